@@ -1,12 +1,208 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.contrib.admin.views.main import ChangeList
+from django.contrib.auth.admin import UserAdmin
+from django.contrib.auth.models import User
+from django.db.models.expressions import RawSQL
+from django.template.response import TemplateResponse
 
 # Register your models here.
 
 from .models import Room, Topic, Message
+from .deletion import delete_user, delete_room, delete_rooms, delete_messages
+from .moderation import move_messages, move_rooms
+from .pagination import EstimatedCountPaginator
+from . import search
 
-# Registers the Room, Topic, and Message models with the Django admin interface,
-# allowing administrators to manage these models through the admin site.
-admin.site.register(Room)
-admin.site.register(Topic)
-admin.site.register(Message)
+# Admin of the Room, Topic and Message models, for the moderators.
+# The changelists join the foreign keys they show (list_select_related), so a page is one query whatever its size.
+# Foreign keys are edited as an id with a lookup popup (raw_id_fields): a <select> would list every user or room.
+# The search box uses the full text search index (search.py) instead of LIKE '%q%' on the whole table.
+# The Message changelist estimates the number of rows (pagination.py) instead of counting them.
+#
+# The bulk actions (delete, move) work in batches of plain queries (deletion.py, moderation.py), without loading the
+# objects. Django's "Delete selected" action is replaced: it loads every selected object and everything that would be
+# deleted with it (every message of a room) to list them on its confirmation page.
 
+
+# Searches with the full text search index when the database has one, with search_fields otherwise.
+class IndexedSearchMixin:
+    def get_search_results(self, request, queryset, search_term):
+        backend = search.get_backend(queryset.db)
+        terms = search.parse_terms(search_term)
+        if backend and terms:
+            return queryset.filter(id__in=RawSQL(*self.search_sql(backend, terms))), False
+        return super().get_search_results(request, queryset, search_term)
+
+
+# Changelist of the estimated counts: the paginator finds the real number of rows when a page turns out short or past
+# the end (pagination.py), the number shown and the page links follow it.
+class EstimatedCountChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+        if self.paginator.count < self.result_count:
+            self.result_count = self.paginator.count
+            self.page_num = min(self.page_num, self.paginator.num_pages)
+            self.multi_page = self.result_count > self.list_per_page
+
+
+# The confirmation page of a bulk delete. Posts the selection back to the action with "post" set.
+def confirmBatchAction(modeladmin, request, title, question):
+    if request.POST.get('post'):
+        return None
+    context = {
+        **modeladmin.admin_site.each_context(request),
+        'title' : title,
+        'question' : question,
+        'opts' : modeladmin.model._meta,
+        'action' : request.POST['action'],
+        'selected' : request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+        'select_across' : request.POST.get('select_across', '0'),
+        'action_checkbox_name' : helpers.ACTION_CHECKBOX_NAME,
+    }
+    return TemplateResponse(request, 'base/admin_confirm_batch.html', context)
+
+
+# The selected rows are counted once for the confirmation page (not loaded), with an estimate for "select all".
+def selectionSize(modeladmin, request, queryset):
+    if request.POST.get('select_across') == '1':
+        return modeladmin.get_paginator(request, queryset, 1).count
+    return len(request.POST.getlist(helpers.ACTION_CHECKBOX_NAME))
+
+
+class TopicAdmin(admin.ModelAdmin):
+    list_display = ('name', 'room_count')
+    search_fields = ('^name',)
+    ordering = ('name',) # the unique index on the name
+
+
+class RoomActionForm(helpers.ActionForm):
+    topic = forms.CharField(required=False, label='Topic', help_text='For "Move to topic".')
+
+
+class RoomAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    list_display = ('name', 'topic', 'host', 'participant_count', 'message_count', 'updated')
+    list_select_related = ('topic', 'host')
+    search_fields = ('name',)
+    raw_id_fields = ('host', 'topic', 'participants')
+    action_form = RoomActionForm
+    actions = ['deleteRooms', 'moveRooms']
+
+    def search_sql(self, backend, terms):
+        return backend.room_ids_sql(terms)
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    # A deleted room is hidden at once, its rows are removed in batches (deletion.py).
+    def delete_model(self, request, obj):
+        delete_room(obj)
+
+    # The confirmation page of a single room shows the number of messages instead of listing them.
+    def get_deleted_objects(self, objs, request):
+        rooms = list(objs)
+        perms_needed = set() if request.user.has_perm('base.delete_message') else {Message._meta.verbose_name}
+        summary = {
+            Room._meta.verbose_name_plural : len(rooms),
+            Message._meta.verbose_name_plural : sum(room.message_count for room in rooms),
+        }
+        return [str(room) for room in rooms], summary, perms_needed, []
+
+    @admin.action(description='Delete selected rooms (in batches)', permissions=['delete'])
+    def deleteRooms(self, request, queryset):
+        size = selectionSize(self, request, queryset)
+        confirmation = confirmBatchAction(self, request, 'Delete rooms',
+                                          f'Delete {size} rooms with all their messages?')
+        if confirmation:
+            return confirmation
+        count = delete_rooms(queryset)
+        self.message_user(request, f'Deleted {count} rooms, their messages are removed in the background.', messages.SUCCESS)
+
+    @admin.action(description='Move selected rooms to topic', permissions=['change'])
+    def moveRooms(self, request, queryset):
+        name = request.POST.get('topic', '').strip()
+        if not name:
+            self.message_user(request, 'Enter the name of the topic to move the rooms to.', messages.ERROR)
+            return
+        # Like the room form, a new name makes a new topic.
+        topic, created = Topic.objects.get_or_create(name=name)
+        count = move_rooms(queryset, topic)
+        self.message_user(request, f'Moved {count} rooms to {topic.name}.', messages.SUCCESS)
+
+
+class MessageActionForm(helpers.ActionForm):
+    room = forms.IntegerField(required=False, label='Room id', help_text='For "Move to room".')
+
+
+class MessageAdmin(IndexedSearchMixin, admin.ModelAdmin):
+    list_display = ('__str__', 'user', 'room', 'created')
+    list_select_related = ('user', 'room')
+    search_fields = ('body',)
+    raw_id_fields = ('user', 'room')
+    paginator = EstimatedCountPaginator
+    # No second COUNT(*) of the whole table next to the number of search results.
+    show_full_result_count = False
+    action_form = MessageActionForm
+    actions = ['deleteMessages', 'moveMessages']
+
+    def search_sql(self, backend, terms):
+        return backend.message_ids_sql(terms)
+
+    def get_changelist(self, request, **kwargs):
+        return EstimatedCountChangeList
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    @admin.action(description='Delete selected messages (in batches)', permissions=['delete'])
+    def deleteMessages(self, request, queryset):
+        size = selectionSize(self, request, queryset)
+        confirmation = confirmBatchAction(self, request, 'Delete messages', f'Delete {size} messages?')
+        if confirmation:
+            return confirmation
+        count = delete_messages(queryset)
+        self.message_user(request, f'Deleted {count} messages.', messages.SUCCESS)
+
+    @admin.action(description='Move selected messages to room', permissions=['change'])
+    def moveMessages(self, request, queryset):
+        try:
+            room = Room.objects.get(id=request.POST.get('room'))
+        except (Room.DoesNotExist, ValueError):
+            self.message_user(request, 'Enter the id of the room to move the messages to.', messages.ERROR)
+            return
+        count = move_messages(queryset, room)
+        self.message_user(request, f'Moved {count} messages to {room.name}.', messages.SUCCESS)
+
+
+admin.site.register(Topic, TopicAdmin)
+admin.site.register(Room, RoomAdmin)
+admin.site.register(Message, MessageAdmin)
+
+
+# Users are deleted with the batched path of deletion.py, instead of loading all their messages at once.
+class BatchDeleteUserAdmin(UserAdmin):
+    def delete_model(self, request, obj):
+        delete_user(obj)
+
+    # The confirmation pages (delete view and "Delete selected") show the number of messages instead of collecting them.
+    def get_deleted_objects(self, objs, request):
+        users = list(objs)
+        perms_needed = set() if request.user.has_perm('base.delete_message') else {Message._meta.verbose_name}
+        summary = {
+            User._meta.verbose_name_plural : len(users),
+            Message._meta.verbose_name_plural : Message.objects.filter(user_id__in=[user.id for user in users]).count(),
+        }
+        return [str(user) for user in users], summary, perms_needed, []
+
+    def delete_queryset(self, request, queryset):
+        for user in queryset:
+            delete_user(user)
+
+
+admin.site.unregister(User)
+admin.site.register(User, BatchDeleteUserAdmin)
@@ -0,0 +1,408 @@
+import asyncio
+import hashlib
+import json
+from urllib.parse import urlencode
+from django.conf import settings
+from django.db.models import Max, OuterRef, Subquery
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.views.decorators.http import condition, require_GET
+from .models import Room, Topic, Message, ArchivedMessage
+from .pagination import paginate
+from .archive import history_page
+from .cache import page_versions, feed_versions, room_versions
+from .routers import read_from_primary
+from .views import filterRooms
+from . import realtime, autocomplete
+
+# JSON API, version 1 (urls under api/v1/).
+# For the mobile apps and bots, which used to scrape the HTML of the home and room pages.
+#
+#   GET api/v1/rooms/                     rooms, newest first. ?q= searches like the home page, ?host=<user id>.
+#   GET api/v1/rooms/<pk>/                one room.
+#   GET api/v1/rooms/<pk>/messages/       messages of a room, newest first, the archived ones last.
+#                                         ?since=<message id> returns the messages posted after that one, oldest first,
+#                                         so a client can poll for new messages with the "since" of the last answer.
+#   GET api/v1/rooms/<pk>/participants/   participants of a room.
+#   GET api/v1/topics/                    every topic, with its number of rooms.
+#   GET api/v1/topics/autocomplete/       ?q=<prefix> the topics whose name starts with q (any case), most rooms first.
+#                                         Served from memory (autocomplete.py), ?limit= up to MAX_LIMIT.
+#   GET api/v1/rooms/<pk>/events/         new messages of a room, as they are posted (long-poll or server-sent events).
+#
+# Lists return {"data": [...], "next": url of the next page or null}, ?limit= sets the page size.
+# ?fields=id,name returns only those fields of every object (sparse fieldsets).
+# Rows are read with .values(), so no model instances are built, and written as compact JSON.
+#
+# The room and message answers have a Last-Modified from the `updated` fields of the rooms and messages they show,
+# and an ETag from those times and the version stamps of the cached pages (cache.py), which signals.py bumps whenever
+# a room, a message, the participants, a topic or a username changes. Both are read with indexed lookups (the newest
+# `updated`), once per request, so a client that sends If-None-Match / If-Modified-Since gets a 304 without the page query.
+
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+
+# Field of the API -> lookup of .values(). id, updated and created are always read, the pages are cut on them.
+ROOM_FIELDS = {
+    'id' : 'id', 'name' : 'name', 'description' : 'description', 'topic' : 'topic__name', 'host' : 'host__username',
+    'host_id' : 'host_id', 'participant_count' : 'participant_count', 'message_count' : 'message_count',
+    'updated' : 'updated', 'created' : 'created',
+}
+MESSAGE_FIELDS = {
+    'id' : 'id', 'room' : 'room_id', 'user' : 'user__username', 'user_id' : 'user_id', 'body' : 'body',
+    'updated' : 'updated', 'created' : 'created',
+}
+TOPIC_FIELDS = {'id' : 'id', 'name' : 'name', 'room_count' : 'room_count'}
+PARTICIPANT_FIELDS = {'id' : 'id', 'username' : 'username'}
+KEYSET_FIELDS = ['id', 'updated', 'created']
+
+
+# Raised by the helpers below, turned into a JSON error by the views.
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def apiResponse(data, status=200):
+    response = JsonResponse(data, status=status, json_dumps_params={'separators' : (',', ':')})
+    # Clients may keep the answer, but have to revalidate it (with its ETag) before using it again.
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+def apiError(error):
+    return apiResponse({'error' : error.message}, status=error.status)
+
+
+# The fields asked for with ?fields=, all of them by default.
+def selectedFields(request, available):
+    if not request.GET.get('fields'):
+        return list(available)
+    fields = [field.strip() for field in request.GET['fields'].split(',') if field.strip()]
+    unknown = [field for field in fields if field not in available]
+    if unknown:
+        raise ApiError(400, f"Unknown fields: {', '.join(unknown)}. Available fields: {', '.join(available)}.")
+    return fields
+
+
+def pageSize(request):
+    try:
+        return max(1, min(int(request.GET.get('limit', API_PAGE_SIZE)), API_MAX_PAGE_SIZE))
+    except ValueError:
+        raise ApiError(400, 'limit must be a number.')
+
+
+# Reads only the lookups of the selected fields (plus `extra`), and renames them to the field names of the API.
+def valuesOf(queryset, fields, available, extra=()):
+    return queryset.values(*{available[field] for field in fields} | set(extra))
+
+
+def serialize(rows, fields, available):
+    return [{field : row[available[field]] for field in fields} for row in rows]
+
+
+# Url of the next page: the same request, with the cursor of the next page.
+def nextUrl(request, cursor):
+    if cursor is None:
+        return None
+    params = {key : value for key, value in request.GET.items() if key != 'cursor'}
+    params['cursor'] = cursor
+    return request.path + '?' + urlencode(params)
+
+
+# A short ETag from the values the answer depends on (and the query string, which changes the answer too).
+def etagOf(request, *values):
+    return hashlib.md5('|'.join(str(value) for value in (request.GET.urlencode(), *values)).encode()).hexdigest()
+
+
+# The newest of the times, None when there are none.
+def newest(*times):
+    return max(filter(None, times), default=None)
+
+
+# Validators of the room list: the newest room or message, and the stamp of the feed pages, which show the same rooms.
+# Computed once per request, @condition asks for the ETag and the Last-Modified separately.
+def roomListState(request):
+    if not hasattr(request, '_api_state'):
+        modified = newest(
+            Room.objects.aggregate(updated=Max('updated'))['updated'],
+            Message.objects.aggregate(updated=Max('updated'))['updated'],
+        )
+        request._api_state = (etagOf(request, modified, *page_versions(feed_versions(request))), modified)
+    return request._api_state
+
+
+def roomListEtag(request):
+    return roomListState(request)[0]
+
+
+def roomListLastModified(request):
+    return roomListState(request)[1]
+
+
+@require_GET
+@condition(etag_func=roomListEtag, last_modified_func=roomListLastModified)
+def apiRooms(request):
+    try:
+        fields = selectedFields(request, ROOM_FIELDS)
+        host = request.GET.get('host')
+        if host and not host.isdigit():
+            raise ApiError(400, 'host must be a user id.')
+        rows, cursor = paginate(
+            valuesOf(filterRooms(request.GET.get('q', ''), host), fields, ROOM_FIELDS, KEYSET_FIELDS),
+            request.GET.get('cursor'), pageSize(request),
+        )
+    except ApiError as error:
+        return apiError(error)
+    except ValueError:
+        return apiError(ApiError(400, 'Invalid cursor.'))
+    return apiResponse({'data' : serialize(rows, fields, ROOM_FIELDS), 'next' : nextUrl(request, cursor)})
+
+
+# Validators of one room and its messages: the newest of the room and its messages, and the stamp of the room page.
+# A room that does not exist has none (and no stamp is read for it), the view answers 404.
+def roomState(request, pk):
+    if not hasattr(request, '_api_state'):
+        newest_message = Message.objects.filter(room=OuterRef('pk')).order_by('-updated').values('updated')[:1]
+        row = Room.objects.filter(id=pk).annotate(newest_message=Subquery(newest_message)).values_list('updated', 'newest_message').first()
+        if row is None:
+            request._api_state = (None, None)
+        else:
+            modified = newest(*row)
+            request._api_state = (etagOf(request, pk, modified, *page_versions(room_versions(request, pk))), modified)
+    return request._api_state
+
+
+def roomEtag(request, pk):
+    return roomState(request, pk)[0]
+
+
+def roomLastModified(request, pk):
+    return roomState(request, pk)[1]
+
+
+@require_GET
+@condition(etag_func=roomEtag, last_modified_func=roomLastModified)
+def apiRoom(request, pk):
+    try:
+        fields = selectedFields(request, ROOM_FIELDS)
+    except ApiError as error:
+        return apiError(error)
+    row = valuesOf(Room.objects.filter(id=pk), fields, ROOM_FIELDS).first()
+    if row is None:
+        return apiError(ApiError(404, 'Room not found.'))
+    return apiResponse({'data' : serialize([row], fields, ROOM_FIELDS)[0]})
+
+
+@require_GET
+@condition(etag_func=roomEtag, last_modified_func=roomLastModified)
+def apiRoomMessages(request, pk):
+    if not Room.objects.filter(id=pk).exists():
+        return apiError(ApiError(404, 'Room not found.'))
+    try:
+        fields = selectedFields(request, MESSAGE_FIELDS)
+        size = pageSize(request)
+        messages = Message.objects.filter(room_id=pk)
+        if 'since' in request.GET:
+            # Incremental fetch: the messages posted after the `since` message, oldest first.
+            try:
+                since = int(request.GET['since'])
+            except ValueError:
+                raise ApiError(400, 'since must be a message id.')
+            rows = list(valuesOf(messages.filter(id__gt=since).order_by('id'), fields, MESSAGE_FIELDS, ['id'])[:size])
+            return apiResponse({
+                'data' : serialize(rows, fields, MESSAGE_FIELDS),
+                # Where the next poll starts. The same value when there was nothing new.
+                'since' : rows[-1]['id'] if rows else since,
+                # More than one page of new messages: fetch again right away.
+                'more' : len(rows) == size,
+            })
+        # The pages go on with the archived messages once the recent ones ran out (see archive.py).
+        rows, cursor = history_page(
+            valuesOf(messages, fields, MESSAGE_FIELDS, KEYSET_FIELDS),
+            valuesOf(ArchivedMessage.objects.filter(room_id=pk), fields, MESSAGE_FIELDS, KEYSET_FIELDS),
+            request.GET.get('cursor'), size,
+        )
+    except ApiError as error:
+        return apiError(error)
+    except ValueError:
+        return apiError(ApiError(400, 'Invalid cursor.'))
+    return apiResponse({'data' : serialize(rows, fields, MESSAGE_FIELDS), 'next' : nextUrl(request, cursor)})
+
+
+# Small lists without an updated field: the ETag is computed from the answer itself, which still saves the download.
+def conditionalResponse(request, data):
+    response = apiResponse(data)
+    etag = '"' + hashlib.md5(response.content).hexdigest() + '"'
+    response['ETag'] = etag
+    return get_conditional_response(request, etag=etag, response=response)
+
+
+@require_GET
+def apiRoomParticipants(request, pk):
+    room = Room.objects.filter(id=pk).first()
+    if room is None:
+        return apiError(ApiError(404, 'Room not found.'))
+    try:
+        fields = selectedFields(request, PARTICIPANT_FIELDS)
+        size = pageSize(request)
+        participants = room.participants.order_by('id')
+        # Participants have no timestamps, their pages are cut on the user id.
+        if request.GET.get('cursor'):
+            try:
+                participants = participants.filter(id__gt=int(request.GET['cursor']))
+            except ValueError:
+                raise ApiError(400, 'Invalid cursor.')
+        rows = list(valuesOf(participants, fields, PARTICIPANT_FIELDS, ['id'])[:size + 1])
+    except ApiError as error:
+        return apiError(error)
+    cursor = str(rows[size - 1]['id']) if len(rows) > size else None
+    return conditionalResponse(request, {'data' : serialize(rows[:size], fields, PARTICIPANT_FIELDS), 'next' : nextUrl(request, cursor)})
+
+
+@require_GET
+def apiTopics(request):
+    try:
+        fields = selectedFields(request, TOPIC_FIELDS)
+    except ApiError as error:
+        return apiError(error)
+    rows = valuesOf(Topic.objects.order_by('name'), fields, TOPIC_FIELDS)
+    return conditionalResponse(request, {'data' : serialize(rows, fields, TOPIC_FIELDS)})
+
+
+# Topics for the topic field of the room form (script.js), without a database query.
+@require_GET
+def apiTopicAutocomplete(request):
+    try:
+        fields = selectedFields(request, TOPIC_FIELDS)
+        limit = int(request.GET['limit']) if request.GET.get('limit') else None
+    except ApiError as error:
+        return apiError(error)
+    except ValueError:
+        return apiError(ApiError(400, 'limit must be a number.'))
+    rows = [dict(zip(('id', 'name', 'room_count'), topic)) for topic in autocomplete.suggest(request.GET.get('q'), limit)]
+    return apiResponse({'data' : serialize(rows, fields, TOPIC_FIELDS)})
+
+
+# Room events: the messages posted in a room after the client's cursor (?since=<message id>), as soon as they exist.
+# For clients without the WebSocket chat, which would otherwise reload the whole room page to see new messages.
+#
+#   Long-poll (default): answers right away when there are newer messages, otherwise waits until one is posted
+#                        (or POLL_TIMEOUT seconds) and answers {"data": [...], "since": ...}. The client asks again
+#                        with the new "since".
+#   Server-sent events:  with "Accept: text/event-stream" (EventSource in the browser) the answer is a stream with one
+#                        "message" event per new message, and "message_deleted" events. EventSource reconnects by
+#                        itself and sends the id of the last event in Last-Event-ID, which is used as the cursor.
+#
+# The view is async: a waiting request is only a subscription to the channel of the room (realtime.py) on the event
+# loop of the ASGI application. It reads the database once when it starts, and is woken by the delta that is
+# published when a message is created, so idle watchers never query the database in a loop.
+# On the WSGI application (runserver) it works too, but every waiting request holds a thread, and the event stream
+# ends after each answer (EventSource reconnects after `retry` milliseconds).
+#
+# Settings (settings.ROOM_EVENTS, all optional):
+#   POLL_TIMEOUT   seconds a long-poll request waits for a new message.
+#   KEEPALIVE      seconds between the comments sent on an idle event stream, so proxies do not close it.
+#   MAX_MESSAGES   maximum number of messages in one answer.
+#   RETRY          milliseconds an EventSource waits before it reconnects.
+
+EVENTS_DEFAULTS = {
+    'POLL_TIMEOUT' : 25,
+    'KEEPALIVE' : 15,
+    'MAX_MESSAGES' : 100,
+    'RETRY' : 3000,
+}
+
+
+def eventSettings():
+    return {**EVENTS_DEFAULTS, **getattr(settings, 'ROOM_EVENTS', {})}
+
+
+# The messages of the room after `since`, oldest first, in the format of the real-time deltas.
+# Read from the primary database: a replica could still miss a message whose delta was already published.
+async def messagesSince(pk, since, limit):
+    with read_from_primary():
+        messages = Message.objects.filter(room_id=pk, id__gt=since).select_related('user__avatar').order_by('id')[:limit]
+        return [realtime.message_delta(message) async for message in messages]
+
+
+# Keeps the message deltas newer than `since`, and the deletions.
+def newEvents(deltas, since):
+    return [delta for delta in deltas if delta['type'] != 'message' or delta['id'] > since]
+
+
+# Waits up to `timeout` seconds for the next events of the subscription, and returns them with the ones already waiting.
+async def nextEvents(subscription, since, timeout):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while (remaining := deadline - loop.time()) > 0:
+        try:
+            first = await asyncio.wait_for(subscription.get(), remaining)
+        except asyncio.TimeoutError:
+            break
+        events = newEvents([first, *subscription.pending()], since)
+        if events:
+            return events
+    return []
+
+
+def sseEvent(delta):
+    lines = [f"event: {delta['type']}", f'data: {json.dumps(delta, separators=(",", ":"))}']
+    if delta['type'] == 'message':
+        lines.insert(0, f"id: {delta['id']}")
+    return '\n'.join(lines) + '\n\n'
+
+
+# The event stream. The subscription is made before the database is read, so no message can fall between the two.
+async def eventStream(pk, since, options, endless):
+    subscription = realtime.get_broker().subscribe(realtime.room_channel(pk))
+    try:
+        yield f"retry: {options['RETRY']}\n\n"
+        events = await messagesSince(pk, since, options['MAX_MESSAGES'])
+        while True:
+            for event in events:
+                if event['type'] == 'message':
+                    since = event['id']
+                yield sseEvent(event)
+            if events and not endless:
+                return
+            events = await nextEvents(subscription, since, options['KEEPALIVE'] if endless else options['POLL_TIMEOUT'])
+            if not events:
+                if not endless:
+                    return
+                yield ': keep-alive\n\n'
+    finally:
+        subscription.close()
+
+
+async def apiRoomEvents(request, pk):
+    if request.method != 'GET':
+        return apiError(ApiError(405, 'Only GET is allowed.'))
+    options = eventSettings()
+    try:
+        since = int(request.GET.get('since') or request.headers.get('Last-Event-ID') or 0)
+    except ValueError:
+        return apiError(ApiError(400, 'since must be a message id.'))
+    if not await Room.objects.filter(id=pk).aexists():
+        return apiError(ApiError(404, 'Room not found.'))
+
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        # Only the ASGI application can keep a stream open without holding a thread.
+        response = StreamingHttpResponse(
+            eventStream(pk, since, options, endless=isinstance(request, ASGIRequest)), content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no' # nginx would buffer the stream otherwise.
+        return response
+
+    subscription = realtime.get_broker().subscribe(realtime.room_channel(pk))
+    try:
+        messages = await messagesSince(pk, since, options['MAX_MESSAGES'])
+        if not messages:
+            events = await nextEvents(subscription, since, options['POLL_TIMEOUT'])
+            messages = [event for event in events if event['type'] == 'message'][:options['MAX_MESSAGES']]
+    finally:
+        subscription.close()
+    return apiResponse({'data' : messages, 'since' : messages[-1]['id'] if messages else since})
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class BaseConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'base'
+
+    # Connects the signal handlers (search index, database connection setup, query instrumentation etc.) and registers
+    # the system checks once the models are loaded.
+    def ready(self):
+        from . import signals, db, instrumentation, checks
@@ -0,0 +1,103 @@
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Message, ArchivedMessage
+from .pagination import paginate, ROOM_PAGE_SIZE
+from . import search, timeline
+
+# Message retention: recent messages stay in the Message table ("hot"), older ones are moved to ArchivedMessage.
+# Rooms with years of history would otherwise keep a huge Message table, and every index on it (room page, activity
+# stream, profile pages) grows with it. The archive table has a single index, for the "older messages" pages of a room.
+#
+# The archive_messages command moves the messages in small batches, each batch in its own short transaction
+# (copy the rows, then delete them), so the database is never locked for long and the site keeps answering in between.
+# The counters are not changed: Room.message_count counts the archived messages too (see the recount command).
+#
+# Settings (settings.MESSAGE_RETENTION, all optional):
+#   HOT_DAYS    messages created more than this many days ago are archived.
+#   BATCH_SIZE  number of messages moved per transaction.
+#   PAUSE       seconds to wait between two batches, so other writers get the database lock.
+
+DEFAULTS = {
+    'HOT_DAYS' : 90,
+    'BATCH_SIZE' : 1000,
+    'PAUSE' : 0.05,
+}
+
+# Cursors of the archive part of the history start with this prefix (base64 cursors never contain a dot).
+ARCHIVE_CURSOR = 'a.'
+
+
+def get_settings():
+    return {**DEFAULTS, **getattr(settings, 'MESSAGE_RETENTION', {})}
+
+
+# The messages created before this moment are archived.
+def cutoff(days=None):
+    return timezone.now() - timedelta(days=get_settings()['HOT_DAYS'] if days is None else days)
+
+
+# Moves up to batch_size messages created before `before` and with an id above `after` to the archive, in one
+# transaction. Returns the number of messages moved (0 when there is nothing left to archive) and the last id moved.
+def archive_batch(before, batch_size, after=0, using='default'):
+    from .signals import invalidateRoomPages
+
+    with transaction.atomic(using=using):
+        # Old messages have the smallest ids, so walking the primary key finds them without an index on created.
+        # The walk starts after the last batch, instead of reading again the newer messages it skipped.
+        rows = list(
+            Message.objects.using(using).filter(id__gt=after, created__lt=before).order_by('id')
+            .values('id', 'user_id', 'room_id', 'body', 'updated', 'created')[:batch_size]
+        )
+        if not rows:
+            return 0, after
+        ids = [row['id'] for row in rows]
+        # ignore_conflicts: a batch that was copied but not deleted (crash in between) can be archived again.
+        ArchivedMessage.objects.using(using).bulk_create([ArchivedMessage(**row) for row in rows], ignore_conflicts=True)
+        # A plain DELETE: .delete() would send post_delete for every message, and the signals would lower the counters
+        # and tell the open room pages that the messages are gone, when they were only moved.
+        Message.objects.using(using).filter(id__in=ids)._raw_delete(using)
+        search.remove_messages(ids, using=using)
+        # The activity column only shows recent messages.
+        timeline.remove_events(ids, using=using)
+        room_ids = {row['room_id'] for row in rows}
+        transaction.on_commit(lambda: invalidateRoomPages(room_ids), using=using)
+    return len(rows), ids[-1]
+
+
+# Archives every message created before `before`, batch after batch. max_batches limits the work of one run,
+# so the command can run often (from cron) and catch up a little every time.
+# Yields the number of messages moved by each batch.
+def archive(before, batch_size=None, pause=None, max_batches=None, using='default'):
+    options = get_settings()
+    batch_size = batch_size or options['BATCH_SIZE']
+    pause = options['PAUSE'] if pause is None else pause
+    batches, last = 0, 0
+    while max_batches is None or batches < max_batches:
+        moved, last = archive_batch(before, batch_size, last, using)
+        if not moved:
+            return
+        batches += 1
+        yield moved
+        if moved < batch_size:
+            return
+        time.sleep(pause)
+
+
+# One page of the history of a room, newest first: the hot messages, then the archived ones.
+# hot and archived are the querysets of the room (model instances or .values() rows), cursor the one of the previous page.
+# Returns the items and the cursor of the next page (None on the last page). Raises ValueError for invalid cursors.
+def history_page(hot, archived, cursor=None, size=ROOM_PAGE_SIZE):
+    if cursor and cursor.startswith(ARCHIVE_CURSOR):
+        items, next_cursor = paginate(archived, cursor[len(ARCHIVE_CURSOR):] or None, size)
+        return items, next_cursor and ARCHIVE_CURSOR + next_cursor
+    items, next_cursor = paginate(hot, cursor, size)
+    if next_cursor:
+        return items, next_cursor
+    # The hot messages ran out, the page is filled up with the newest archived messages.
+    if len(items) < size:
+        older, archive_cursor = paginate(archived, None, size - len(items))
+        return items + older, archive_cursor and ARCHIVE_CURSOR + archive_cursor
+    return items, ARCHIVE_CURSOR if archived.exists() else None
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+
+# Authentication fast path, turned on in the settings (SESSION_ENGINE, AUTH_USER_CACHE), off by default.
+# On every request AuthenticationMiddleware loads the logged in user: a SELECT on auth_user, on top of the session
+# lookup. The session can be cached by the cached_db session engine (settings.SESSION_ENGINE), and the user by this
+# backend, in the same "sessions" cache. The user is cached under its id and dropped when it is saved or deleted
+# (signals.py), so a new password (which logs the other sessions out) is seen right away. The same for a new avatar.
+# AuthenticationMiddleware already keeps request.user for the rest of the request, so a request loads it at most once.
+#
+# Settings:
+#   SESSION_CACHE_ALIAS      the cache of the sessions and users. It must be a shared cache (memcached, Redis), so a
+#                            logout or a saved user is seen by every process: a LocMemCache is refused outside DEBUG
+#                            (checks.py).
+#   AUTH_USER_CACHE_TIMEOUT  seconds a user stays in the cache.
+
+
+def user_cache():
+    return caches[getattr(settings, 'SESSION_CACHE_ALIAS', 'default')]
+
+
+def user_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def forget_user(user_id):
+    user_cache().delete(user_key(user_id))
+
+
+# ModelBackend that looks the logged in user up in the cache first. Logging in (authenticate) is not changed.
+class CachedModelBackend(ModelBackend):
+    def get_user(self, user_id):
+        key = user_key(user_id)
+        user = user_cache().get(key)
+        if user is None:
+            # The avatar is shown on every page (navbar), so it is cached with the user.
+            user = get_user_model()._default_manager.select_related('avatar').filter(pk=user_id).first()
+            if user is None:
+                return None
+            user_cache().set(key, user, getattr(settings, 'AUTH_USER_CACHE_TIMEOUT', 300))
+        return user if self.user_can_authenticate(user) else None
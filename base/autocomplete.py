@@ -0,0 +1,191 @@
+import heapq
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+from django.conf import settings
+from django.db import DatabaseError
+from .models import Topic
+
+logger = logging.getLogger(__name__)
+
+# Topic autocomplete.
+# The room form used to render every topic into its <datalist>, so the page grew with the Topic table. Now it ships
+# no topics: script.js asks api/v1/topics/autocomplete/?q=<what was typed> for the best matches as the user types.
+#
+# The matches come from an index in the memory of the process, not from the database: the topic names, lowercased
+# and sorted, so the names starting with a prefix are one slice found with bisect. They are ranked by popularity
+# (the number of rooms of the topic), and the best MAX_LIMIT of a prefix are remembered, so the next request for the
+# same prefix is a dict lookup.
+#
+# The index is loaded once per process (wsgi.py / asgi.py warm it at startup) and kept up to date by signals.py
+# after the transaction is committed: new, renamed and deleted topics, rooms moving in and out of a topic.
+# Changes made by other processes (or without signals) are picked up when it is loaded again, every REFRESH seconds.
+#
+# Settings (settings.TOPIC_AUTOCOMPLETE, all optional):
+#   LIMIT      number of topics returned by default (?limit= asks for another number, up to MAX_LIMIT).
+#   MAX_LIMIT  most topics returned for a prefix.
+#   REFRESH    seconds after which the index is loaded again from the database.
+#   MEMO_SIZE  number of prefixes whose matches are remembered.
+
+DEFAULTS = {
+    'LIMIT' : 10,
+    'MAX_LIMIT' : 50,
+    'REFRESH' : 300,
+    'MEMO_SIZE' : 10000,
+}
+
+
+def get_settings():
+    return {**DEFAULTS, **getattr(settings, 'TOPIC_AUTOCOMPLETE', {})}
+
+
+def fold(name):
+    return name.casefold()
+
+
+class TopicIndex:
+    def __init__(self, topics, options):
+        self.options = options
+        self.lock = threading.Lock()
+        # id -> (name, number of rooms)
+        self.topics = {pk : (name, weight) for pk, name, weight in topics}
+        # (folded name, id), sorted.
+        self.keys = sorted((fold(name), pk) for pk, (name, _) in self.topics.items())
+        # folded prefix -> ids of its best MAX_LIMIT topics.
+        self.memo = {}
+        self.loaded = time.monotonic()
+
+    # The best `limit` topics starting with `prefix`: [(id, name, number of rooms)], most rooms first.
+    def search(self, prefix, limit):
+        prefix = fold(prefix.strip())
+        with self.lock:
+            ids = self.memo.get(prefix)
+            if ids is None:
+                ids = self.memo[prefix] = self.best(prefix)
+                if len(self.memo) > self.options['MEMO_SIZE']:
+                    self.memo.clear()
+            return [(pk, *self.topics[pk]) for pk in ids[:limit]]
+
+    def best(self, prefix):
+        start = bisect_left(self.keys, (prefix,))
+        # Every name with the prefix sorts before prefix + the last code point.
+        end = bisect_left(self.keys, (prefix + '\U0010ffff',), start)
+        matches = (pk for _, pk in self.keys[start:end])
+        return heapq.nsmallest(self.options['MAX_LIMIT'], matches, key=self.rank)
+
+    # Most rooms first, then by name.
+    def rank(self, pk):
+        name, weight = self.topics[pk]
+        return (-weight, fold(name), pk)
+
+    # Adds a topic, or changes its name and number of rooms.
+    def put(self, pk, name, weight):
+        with self.lock:
+            self.drop(pk)
+            self.topics[pk] = (name, weight)
+            insort(self.keys, (fold(name), pk))
+            self.rerank(pk)
+
+    def remove(self, pk):
+        with self.lock:
+            self.drop(pk)
+
+    # A room was added to (amount 1) or removed from (-1) the topic.
+    def count(self, pk, amount):
+        with self.lock:
+            if pk in self.topics:
+                name, weight = self.topics[pk]
+                self.topics[pk] = (name, max(0, weight + amount))
+                self.rerank(pk, lower=amount < 0)
+
+    def drop(self, pk):
+        if pk not in self.topics:
+            return
+        self.rerank(pk, gone=True)
+        key = (fold(self.topics.pop(pk)[0]), pk)
+        position = bisect_left(self.keys, key)
+        if position < len(self.keys) and self.keys[position] == key:
+            del self.keys[position]
+
+    # Updates the remembered matches of every prefix of the name of a topic that was added or gained rooms,
+    # lost rooms (lower) or is going away (gone).
+    # The short prefixes have the most matches and are the slowest to compute again, so a topic is put in its place
+    # in the lists. Only a full list that loses a topic or where it moves down is forgotten: the next best topic is
+    # not in it.
+    def rerank(self, pk, lower=False, gone=False):
+        folded = fold(self.topics[pk][0])
+        for length in range(len(folded) + 1):
+            prefix = folded[:length]
+            ids = self.memo.get(prefix)
+            if ids is None:
+                continue
+            if (lower or gone) and len(ids) >= self.options['MAX_LIMIT'] and pk in ids:
+                del self.memo[prefix]
+                continue
+            ids = [other for other in ids if other != pk]
+            if not gone:
+                ids.append(pk)
+            self.memo[prefix] = sorted(ids, key=self.rank)[:self.options['MAX_LIMIT']]
+
+
+_index = None
+_loading = threading.Lock()
+
+
+def load(options=None):
+    global _index
+    options = options or get_settings()
+    topics = Topic.objects.values_list('id', 'name', 'room_count').iterator(chunk_size=2000)
+    _index = TopicIndex(topics, options)
+    return _index
+
+
+# The index of this process, loaded when missing or older than REFRESH seconds.
+def get_index():
+    options = get_settings()
+    index = _index
+    if index is None or time.monotonic() - index.loaded > options['REFRESH']:
+        with _loading:
+            # Another thread may have loaded it while this one waited.
+            if _index is index:
+                index = load(options)
+            else:
+                index = _index
+    return index
+
+
+def suggest(prefix, limit=None):
+    options = get_settings()
+    limit = max(1, min(limit or options['LIMIT'], options['MAX_LIMIT']))
+    return get_index().search(prefix or '', limit)
+
+
+# Loads the index before the first request (wsgi.py, asgi.py). Before the first migrate there is no Topic table yet,
+# the index is then loaded by the first request instead.
+def warm():
+    try:
+        load()
+    except DatabaseError as error:
+        logger.warning('Topic autocomplete index not loaded: %s', error)
+
+
+# Changes from signals.py, only applied to an index that is already loaded (a new one reads them from the database).
+def topic_saved(pk, name, weight):
+    if _index is not None:
+        _index.put(pk, name, weight)
+
+
+def topic_deleted(pk):
+    if _index is not None:
+        _index.remove(pk)
+
+
+def topic_counted(pk, amount):
+    if _index is not None:
+        _index.count(pk, amount)
+
+
+def reset():
+    global _index
+    _index = None
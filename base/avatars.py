@@ -0,0 +1,81 @@
+import hashlib
+import io
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.templatetags.static import static
+from .models import Avatar
+
+# Needs Pillow (pip install pillow) to make the thumbnails. Without it, uploads are refused (AvatarForm).
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# User avatars, stored on the server instead of linking to an outside image host on every page.
+#
+# An uploaded image is cropped to a square and resized once, at upload, to the fixed SIZES (WebP files).
+# The files are named after the SHA-256 of the upload: avatars/ab/abcdef...-small.webp. A new picture gets a new name,
+# so the files never change and StaticFilesMiddleware serves them with the same one-year "immutable" Cache-Control
+# as the hashed static files. The same picture uploaded twice is stored once.
+# Old thumbnails are kept when a user changes their avatar: another user may have uploaded the same picture.
+#
+# Settings (settings.AVATARS, all optional):
+#   SIZES      name -> width and height in pixels. About twice the size they are shown at, for high density screens.
+#   MAX_BYTES  largest upload accepted.
+
+DEFAULTS = {
+    'SIZES' : {'small' : 64, 'medium' : 160},
+    'MAX_BYTES' : 5 * 1024 * 1024,
+}
+
+FALLBACK = 'images/avatar.svg'
+
+
+def get_settings():
+    return {**DEFAULTS, **getattr(settings, 'AVATARS', {})}
+
+
+def avatar_name(digest, size):
+    return f'avatars/{digest[:2]}/{digest}-{size}.webp'
+
+
+# Square thumbnail of the image, as WebP bytes.
+def thumbnail(image, pixels):
+    square = ImageOps.fit(image, (pixels, pixels), Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    square.save(output, 'WEBP', quality=85, method=6)
+    return output.getvalue()
+
+
+# Makes the thumbnails of an uploaded image (a file object) and sets it as the avatar of the user.
+# Raises ValueError if the file is not an image Pillow can read.
+def save_avatar(user, upload):
+    data = upload.read()
+    digest = hashlib.sha256(data).hexdigest()
+    sizes = get_settings()['SIZES']
+    missing = [size for size in sizes if not default_storage.exists(avatar_name(digest, size))]
+    if missing:
+        try:
+            image = Image.open(io.BytesIO(data))
+            # Photos from phones are often stored sideways, with the rotation in the EXIF data.
+            image = ImageOps.exif_transpose(image).convert('RGBA')
+        except Exception as error:
+            raise ValueError('Not a valid image.') from error
+        for size in missing:
+            default_storage.save(avatar_name(digest, size), ContentFile(thumbnail(image, sizes[size])))
+    with transaction.atomic():
+        Avatar.objects.update_or_create(user=user, defaults={'digest' : digest})
+    return digest
+
+
+# Url of the avatar of a user at one of the SIZES, or of the default avatar.
+# The user's avatar should be fetched with select_related('avatar') (or 'user__avatar', 'host__avatar'...).
+def avatar_url(user, size='small'):
+    try:
+        digest = user.avatar.digest
+    except (Avatar.DoesNotExist, AttributeError):
+        # No avatar, or no user (a room whose host was deleted).
+        return static(FALLBACK)
+    return default_storage.url(avatar_name(digest, size))
@@ -0,0 +1,172 @@
+import hashlib
+import threading
+import time
+from functools import wraps
+from urllib.parse import urlencode
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+from .instrumentation import record_cache
+
+# Template fragment caching for the topic sidebar, the room cards and the activity items.
+#
+# The fragments are cached with the {% cache %} tag in the "fragments" cache (settings.CACHES).
+# Their keys contain the id and the `updated` timestamp of the object, so an edited room or message
+# gets a new key and the old entry is simply never read again (and is evicted later).
+# A room card is also keyed on the name of its topic, and shows its host and age outside the cached part.
+# The topic sidebar depends on all topics at once, so it is keyed on a "topic-list version", which the signals in
+# signals.py bump when a topic is saved or deleted, and when a room is created, deleted or moved to another topic.
+
+FRAGMENT_CACHE = 'fragments'
+TOPICS_VERSION_KEY = 'fragments:topics:version'
+
+# Keys of fragments written by the {% cache %} tag start with this prefix.
+FRAGMENT_KEY_PREFIX = 'template.cache.'
+
+
+# Hit/miss counters of every CountingLocMemCache in this process, by cache location.
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+# Local memory cache that counts its fragment hits and misses.
+# LocMemCache already evicts the least recently used entries once OPTIONS['MAX_ENTRIES'] is reached.
+class CountingLocMemCache(LocMemCache):
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        self.location = name
+
+    def get(self, key, default=None, version=None):
+        missing = object()
+        value = super().get(key, missing, version)
+        if key.startswith(FRAGMENT_KEY_PREFIX):
+            record_cache(FRAGMENT_CACHE, value is not missing)
+            with _stats_lock:
+                stats = _stats.setdefault(self.location, {'hits' : 0, 'misses' : 0})
+                stats['hits' if value is not missing else 'misses'] += 1
+        return default if value is missing else value
+
+
+# Returns {location: {'hits': ..., 'misses': ...}} for every counting cache.
+def cache_stats():
+    with _stats_lock:
+        return {location : dict(stats) for location, stats in _stats.items()}
+
+
+# The current topic-list version. A new one is made if it is missing (never set, or evicted).
+def topics_version():
+    return caches[FRAGMENT_CACHE].get_or_set(TOPICS_VERSION_KEY, time.time_ns, None)
+
+
+def bump_topics_version():
+    caches[FRAGMENT_CACHE].set(TOPICS_VERSION_KEY, time.time_ns(), None)
+
+
+# Full page cache for anonymous visitors.
+# Logged out visitors all get the same HTML for the same url, so the response of home, room and the "load more"
+# pages is cached by path and normalized query string, and served without running the view.
+#
+# Every cached page also depends on version stamps: the global stamp (anything on the feed changed) and/or the stamp
+# of one room. signals.py bumps them when a room is created, edited or deleted, when a message is posted or deleted,
+# and when participants or topics change. A bumped stamp gives a new cache key and a new ETag, so the old page is
+# never served again. Browsers that send If-None-Match with the current ETag get a 304 without any rendering.
+# The stamps are rows of the PageVersion table, shared by every process, so a page bumped by one process is not
+# served by another (the pages themselves stay in the memory of each process). Reading them is one query by primary key.
+# The key and ETag of a page also change every TIMEOUT seconds of the "pages" cache, to refresh its relative times.
+
+PAGE_CACHE = 'pages'
+GLOBAL_VERSION = 'pages:version:global'
+
+
+def room_version_key(room_id):
+    return f'pages:version:room:{room_id}'
+
+
+# The current stamps of the version keys, 0 for the keys that were never bumped.
+# Read from the primary: a replica that lags behind would still give the stamp of a page that changed.
+def page_versions(keys):
+    from .models import PageVersion
+
+    versions = dict(PageVersion.objects.using('default').filter(key__in=keys).values_list('key', 'stamp'))
+    return [versions.get(key, 0) for key in keys]
+
+
+# Inserts or updates the rows of the keys, in one query (a key may only be in it once).
+def bump_page_versions(keys):
+    from .models import PageVersion
+
+    stamp = time.time_ns()
+    PageVersion.objects.bulk_create(
+        [PageVersion(key=key, stamp=stamp) for key in dict.fromkeys(keys)],
+        update_conflicts=True, unique_fields=['key'], update_fields=['stamp'],
+    )
+
+
+# The number of the current TIMEOUT-long period of the "pages" cache, 0 when the pages never time out.
+def page_period():
+    timeout = caches[PAGE_CACHE].default_timeout
+    return int(time.time() // timeout) if timeout else 0
+
+
+# Query string with the parameters sorted and empty ones dropped, so ?b=1&a=2 and ?a=2&b=1&c= share one cache entry.
+def normalized_query(request):
+    return urlencode(sorted((key, value) for key, values in request.GET.lists() for value in values if value))
+
+
+# Pages of anonymous visitors with pending flash messages (django.contrib.messages) are personal, and never cached.
+def is_cacheable_request(request):
+    return (
+        request.method in ('GET', 'HEAD')
+        and not request.user.is_authenticated
+        and 'messages' not in request.COOKIES
+    )
+
+
+# View decorator. version_keys(request, *args, **kwargs) returns the version keys the page depends on.
+def anonymous_page_cache(version_keys):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not is_cacheable_request(request):
+                return view(request, *args, **kwargs)
+
+            versions = page_versions(version_keys(request, *args, **kwargs))
+            identity = f'{request.path}?{normalized_query(request)}|{page_period()}|' + '|'.join(str(version) for version in versions)
+            digest = hashlib.md5(identity.encode()).hexdigest()
+            cache_key = f'pages:page:{digest}'
+            etag = quote_etag(digest)
+
+            if etag in parse_etags(request.headers.get('If-None-Match', '')):
+                record_cache(PAGE_CACHE, True)
+                response = HttpResponseNotModified()
+            else:
+                cached = caches[PAGE_CACHE].get(cache_key)
+                record_cache(PAGE_CACHE, cached is not None)
+                if cached is not None:
+                    content, content_type = cached
+                    response = HttpResponse(content, content_type=content_type)
+                else:
+                    response = view(request, *args, **kwargs)
+                    if response.status_code != 200 or response.streaming or response.cookies:
+                        return response
+                    caches[PAGE_CACHE].set(cache_key, (response.content, response['Content-Type']))
+
+            response['ETag'] = etag
+            # The same url shows another page to logged in users, so shared caches must keep them apart, and browsers must revalidate.
+            patch_vary_headers(response, ['Cookie'])
+            patch_cache_control(response, no_cache=True)
+            return response
+        return wrapper
+    return decorator
+
+
+# Version keys of the pages that show the whole feed (home and the "load more" pages).
+def feed_versions(request, *args, **kwargs):
+    return [GLOBAL_VERSION]
+
+
+# Version keys of a room page.
+def room_versions(request, pk, *args, **kwargs):
+    return [room_version_key(pk)]
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+# System checks of the settings (run by runserver, migrate, check and the test runner).
+
+# Session engines that keep the sessions in settings.SESSION_CACHE_ALIAS.
+CACHED_SESSION_ENGINES = {'django.contrib.sessions.backends.cache', 'django.contrib.sessions.backends.cached_db'}
+
+
+# The cached sessions and users (auth.py) must be shared by every process: a logout, a new password or a deactivated
+# user only drops them from the cache it is written to, and a LocMemCache is in the memory of one process.
+# Fine with DEBUG (one runserver process), refused otherwise.
+@checks.register(checks.Tags.caches)
+def check_session_cache(app_configs, **kwargs):
+    cached = settings.SESSION_ENGINE in CACHED_SESSION_ENGINES or 'base.auth.CachedModelBackend' in settings.AUTHENTICATION_BACKENDS
+    alias = getattr(settings, 'SESSION_CACHE_ALIAS', 'default')
+    if settings.DEBUG or not cached or not isinstance(caches[alias], LocMemCache):
+        return []
+    return [checks.Error(
+        f'The "{alias}" cache of the cached sessions and users is a LocMemCache, which is not shared by the processes: '
+        f'a logout in one process would not log the session out in the others.',
+        hint='Set REDIS_URL (or another shared cache for SESSION_CACHE_ALIAS), or use the db session engine and ModelBackend.',
+        id='base.E001',
+    )]
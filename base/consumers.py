@@ -0,0 +1,129 @@
+import asyncio
+import json
+import re
+from importlib import import_module
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import close_old_connections
+from django.http.cookie import parse_cookie
+from .models import Room
+from .ingest import submit_message, IngestQueueFull
+from .realtime import get_broker, room_channel
+
+# WebSocket chat for the rooms, served by the ASGI application (studybuddy/asgi.py).
+# The browser connects to /ws/room/<pk>/ and:
+#   - receives a JSON delta (see realtime.py) every time a message is posted in, or deleted from, the room.
+#   - sends {"body": "..."} to post a message. It is saved to Message like a POST to the room view (or queued, see ingest.py),
+#     and the delta is published to every connected participant by the signals in signals.py.
+
+ROOM_PATH = re.compile(r'^/ws/room/(?P<pk>\d+)/$')
+
+# Close codes sent to the browser when the connection is refused.
+CLOSE_NOT_FOUND = 4404
+CLOSE_FORBIDDEN = 4403
+
+
+# Runs a function that uses the database in a worker thread, and closes connections that are too old,
+# like Django does around every HTTP request.
+def databaseSyncToAsync(function):
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(wrapper)
+
+
+# Finds the logged in user from the session cookie of the WebSocket handshake.
+@databaseSyncToAsync
+def getUser(scope):
+    headers = dict(scope.get('headers', []))
+    cookies = parse_cookie(headers.get(b'cookie', b'').decode('latin-1'))
+    session = import_module(settings.SESSION_ENGINE).SessionStore(cookies.get(settings.SESSION_COOKIE_NAME))
+    return get_user(SimpleNamespace(session=session))
+
+
+@databaseSyncToAsync
+def getRoom(pk):
+    return Room.objects.filter(id=pk).first()
+
+
+@databaseSyncToAsync
+def postMessage(room, user, body):
+    submit_message(room, user, body)
+
+
+# Browsers send the Origin header on WebSocket handshakes. Connections from other sites are refused,
+# otherwise any page could post messages with the cookies of a logged in user.
+def isSameOrigin(scope):
+    headers = dict(scope.get('headers', []))
+    origin = headers.get(b'origin')
+    if origin is None:
+        return True
+    return urlsplit(origin.decode('latin-1')).netloc == headers.get(b'host', b'').decode('latin-1')
+
+
+# Forwards the deltas published on the room channel to the browser.
+async def forwardDeltas(subscription, send):
+    while True:
+        data = await subscription.get()
+        await send({'type' : 'websocket.send', 'text' : json.dumps(data)})
+
+
+async def roomChat(scope, receive, send, pk):
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+    if not isSameOrigin(scope):
+        await send({'type' : 'websocket.close', 'code' : CLOSE_FORBIDDEN})
+        return
+    room = await getRoom(pk)
+    if room is None:
+        await send({'type' : 'websocket.close', 'code' : CLOSE_NOT_FOUND})
+        return
+    user = await getUser(scope)
+
+    # Subscribes before accepting, so no message posted right after the handshake is missed.
+    subscription = get_broker().subscribe(room_channel(room.id))
+    await send({'type' : 'websocket.accept'})
+    forward = asyncio.create_task(forwardDeltas(subscription, send))
+    try:
+        while True:
+            event = await receive()
+            if event['type'] == 'websocket.disconnect':
+                break
+            if event['type'] != 'websocket.receive':
+                continue
+            # Anonymous visitors can read along, but only logged in users can post.
+            if not user.is_authenticated:
+                await send({'type' : 'websocket.send', 'text' : json.dumps({'type' : 'error', 'error' : 'login required'})})
+                continue
+            try:
+                body = str(json.loads(event.get('text') or '{}').get('body', '')).strip()
+            except (ValueError, AttributeError):
+                body = ''
+            if body:
+                try:
+                    await postMessage(room, user, body)
+                except IngestQueueFull:
+                    await send({'type' : 'websocket.send', 'text' : json.dumps({'type' : 'error', 'error' : 'too many messages, try again'})})
+    finally:
+        forward.cancel()
+        subscription.close()
+
+
+# Wraps the Django ASGI application: WebSocket connections go to the room chat, everything else to Django.
+def websocketRouter(http_application):
+    async def application(scope, receive, send):
+        if scope['type'] != 'websocket':
+            return await http_application(scope, receive, send)
+        match = ROOM_PATH.match(scope['path'])
+        if match:
+            return await roomChat(scope, receive, send, int(match['pk']))
+        await receive()
+        await send({'type' : 'websocket.close', 'code' : CLOSE_NOT_FOUND})
+    return application
@@ -0,0 +1,17 @@
+from django.conf import settings
+from .cache import topics_version
+from .trending import trending_topics
+
+
+# Values used by the {% cache %} tags of the templates (see cache.py).
+# topics_version is passed as a function, so the template only looks it up when a fragment needs it.
+def fragment_cache(request):
+    return {
+        'fragment_cache_timeout' : getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 60),
+        'topics_version' : topics_version,
+    }
+
+
+# The trending topics of the topic sidebar (see trending.py), also passed as a function.
+def trending(request):
+    return {'trending_topics' : trending_topics}
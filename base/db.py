@@ -0,0 +1,18 @@
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Database connection setup.
+# SQLite settings that are not connection parameters are set with PRAGMA statements, on every new connection.
+# They are listed in the 'PRAGMAS' entry of the database in settings.DATABASES.
+
+
+@receiver(connection_created)
+def applyPragmas(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = connection.settings_dict.get('PRAGMAS', {})
+    if not pragmas:
+        return
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
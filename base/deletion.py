@@ -0,0 +1,186 @@
+import logging
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from .models import Room, Topic, Message, ArchivedMessage, ActivityEvent
+from . import search, timeline
+from .cache import bump_topics_version
+
+# Bulk deletion of rooms and users.
+# room.delete() and user.delete() let Django's collector load every message and participant row into memory first,
+# to send their delete signals, and then delete everything in one long transaction. For a busy room this takes seconds,
+# and SQLite is locked for writes the whole time.
+#
+# Here the rows are deleted in batches of plain DELETEs instead, each batch in its own short transaction, and the work
+# of the signal handlers (counters, search index, cached pages) is done once per batch.
+# Every deletion of a room or a user in this project goes through here: the room views and the admin (admin.py, also
+# its delete views and "Delete selected"). A plain room.delete() or user.delete() (the shell, another app) still
+# works, through the slow path of the collector.
+# A deleted room is hidden right away (Room.objects leaves it out, see models.py), so the request returns at once,
+# and its rows are removed by a background thread. The purge_deleted_rooms command finishes the rooms whose cleanup
+# was interrupted (the process stopped before the thread was done).
+#
+# Settings (settings.ROOM_DELETION, all optional):
+#   BACKGROUND  removes the rows of a deleted room in a background thread. When False, the request removes them itself.
+#   BATCH_SIZE  number of rows deleted per transaction.
+#   PAUSE       seconds to wait between two batches, so other writers get the database lock.
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BACKGROUND' : True,
+    'BATCH_SIZE' : 1000,
+    'PAUSE' : 0.01,
+}
+
+
+def get_settings():
+    return {**DEFAULTS, **getattr(settings, 'ROOM_DELETION', {})}
+
+
+# Deletes the rows of queryset, batch_size at a time, each batch in its own transaction.
+# on_batch(rows) is called inside the transaction with the deleted rows (dicts with the `fields` values),
+# to do what the signals would have done. Returns the number of deleted rows.
+def delete_in_batches(queryset, fields=(), on_batch=None, batch_size=None, pause=None, using='default'):
+    options = get_settings()
+    batch_size = batch_size or options['BATCH_SIZE']
+    pause = options['PAUSE'] if pause is None else pause
+    queryset = queryset.using(using).order_by()
+    deleted = 0
+    while True:
+        with transaction.atomic(using=using):
+            rows = list(queryset.values('id', *fields)[:batch_size])
+            if not rows:
+                return deleted
+            # A plain DELETE, without loading the rows or sending the delete signals.
+            queryset.model.objects.using(using).filter(id__in=[row['id'] for row in rows])._raw_delete(using)
+            if on_batch:
+                on_batch(rows)
+        deleted += len(rows)
+        if len(rows) < batch_size:
+            return deleted
+        time.sleep(pause)
+
+
+# Lowers a counter of the rooms by the number of rows of each room (rows with a room_id key).
+def uncount(rows, field, using):
+    from .signals import changeCount
+
+    for room_id, count in Counter(row['room_id'] for row in rows).items():
+        changeCount(Room.all_objects.using(using).filter(id=room_id), field, -count)
+
+
+# Hides a room: from now on it is not shown anywhere, its rows are removed later by purge_room.
+# Does right away what the delete signals of the room would do: topic counter, search index, caches.
+def hide_room(room, using='default'):
+    from .signals import changeCount, countSuggestedTopic, invalidateRoomPages
+
+    with transaction.atomic(using=using):
+        if not Room.objects.using(using).filter(id=room.id).update(hidden=True):
+            return False # already hidden (or deleted)
+        if room.topic_id:
+            changeCount(Topic.objects.using(using).filter(id=room.topic_id), 'room_count', -1)
+            countSuggestedTopic(room.topic_id, -1, using)
+        search.remove_room(room.id, using=using)
+        timeline.remove_room_events(room.id, using=using)
+        transaction.on_commit(bump_topics_version, using=using)
+        transaction.on_commit(lambda: invalidateRoomPages([room.id]), using=using)
+    room.hidden = True
+    return True
+
+
+# Removes the messages, archived messages and participant rows of a hidden room in batches, then the room itself.
+def purge_room(pk, batch_size=None, pause=None, using='default'):
+    options = {'batch_size' : batch_size, 'pause' : pause, 'using' : using}
+    Participant = Room.participants.through
+    delete_in_batches(Message.objects.filter(room_id=pk),
+                      on_batch=lambda rows: search.remove_messages([row['id'] for row in rows], using=using), **options)
+    delete_in_batches(ArchivedMessage.objects.filter(room_id=pk), **options)
+    # Events of messages written while the room was being hidden.
+    delete_in_batches(ActivityEvent.objects.filter(room_id=pk), **options)
+    delete_in_batches(Participant.objects.filter(room_id=pk), **options)
+    # Nothing refers to the room any more, so this is a single-row DELETE.
+    Room.all_objects.using(using).filter(id=pk, hidden=True)._raw_delete(using)
+
+
+# Purges the hidden rooms one after the other, so there is only one thread deleting rows.
+def purgeInThread(pks, using):
+    close_old_connections()
+    try:
+        for pk in pks:
+            try:
+                purge_room(pk, using=using)
+            except Exception:
+                # The room stays hidden, the purge_deleted_rooms command will finish it.
+                logger.exception('Could not remove the rows of the deleted room %s', pk)
+    finally:
+        close_old_connections()
+
+
+def purge_rooms(pks, using='default'):
+    if not pks:
+        return
+    if get_settings()['BACKGROUND']:
+        start = lambda: threading.Thread(target=purgeInThread, args=(pks, using), name='room-purge', daemon=True).start()
+        transaction.on_commit(start, using=using)
+    else:
+        for pk in pks:
+            purge_room(pk, using=using)
+
+
+# Deletes a room: hides it, then removes its rows in a background thread once the transaction is committed
+# (or right away when ROOM_DELETION['BACKGROUND'] is off).
+def delete_room(room, using='default'):
+    if hide_room(room, using=using):
+        purge_rooms([room.id], using=using)
+
+
+# Deletes the rooms of a queryset (the admin action), the same way. Only their id and topic are read.
+# Returns the number of rooms deleted.
+def delete_rooms(queryset, using='default'):
+    rooms = queryset.using(using).select_related(None).order_by().only('id', 'topic_id')
+    pks = [room.id for room in rooms.iterator() if hide_room(room, using=using)]
+    purge_rooms(pks, using=using)
+    return len(pks)
+
+
+# What the delete signals of messages do, for a batch of deleted rows (with their room_id).
+def messagesDeleted(rows, using):
+    from .signals import invalidateRoomPages
+
+    uncount(rows, 'message_count', using)
+    search.remove_messages([row['id'] for row in rows], using=using)
+    timeline.remove_events([row['id'] for row in rows], using=using)
+    room_ids = {row['room_id'] for row in rows}
+    transaction.on_commit(lambda: invalidateRoomPages(room_ids), using=using)
+
+
+# Deletes the messages of a queryset (the admin action) in batches. Returns the number of messages deleted.
+def delete_messages(queryset, batch_size=None, pause=None, using='default'):
+    return delete_in_batches(queryset, ['room_id'], lambda rows: messagesDeleted(rows, using),
+                             batch_size=batch_size, pause=pause, using=using)
+
+
+# Deletes a user: their messages, archived messages and participant rows in batches (with the room counters lowered
+# batch by batch), then the user. Their rooms are kept without a host (SET_NULL), like user.delete() does.
+def delete_user(user, batch_size=None, pause=None, using='default'):
+    from .signals import invalidateRoomPages
+
+    options = {'batch_size' : batch_size, 'pause' : pause, 'using' : using}
+    Participant = Room.participants.through
+
+    def participantsDeleted(rows):
+        uncount(rows, 'participant_count', using)
+        room_ids = {row['room_id'] for row in rows}
+        transaction.on_commit(lambda: invalidateRoomPages(room_ids), using=using)
+
+    delete_messages(Message.objects.filter(user_id=user.id), **options)
+    delete_in_batches(ArchivedMessage.objects.filter(user_id=user.id), ['room_id'],
+                      lambda rows: uncount(rows, 'message_count', using), **options)
+    delete_in_batches(Participant.objects.filter(user_id=user.id), ['room_id'], participantsDeleted, **options)
+    # Only the hosted rooms (one UPDATE) and rows of other apps (sessions, permissions...) are left for the collector.
+    hosted = list(Room.all_objects.using(using).filter(host_id=user.id).values_list('id', flat=True))
+    user.delete(using=using)
+    invalidateRoomPages(hosted)
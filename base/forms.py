@@ -1,5 +1,7 @@
+from django import forms
 from django.forms import ModelForm
 from .models import Room
+from . import avatars
 
 # Model form for room class. 
 # Creates a form (RoomForm) based on the Room model. 
@@ -8,4 +10,16 @@ class RoomForm(ModelForm):
     class Meta:
         model = Room
         fields = '__all__'
-        exclude = ['host', 'participants']
\ No newline at end of file
+        exclude = ['host', 'participants']
+
+# Upload form of the avatar (updateUser view). The image itself is checked when the thumbnails are made (avatars.py).
+class AvatarForm(forms.Form):
+    avatar = forms.FileField()
+
+    def clean_avatar(self):
+        upload = self.cleaned_data['avatar']
+        if avatars.Image is None:
+            raise forms.ValidationError('Avatar uploads are not available on this server.')
+        if upload.size > avatars.get_settings()['MAX_BYTES']:
+            raise forms.ValidationError('The image is too large.')
+        return upload
@@ -0,0 +1,237 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, transaction
+from .models import Room, Message
+from . import search, realtime, timeline, trending
+
+# Batched message ingestion.
+# Normally every message posted in a room is written right away: an INSERT for the message, then a SELECT + INSERT for
+# the participant, each in its own transaction. Under bursty traffic SQLite handles one writer at a time, so the
+# requests queue up on the database lock.
+#
+# With settings.MESSAGE_INGEST['ENABLED'] the messages are put in an in-memory queue instead, and a background thread
+# writes them in batches: one bulk_create for the messages, one SELECT + bulk_create for the participants that are
+# really new, and one UPDATE per room for the counters. The search index and the real-time deltas are updated for the
+# whole batch too, because bulk_create does not send the signals that normally do that (signals.py).
+#
+# Settings (all optional):
+#   BATCH_SIZE     maximum number of messages written in one transaction.
+#   MAX_LATENCY    seconds a message may wait in the queue before its batch is written, even if the batch is not full.
+#   MAX_QUEUE      maximum number of waiting messages. When the queue is full, new messages are refused (back-pressure).
+#   BLOCK_TIMEOUT  seconds a request waits for room in a full queue before the message is refused.
+#   RETRIES        times a message is put back in the queue when the database could not write it (locked, ...).
+#   BACKGROUND     False to write the queue only when flush() is called, without the background thread (tests).
+#
+# A batch that fails is written again one message at a time, so one bad message does not lose the others of its batch.
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED' : False,
+    'BATCH_SIZE' : 200,
+    'MAX_LATENCY' : 0.05,
+    'MAX_QUEUE' : 10000,
+    'BLOCK_TIMEOUT' : 1.0,
+    'RETRIES' : 3,
+    'BACKGROUND' : True,
+}
+
+
+# Raised when the queue stays full for longer than BLOCK_TIMEOUT.
+class IngestQueueFull(Exception):
+    pass
+
+
+def get_settings():
+    return {**DEFAULTS, **getattr(settings, 'MESSAGE_INGEST', {})}
+
+
+# Writes a batch of unsaved Message objects, and does the work of the signal handlers for all of them at once.
+def write_batch(messages, using='default'):
+    from .signals import changeCount, invalidateRoomPages
+
+    rooms = Room.objects.using(using)
+    Participant = Room.participants.through
+    with transaction.atomic(using=using):
+        messages = Message.objects.using(using).bulk_create(messages)
+
+        # Participants: the same user posting many times in a room is one row, and rows that already exist are skipped.
+        pairs = {(message.room_id, message.user_id) for message in messages}
+        existing = set(
+            Participant.objects.using(using)
+            .filter(room_id__in={room_id for room_id, _ in pairs}, user_id__in={user_id for _, user_id in pairs})
+            .values_list('room_id', 'user_id')
+        )
+        new_pairs = pairs - existing
+        Participant.objects.using(using).bulk_create(
+            [Participant(room_id=room_id, user_id=user_id) for room_id, user_id in new_pairs], ignore_conflicts=True
+        )
+
+        # Counters, one UPDATE per room.
+        posted = Counter(message.room_id for message in messages)
+        joined = Counter(room_id for room_id, _ in new_pairs)
+        for room_id, count in posted.items():
+            changeCount(rooms.filter(id=room_id), 'message_count', count)
+        for room_id, count in joined.items():
+            changeCount(rooms.filter(id=room_id), 'participant_count', count)
+
+        # Trending scores, one UPDATE per room and topic.
+        for room_id, count in posted.items():
+            trending.record(room_id, messages=count, participants=joined[room_id], using=using)
+
+        backend = search.get_backend(using)
+        if backend:
+            backend.add_many(search.MESSAGE, [
+                (message.id, message.room_id, search.message_document(message)) for message in messages
+            ])
+
+        timeline.add_events(messages, using=using)
+
+        transaction.on_commit(lambda: publishDeltas(messages), using=using)
+        transaction.on_commit(lambda: invalidateRoomPages({message.room_id for message in messages}), using=using)
+    return messages
+
+
+# The deltas are only built for the rooms somebody watches (realtime.publish_to_room).
+def publishDeltas(messages):
+    for message in messages:
+        realtime.publish_to_room(message.room_id, lambda: realtime.message_delta(message))
+
+
+class MessageIngestor:
+    def __init__(self, batch_size, max_latency, max_queue, block_timeout, retries=3, background=True, using='default'):
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.block_timeout = block_timeout
+        self.retries = retries
+        self.background = background
+        self.using = using
+        self.queue = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.worker = None
+
+    # Puts a message in the queue. Waits up to block_timeout when the queue is full, then raises IngestQueueFull.
+    def submit(self, room, user, body):
+        self.start()
+        try:
+            self.queue.put(Message(room=room, user=user, body=body), timeout=self.block_timeout)
+        except queue.Full:
+            raise IngestQueueFull()
+
+    # Starts the background thread the first time a message is submitted.
+    def start(self):
+        if not self.background:
+            return
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name='message-ingest', daemon=True)
+                self.worker.start()
+
+    # Takes the next batch from the queue: waits for a first message, then for more until the batch is full
+    # or the first message has waited max_latency seconds.
+    def next_batch(self, timeout=None):
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                self.write(batch)
+            except Exception:
+                # The thread keeps running for the next batches.
+                logger.exception('Could not write a batch of %d messages', len(batch))
+
+    # Writes everything that is in the queue right now. Used at exit, and by the tests and benchmark.
+    def flush(self):
+        written = 0
+        while True:
+            batch = self.next_batch(timeout=0.001)
+            if not batch:
+                return written
+            self.write(batch)
+            written += len(batch)
+
+    def write(self, batch):
+        close_old_connections()
+        try:
+            try:
+                write_batch(batch, using=self.using)
+            except Exception:
+                logger.exception('Could not write a batch of %d messages, writing them one at a time', len(batch))
+                self.write_each(batch)
+        finally:
+            close_old_connections()
+            for _ in batch:
+                self.queue.task_done()
+
+    # Writes the messages of a failed batch one by one. A message the database could not write right now goes back in
+    # the queue for a later batch, up to `retries` times. A message that can not be written at all is logged with its content.
+    def write_each(self, batch):
+        for message in batch:
+            # The failed bulk_create may have set the id of the message before its transaction was rolled back.
+            message.pk = None
+            try:
+                write_batch([message], using=self.using)
+            except OperationalError:
+                self.retry(message)
+            except Exception:
+                logger.exception('Lost the message of user %s in room %s: %r', message.user_id, message.room_id, message.body)
+
+    def retry(self, message):
+        message._ingest_attempts = getattr(message, '_ingest_attempts', 0) + 1
+        try:
+            if message._ingest_attempts > self.retries:
+                raise queue.Full()
+            self.queue.put_nowait(message)
+        except queue.Full:
+            logger.exception('Lost the message of user %s in room %s: %r', message.user_id, message.room_id, message.body)
+
+    # Waits until every submitted message is written by the background thread.
+    def join(self):
+        self.queue.join()
+
+
+_ingestor = None
+_ingestor_lock = threading.Lock()
+
+
+# Returns the ingestor of this process, created from settings.MESSAGE_INGEST the first time.
+def get_ingestor():
+    global _ingestor
+    with _ingestor_lock:
+        if _ingestor is None:
+            options = get_settings()
+            _ingestor = MessageIngestor(
+                options['BATCH_SIZE'], options['MAX_LATENCY'], options['MAX_QUEUE'], options['BLOCK_TIMEOUT'],
+                options['RETRIES'], options['BACKGROUND'],
+            )
+            # Messages still in the queue when the process stops are written before it exits.
+            atexit.register(_ingestor.flush)
+    return _ingestor
+
+
+# Posts a message in a room: queued for the next batch when ingestion is enabled, written right away otherwise.
+# Raises IngestQueueFull when the queue is full.
+def submit_message(room, user, body):
+    if get_settings()['ENABLED']:
+        get_ingestor().submit(room, user, body)
+    else:
+        room.post_message(user, body)
@@ -0,0 +1,282 @@
+import json
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.template.base import Template
+
+# Request instrumentation, used by InstrumentationMiddleware (middleware.py).
+# For a sampled request it records:
+#   - the wall time of the whole request,
+#   - every database query (with connection.execute_wrapper on every connection), its SQL, parameters and duration,
+#   - the time spent rendering templates (the outermost Template.render, queries run by the template included),
+#   - the hits and misses of the page cache and the fragment cache (cache.py calls record_cache).
+# The queries are then checked for two patterns:
+#   - duplicates: the same SQL with the same parameters, run several times (the result could have been reused).
+#   - N+1: the same SQL with different parameters, run many times (usually a related object fetched in a loop,
+#     which select_related/prefetch_related would fetch in one query).
+# Problems are logged as JSON lines on the "base.instrumentation" logger, and the timings are sent to the browser in
+# a Server-Timing header (visible in the network tab of the developer tools).
+#
+# Every request, sampled or not, is added to in-memory histograms (per view), exposed by the metrics view.
+# Only a fraction of the requests (SAMPLE_RATE) is profiled, the others only cost two perf_counter() calls,
+# so the middleware can stay on in production.
+#
+# Settings (settings.INSTRUMENTATION, all optional):
+#   ENABLED               turns the middleware on and off.
+#   SAMPLE_RATE           fraction of the requests that is profiled, from 0 to 1.
+#   SERVER_TIMING         adds the Server-Timing header to profiled responses (it tells visitors how the server works,
+#                         so it is only on in development by default).
+#   DUPLICATE_THRESHOLD   number of identical queries reported as duplicates.
+#   N_PLUS_ONE_THRESHOLD  number of queries with the same SQL (and different parameters) reported as N+1.
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED' : True,
+    'SAMPLE_RATE' : 1.0,
+    'SERVER_TIMING' : False,
+    'DUPLICATE_THRESHOLD' : 2,
+    'N_PLUS_ONE_THRESHOLD' : 5,
+}
+
+
+def get_settings():
+    return {**DEFAULTS, **getattr(settings, 'INSTRUMENTATION', {})}
+
+
+# The profile of the request running in this thread (or task), None when it is not sampled.
+_profile = ContextVar('profile', default=None)
+
+# "IN (%s, %s, %s)" becomes "IN (%s...)", so the same query with lists of different lengths is one pattern.
+PLACEHOLDER_LIST = re.compile(r'\(\s*%s(?:\s*,\s*%s)+\s*\)')
+
+
+def normalize_sql(sql):
+    return PLACEHOLDER_LIST.sub('(%s...)', sql)
+
+
+class Profile:
+    def __init__(self):
+        self.queries = [] # (sql, parameters, seconds)
+        self.template_seconds = 0.0
+        self.template_depth = 0
+        self.cache = Counter() # (cache name, 'hits' or 'misses') -> number
+
+    # connection.execute_wrapper: times every query of the request.
+    def execute(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, repr(params), time.perf_counter() - start))
+
+    def db_seconds(self):
+        return sum(seconds for _, _, seconds in self.queries)
+
+    # Returns {'duplicates' : [...], 'n_plus_one' : [...]}, each entry with the SQL and the number of times it ran.
+    def problems(self, duplicate_threshold, n_plus_one_threshold):
+        identical = Counter((sql, params) for sql, params, _ in self.queries)
+        patterns = Counter(normalize_sql(sql) for sql, _ in identical)
+        runs = Counter()
+        for (sql, _), count in identical.items():
+            runs[normalize_sql(sql)] += count
+        return {
+            'duplicates' : [
+                {'sql' : sql, 'count' : count} for (sql, _), count in identical.items() if count >= duplicate_threshold
+            ],
+            'n_plus_one' : [
+                {'sql' : sql, 'count' : runs[sql]}
+                for sql, variants in patterns.items() if variants > 1 and runs[sql] >= n_plus_one_threshold
+            ],
+        }
+
+    # The Server-Timing header: https://developer.mozilla.org/docs/Web/HTTP/Headers/Server-Timing
+    def server_timing(self, total_seconds):
+        entries = [
+            f'total;dur={total_seconds * 1000:.1f}',
+            f'db;dur={self.db_seconds() * 1000:.1f};desc="{len(self.queries)} queries"',
+            f'tpl;dur={self.template_seconds * 1000:.1f};desc="templates"',
+        ]
+        for name in sorted({name for name, _ in self.cache}):
+            entries.append(f'cache-{name};desc="{self.cache[name, "hits"]} hits {self.cache[name, "misses"]} misses"')
+        return ', '.join(entries)
+
+
+# Profiles the code inside the with block: queries, templates and caches.
+# The profile is kept in a context variable, which is copied to the threads that run the sync code of async
+# requests (sync_to_async), so the queries of a request are recorded whatever thread runs them.
+@contextmanager
+def profile():
+    install()
+    current = Profile()
+    token = _profile.set(current)
+    try:
+        yield current
+    finally:
+        _profile.reset(token)
+
+
+# connection.execute_wrapper of every database connection: hands the query to the profile of the request, if there is one.
+def recordQuery(execute, sql, params, many, context):
+    current = _profile.get()
+    if current is None:
+        return execute(sql, params, many, context)
+    return current.execute(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def wrapConnection(sender, connection, **kwargs):
+    if recordQuery not in connection.execute_wrappers:
+        connection.execute_wrappers.append(recordQuery)
+
+
+# Called by the caches in cache.py for every lookup.
+def record_cache(name, hit):
+    current = _profile.get()
+    if current is not None:
+        current.cache[name, 'hits' if hit else 'misses'] += 1
+
+
+_render = Template.render
+_installed = False
+
+
+# Template.render is wrapped once, to time the rendering of profiled requests. Includes and {% extends %} render
+# templates inside templates, only the outermost one is timed.
+def timedRender(self, context):
+    current = _profile.get()
+    if current is None:
+        return _render(self, context)
+    current.template_depth += 1
+    start = time.perf_counter()
+    try:
+        return _render(self, context)
+    finally:
+        current.template_depth -= 1
+        if current.template_depth == 0:
+            current.template_seconds += time.perf_counter() - start
+
+
+# Wraps Template.render, and the connections that were opened before the first request (new ones are wrapped by
+# wrapConnection). Called by the middleware when it starts.
+def install():
+    global _installed
+    if not _installed:
+        Template.render = timedRender
+        _installed = True
+    for connection in connections.all(initialized_only=True):
+        wrapConnection(None, connection)
+
+
+# Histograms in the Prometheus format: the number of observations under each bucket bound, their sum and count.
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# name -> (help text, bucket bounds).
+METRICS = {
+    'request_seconds' : ('Wall time of the requests.', [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]),
+    'db_queries' : ('Database queries per profiled request.', [0, 1, 2, 5, 10, 20, 50, 100, 200]),
+    'db_seconds' : ('Database time of the profiled requests.', [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1]),
+    'template_seconds' : ('Template render time of the profiled requests.', [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1]),
+}
+
+_histograms = {} # (metric, view) -> Histogram
+_problems = Counter() # (view, kind) -> number of profiled requests with that problem
+_lock = threading.Lock()
+
+
+def observe(metric, view, value):
+    with _lock:
+        histogram = _histograms.get((metric, view))
+        if histogram is None:
+            histogram = _histograms[metric, view] = Histogram(METRICS[metric][1])
+        histogram.observe(value)
+
+
+# Called by the middleware at the end of every request. current is the Profile, or None if the request was not sampled.
+def finish(request, current, seconds, response):
+    match = getattr(request, 'resolver_match', None)
+    # The url name keeps the number of histograms small (one per page), whatever the urls requested.
+    view = (match.url_name or match.view_name) if match else 'unresolved'
+    observe('request_seconds', view, seconds)
+    if current is None:
+        return
+
+    observe('db_queries', view, len(current.queries))
+    observe('db_seconds', view, current.db_seconds())
+    observe('template_seconds', view, current.template_seconds)
+
+    options = get_settings()
+    problems = current.problems(options['DUPLICATE_THRESHOLD'], options['N_PLUS_ONE_THRESHOLD'])
+    for kind, found in problems.items():
+        if found:
+            with _lock:
+                _problems[view, kind] += 1
+    line = {
+        'event' : 'request_profile',
+        'view' : view,
+        'path' : request.path,
+        'status' : response.status_code,
+        'total_ms' : round(seconds * 1000, 2),
+        'db_ms' : round(current.db_seconds() * 1000, 2),
+        'queries' : len(current.queries),
+        'template_ms' : round(current.template_seconds * 1000, 2),
+        'cache' : {f'{name}_{result}' : count for (name, result), count in current.cache.items()},
+    }
+    if problems['duplicates'] or problems['n_plus_one']:
+        logger.warning(json.dumps({**line, 'event' : 'query_problems', **problems}))
+    else:
+        logger.debug(json.dumps(line))
+    if options['SERVER_TIMING']:
+        response['Server-Timing'] = current.server_timing(seconds)
+
+
+# The histograms and problem counters, as lines of the Prometheus text format.
+def prometheus_lines():
+    with _lock:
+        histograms = {key : (list(histogram.counts), histogram.sum, histogram.count) for key, histogram in _histograms.items()}
+        problems = dict(_problems)
+    lines = []
+    for metric, (help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP studybuddy_{metric} {help_text}')
+        lines.append(f'# TYPE studybuddy_{metric} histogram')
+        for (name, view), (counts, total, count) in sorted(histograms.items()):
+            if name != metric:
+                continue
+            cumulative = 0
+            for bound, number in zip([*buckets, '+Inf'], counts):
+                cumulative += number
+                lines.append(f'studybuddy_{metric}_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+            lines.append(f'studybuddy_{metric}_sum{{view="{view}"}} {total}')
+            lines.append(f'studybuddy_{metric}_count{{view="{view}"}} {count}')
+    lines.append('# HELP studybuddy_query_problems_total Profiled requests with duplicate or N+1 queries.')
+    lines.append('# TYPE studybuddy_query_problems_total counter')
+    for (view, kind), count in sorted(problems.items()):
+        lines.append(f'studybuddy_query_problems_total{{view="{view}",kind="{kind}"}} {count}')
+    return lines
+
+
+# Empties the histograms (used by the tests).
+def reset():
+    with _lock:
+        _histograms.clear()
+        _problems.clear()
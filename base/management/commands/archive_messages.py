@@ -0,0 +1,41 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from base import archive
+from base.models import Message
+
+
+# Usage: python manage.py archive_messages [--days 90] [--batch-size 1000] [--pause 0.05] [--max-batches N] [--dry-run]
+# Moves the messages older than --days from the Message table to the archive (see archive.py), one small transaction
+# per batch, so it can run while the site is up. Meant to run regularly (cron), --max-batches bounds the work of a run.
+# The defaults come from settings.MESSAGE_RETENTION.
+class Command(BaseCommand):
+    help = 'Moves old messages to the archive table, in small batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='Database to archive the messages of.')
+        parser.add_argument('--days', type=int, help='Archive the messages created more than this many days ago.')
+        parser.add_argument('--batch-size', type=int, help='Number of messages moved per transaction.')
+        parser.add_argument('--pause', type=float, help='Seconds to wait between two batches.')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches (the next run continues).')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the messages that would be archived.')
+
+    def handle(self, *args, **options):
+        if options['days'] is not None and options['days'] < 0:
+            raise CommandError('--days cannot be negative.')
+        using = options['database']
+        before = archive.cutoff(options['days'])
+        if options['dry_run']:
+            count = Message.objects.using(using).filter(created__lt=before).count()
+            self.stdout.write(f'{count} messages created before {before:%Y-%m-%d %H:%M} would be archived.')
+            return
+
+        start = time.perf_counter()
+        moved = batches = 0
+        for count in archive.archive(before, options['batch_size'], options['pause'], options['max_batches'], using):
+            moved += count
+            batches += 1
+            self.stdout.write(f'Batch {batches}: {count} messages archived.')
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {moved} messages created before {before:%Y-%m-%d %H:%M} in {batches} batches, '
+            f'{time.perf_counter() - start:.1f}s.'
+        ))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from base import timeline
+
+
+# Usage: python manage.py backfill_activity
+# Empties the activity timelines (see base/timeline.py) and fills them again from the Message table,
+# up to the caps of settings.ACTIVITY_TIMELINE. Needed after messages were written without signals
+# (generate_dataset, raw SQL, loaddata...) or after the caps were changed.
+class Command(BaseCommand):
+    help = 'Rebuilds the activity timelines of the site and of every user from the messages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='Database to rebuild the timelines of.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Number of rows read and written at a time.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic(using=options['database']):
+            count = timeline.backfill(using=options['database'], chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Wrote {count} activity events.'))
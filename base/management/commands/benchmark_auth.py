@@ -0,0 +1,63 @@
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from base.models import Room
+
+# (label, session engine, authentication backend) of the configurations that are compared.
+CONFIGURATIONS = [
+    ('db sessions', 'django.contrib.sessions.backends.db', 'django.contrib.auth.backends.ModelBackend'),
+    ('cached_db sessions', 'django.contrib.sessions.backends.cached_db', 'django.contrib.auth.backends.ModelBackend'),
+    ('cached_db + cached user', 'django.contrib.sessions.backends.cached_db', 'base.auth.CachedModelBackend'),
+    ('signed cookies + cached user', 'django.contrib.sessions.backends.signed_cookies', 'base.auth.CachedModelBackend'),
+]
+
+
+# Usage: python manage.py benchmark_auth [--requests 50]
+# Requests a few pages as a logged in user with every session engine / authentication backend of CONFIGURATIONS,
+# and prints the database queries per request: all of them, and those on the session and user tables.
+# Like benchmark_pages, it needs a database with rooms (generate_dataset). Only GET requests are sent,
+# but every configuration logs the host of the busiest room in, which adds a session row with the db engines.
+class Command(BaseCommand):
+    help = 'Compares the session and user queries per authenticated request of the session engines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help='Number of requests per page and configuration.')
+        parser.add_argument('--host', help='Host header of the requests (default: the first of ALLOWED_HOSTS, or localhost).')
+
+    def handle(self, *args, **options):
+        room = Room.objects.order_by('-message_count', '-id').first()
+        if room is None or room.host is None:
+            raise CommandError('The database has no rooms with a host, run generate_dataset first.')
+        host = options['host'] or next(
+            (name for name in settings.ALLOWED_HOSTS if name != '*' and not name.startswith('.')), 'localhost'
+        )
+        paths = [reverse('home'), reverse('room', args=[room.id]), reverse('create-room')]
+
+        self.stdout.write(f"{'configuration':<30} {'queries':>8} {'session':>8} {'user':>8} {'ms':>8}")
+        for label, engine, backend in CONFIGURATIONS:
+            with override_settings(SESSION_ENGINE=engine, AUTHENTICATION_BACKENDS=[backend]):
+                caches['sessions'].clear()
+                client = Client(HTTP_HOST=host)
+                client.force_login(room.host, backend=backend)
+                for path in paths:
+                    client.get(path) # warm-up: the first request fills the caches.
+                queries = session = user = 0
+                start = time.perf_counter()
+                for _ in range(options['requests']):
+                    for path in paths:
+                        with CaptureQueriesContext(connection) as captured:
+                            if client.get(path).status_code != 200:
+                                raise CommandError(f'{path} did not answer 200 with {label}.')
+                        queries += len(captured)
+                        session += sum('django_session' in query['sql'] for query in captured)
+                        user += sum('FROM "auth_user" WHERE "auth_user"."id" =' in query['sql'] for query in captured)
+                seconds = time.perf_counter() - start
+            count = options['requests'] * len(paths)
+            self.stdout.write(
+                f'{label:<30} {queries / count:>8.2f} {session / count:>8.2f} {user / count:>8.2f} {seconds / count * 1000:>8.2f}'
+            )
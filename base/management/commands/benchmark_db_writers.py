@@ -0,0 +1,109 @@
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections, transaction
+
+
+# Usage: python manage.py benchmark_db_writers [--threads 8] [--writes 500] [--readers 2]
+# Concurrency benchmark of the database settings. Every writer thread does transactions that look like posting a
+# message (INSERT a message row + UPDATE a counter row), while reader threads keep reading, and the writes per second
+# and "database is locked" failures of each configuration are printed:
+#   sqlite-default  a SQLite file with the settings Django uses out of the box (rollback journal, 5s timeout, no pragmas).
+#   sqlite-tuned    a SQLite file with the settings of this project (WAL, synchronous=NORMAL, mmap, busy_timeout...).
+#   configured      the "default" database, when it is not SQLite (for example PostgreSQL with the connection pool).
+# The SQLite files are created in a temporary directory, the tables of the "configured" database are dropped at the end.
+class Command(BaseCommand):
+    help = 'Benchmarks concurrent writer throughput of the database configurations.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help='Number of writer threads.')
+        parser.add_argument('--writes', type=int, default=500, help='Number of transactions per writer thread.')
+        parser.add_argument('--readers', type=int, default=2, help='Number of reader threads running during the writes.')
+
+    def handle(self, *args, **options):
+        default = settings.DATABASES['default']
+        with tempfile.TemporaryDirectory() as directory:
+            profiles = {
+                'sqlite-default' : {'ENGINE' : 'django.db.backends.sqlite3', 'NAME' : str(Path(directory) / 'default.sqlite3')},
+                'sqlite-tuned' : {
+                    'ENGINE' : 'django.db.backends.sqlite3',
+                    'NAME' : str(Path(directory) / 'tuned.sqlite3'),
+                    'OPTIONS' : dict(default.get('OPTIONS', {})) if default['ENGINE'].endswith('sqlite3') else {'timeout' : 20},
+                    'PRAGMAS' : dict(default.get('PRAGMAS', {})) or {'journal_mode' : 'WAL', 'synchronous' : 'NORMAL', 'busy_timeout' : 20000},
+                },
+            }
+            if not default['ENGINE'].endswith('sqlite3'):
+                profiles['configured'] = default
+            for name, profile in profiles.items():
+                alias = f'benchmark-{name}'
+                connections.settings[alias] = connections.configure_settings({'default' : default, alias : profile})[alias]
+                try:
+                    self.report(name, options, *self.run(alias, options))
+                finally:
+                    connections[alias].close()
+                    del connections.settings[alias]
+
+    def run(self, alias, options):
+        with connections[alias].cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS benchmark_message')
+            cursor.execute('DROP TABLE IF EXISTS benchmark_counter')
+            cursor.execute('CREATE TABLE benchmark_message (id integer PRIMARY KEY, room_id integer, body text)')
+            cursor.execute('CREATE TABLE benchmark_counter (id integer PRIMARY KEY, message_count integer)')
+            cursor.execute('INSERT INTO benchmark_counter (id, message_count) VALUES (1, 0)')
+        connections[alias].close()
+
+        stop = threading.Event()
+
+        def writer(number):
+            failed = 0
+            try:
+                for i in range(options['writes']):
+                    try:
+                        with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+                            cursor.execute(
+                                'INSERT INTO benchmark_message (id, room_id, body) VALUES (%s, %s, %s)',
+                                [number * options['writes'] + i + 1, 1, f'message {i} of writer {number}'],
+                            )
+                            cursor.execute('UPDATE benchmark_counter SET message_count = message_count + 1 WHERE id = 1')
+                    except OperationalError:
+                        failed += 1
+            finally:
+                connections[alias].close()
+            return failed
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    try:
+                        with connections[alias].cursor() as cursor:
+                            cursor.execute('SELECT COUNT(*) FROM benchmark_message WHERE room_id = 1')
+                    except OperationalError:
+                        pass
+            finally:
+                connections[alias].close()
+
+        readers = [threading.Thread(target=reader) for _ in range(options['readers'])]
+        for thread in readers:
+            thread.start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options['threads']) as pool:
+            failed = sum(pool.map(writer, range(options['threads'])))
+        seconds = time.perf_counter() - start
+        stop.set()
+        for thread in readers:
+            thread.join()
+
+        with connections[alias].cursor() as cursor:
+            cursor.execute('DROP TABLE benchmark_message')
+            cursor.execute('DROP TABLE benchmark_counter')
+        return seconds, failed
+
+    def report(self, name, options, seconds, failed):
+        total = options['threads'] * options['writes']
+        self.stdout.write(
+            f'{name:>15}: {total - failed} writes in {seconds:.2f}s, {(total - failed) / seconds:.0f} writes/s, {failed} failed'
+        )
@@ -0,0 +1,70 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, close_old_connections
+from base.ingest import MessageIngestor, get_settings
+from base.deletion import delete_user
+from base.models import Room
+
+
+# Usage: python manage.py benchmark_ingest [--messages 5000] [--threads 8]
+# Posts the same messages through the direct path (Room.post_message, like the room view without ingestion)
+# and through the batched ingestion queue (base/ingest.py), and prints the messages per second of both.
+# A benchmark user and room are created for the run and deleted (with their messages) at the end.
+class Command(BaseCommand):
+    help = 'Load test: messages per second of direct writes against batched ingestion.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000, help='Number of messages posted per run.')
+        parser.add_argument('--threads', type=int, default=8, help='Number of concurrent posters (like request threads).')
+        parser.add_argument('--users', type=int, default=50, help='Number of different users posting.')
+
+    def handle(self, *args, **options):
+        users = [User.objects.create(username=f'benchmark-ingest-{i}') for i in range(options['users'])]
+        room = Room.objects.create(host=users[0], name='benchmark-ingest')
+        try:
+            direct = self.run(options, lambda user, body: room.post_message(user, body), users)
+            self.report('direct', options['messages'], direct)
+
+            ingest_settings = get_settings()
+            ingestor = MessageIngestor(
+                ingest_settings['BATCH_SIZE'], ingest_settings['MAX_LATENCY'],
+                ingest_settings['MAX_QUEUE'], ingest_settings['BLOCK_TIMEOUT'], ingest_settings['RETRIES'],
+            )
+
+            def post(user, body):
+                ingestor.submit(room, user, body)
+
+            batched = self.run(options, post, users, finish=ingestor.join)
+            self.report('batched', options['messages'], batched)
+        finally:
+            room.delete()
+            for user in users:
+                delete_user(user, pause=0)
+
+    # Posts the messages from a pool of threads.
+    # Returns the seconds it took until every message was written, and the number of posts that failed
+    # (on SQLite mostly "database is locked", when a writer waited too long for the lock).
+    def run(self, options, post, users, finish=None):
+        def worker(i):
+            try:
+                post(users[i % len(users)], f'benchmark message {i}')
+                return True
+            except OperationalError:
+                return False
+            finally:
+                close_old_connections()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options['threads']) as pool:
+            results = list(pool.map(worker, range(options['messages'])))
+        if finish:
+            finish()
+        return time.perf_counter() - start, results.count(False)
+
+    def report(self, name, messages, result):
+        seconds, failed = result
+        self.stdout.write(
+            f'{name:>8}: {messages - failed} messages in {seconds:.2f}s, {(messages - failed) / seconds:.0f} messages/s, {failed} failed'
+        )
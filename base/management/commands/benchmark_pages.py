@@ -0,0 +1,274 @@
+import asyncio
+import json
+import math
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlencode, urlsplit
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from base import urls
+from base.models import Room, Topic, Message
+
+DRIVERS = ['client', 'wsgi', 'asgi']
+
+
+# Nearest-rank percentile of a list of numbers.
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+
+# Usage: python manage.py benchmark_pages [--iterations 50] [--concurrency 8] [--driver client wsgi asgi]
+#                                         [--save-baseline FILE] [--compare FILE] [--cold]
+# Requests every page of base/urls.py and prints the p50/p95/p99 latency of each one, with three drivers:
+#   client  one request at a time through the test client. Also counts the queries and the memory allocated per request.
+#   wsgi    --concurrency threads calling the WSGI application, like a threaded WSGI server.
+#   asgi    --concurrency concurrent requests to the ASGI application (studybuddy/asgi.py) on one event loop.
+# Only GET requests are sent, so the database is not changed and runs can be repeated.
+# Run generate_dataset first, the pages are requested with its busiest room and most active host.
+#
+# --save-baseline writes the results to a JSON file, --compare reads such a file and fails (exit code 1) when a page
+# got slower by more than --threshold, or runs more queries than in the baseline.
+class Command(BaseCommand):
+    help = 'Benchmarks the latency, queries and memory of every page, and compares them with a baseline.'
+
+    # Pages that need a logged in user, and which user that is.
+    LOGIN = {'create-room' : 'host', 'update-room' : 'host', 'delete-room' : 'host', 'delete-message' : 'author', 'update-user' : 'host'}
+
+    # Differences under this many milliseconds are noise, not regressions.
+    NOISE_MS = 1.0
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50, help='Number of timed requests per page and driver.')
+        parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent requests of the wsgi and asgi drivers.')
+        parser.add_argument('--driver', nargs='+', choices=DRIVERS, default=DRIVERS, dest='drivers', help='Drivers to run.')
+        parser.add_argument('--cold', action='store_true', help='Clear the caches before every request.')
+        parser.add_argument('--host', help='Host header of the requests (default: the first of ALLOWED_HOSTS, or localhost).')
+        parser.add_argument('--save-baseline', metavar='FILE', help='Write the results to this JSON file.')
+        parser.add_argument('--compare', metavar='FILE', help='Compare the results with this baseline JSON file.')
+        parser.add_argument('--threshold', type=float, default=0.2, help='Allowed p95 slowdown against the baseline (0.2 = 20%%).')
+
+    def handle(self, *args, **options):
+        host = options['host'] or next(
+            (name for name in settings.ALLOWED_HOSTS if name != '*' and not name.startswith('.')), 'localhost'
+        )
+        cases = self.cases(host)
+        results = {}
+        for driver in options['drivers']:
+            for label, path, client in cases:
+                results[f'{driver}:{label}'] = getattr(self, f'run_{driver}')(path, client, host, options)
+        self.report(results)
+
+        baseline = {
+            'created' : datetime.now(timezone.utc).isoformat(),
+            'dataset' : self.dataset(),
+            'iterations' : options['iterations'],
+            'concurrency' : options['concurrency'],
+            'cold' : options['cold'],
+            'results' : results,
+        }
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as file:
+                json.dump(baseline, file, indent=2, sort_keys=True)
+            self.stdout.write(f"Baseline saved to {options['save_baseline']}")
+        if options['compare']:
+            with open(options['compare']) as file:
+                self.compare(json.load(file), baseline, options['threshold'])
+
+    def dataset(self):
+        return {'users' : User.objects.count(), 'topics' : Topic.objects.count(),
+                'rooms' : Room.objects.count(), 'messages' : Message.objects.count()}
+
+    # The pages to request: (label, path, client). The client is logged in for the pages that need a user.
+    def cases(self, host):
+        room = Room.objects.order_by('-message_count', '-id').first()
+        if room is None or room.host is None:
+            raise CommandError('The database has no rooms with a host, run generate_dataset first.')
+        message = Message.objects.filter(room=room).order_by('-id').first()
+        arguments = {
+            'room' : [room.id], 'room-messages' : [room.id], 'update-room' : [room.id], 'delete-room' : [room.id],
+            'user-profile' : [room.host_id], 'delete-message' : [message.id] if message else None,
+            'api-room' : [room.id], 'api-room-messages' : [room.id], 'api-room-participants' : [room.id],
+            'api-room-events' : [room.id], # since=0: answers right away with the oldest messages, never waits.
+        }
+        users = {'host' : room.host, 'author' : message.user if message else None}
+
+        clients = {None : Client(HTTP_HOST=host)}
+        for name, user in users.items():
+            if user:
+                clients[name] = Client(HTTP_HOST=host)
+                clients[name].force_login(user)
+
+        cases = []
+        for pattern in urls.urlpatterns:
+            name = pattern.name
+            args = arguments.get(name, [])
+            if args is None or (pattern.pattern.converters and not args):
+                self.stdout.write(f'Skipping {name}, no arguments known for it.')
+                continue
+            cases.append((name, reverse(name, args=args), clients[self.LOGIN.get(name)]))
+            # The home page is also requested with a search, which takes another path through the views.
+            if name == 'home':
+                word = (room.topic.name if room.topic else room.name).split()[0]
+                cases.append(('home search', f"{reverse(name)}?{urlencode({'q' : word})}", clients[None]))
+        return cases
+
+    def clear_caches(self, options):
+        if options['cold']:
+            for cache in caches.all():
+                cache.clear()
+
+    # One request at a time through the test client, with the queries of each request counted.
+    # The memory is measured in one extra request, because tracemalloc slows every allocation down.
+    def run_client(self, path, client, host, options):
+        self.clear_caches(options)
+        status = client.get(path).status_code # warm-up
+        timings, queries = [], []
+        for _ in range(options['iterations']):
+            self.clear_caches(options)
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                client.get(path)
+                timings.append(time.perf_counter() - start)
+            queries.append(len(captured))
+
+        self.clear_caches(options)
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            client.get(path)
+            memory = tracemalloc.get_traced_memory()[1] - before
+        finally:
+            tracemalloc.stop()
+        return self.summary(timings, status, queries=max(queries), memory_kib=round(memory / 1024, 1))
+
+    # --concurrency threads calling the WSGI application directly.
+    def run_wsgi(self, path, client, host, options):
+        application = WSGIHandler()
+        factory = RequestFactory(HTTP_HOST=host)
+        cookie = self.cookie(client)
+        statuses = []
+
+        def request(_):
+            self.clear_caches(options)
+            environ = factory.get(path).environ
+            if cookie:
+                environ['HTTP_COOKIE'] = cookie
+            start = time.perf_counter()
+            response = application(environ, lambda status, headers, exc_info=None: statuses.append(int(status.split()[0])))
+            try:
+                b''.join(response)
+            finally:
+                # Sends request_finished, which gives the database connection back.
+                response.close()
+            return time.perf_counter() - start
+
+        request(None) # warm-up
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options['concurrency']) as pool:
+            timings = list(pool.map(request, range(options['iterations'])))
+        return self.summary(timings, statuses[0], rps=round(len(timings) / (time.perf_counter() - start), 1))
+
+    # --concurrency concurrent requests to the ASGI application on one event loop.
+    def run_asgi(self, path, client, host, options):
+        from studybuddy.asgi import application
+
+        url = urlsplit(path)
+        headers = [(b'host', host.encode())]
+        cookie = self.cookie(client)
+        if cookie:
+            headers.append((b'cookie', cookie.encode()))
+        scope = {
+            'type' : 'http', 'asgi' : {'version' : '3.0'}, 'http_version' : '1.1', 'method' : 'GET', 'scheme' : 'http',
+            'path' : url.path, 'raw_path' : url.path.encode(), 'query_string' : url.query.encode(), 'root_path' : '',
+            'headers' : headers, 'client' : ('127.0.0.1', 50000), 'server' : (host, 80),
+        }
+        statuses = []
+
+        async def request(semaphore):
+            async with semaphore:
+                self.clear_caches(options)
+                received = asyncio.Event()
+
+                async def receive():
+                    if received.is_set():
+                        # The client never disconnects, Django stops waiting when the response is sent.
+                        await asyncio.Future()
+                    received.set()
+                    return {'type' : 'http.request', 'body' : b'', 'more_body' : False}
+
+                async def send(message):
+                    if message['type'] == 'http.response.start':
+                        statuses.append(message['status'])
+
+                start = time.perf_counter()
+                await application(dict(scope), receive, send)
+                return time.perf_counter() - start
+
+        async def run():
+            semaphore = asyncio.Semaphore(options['concurrency'])
+            await request(semaphore) # warm-up
+            start = time.perf_counter()
+            timings = await asyncio.gather(*(request(semaphore) for _ in range(options['iterations'])))
+            return timings, time.perf_counter() - start
+
+        timings, seconds = asyncio.run(run())
+        return self.summary(timings, statuses[0], rps=round(len(timings) / seconds, 1))
+
+    # The cookie header of the logged in user of a test client (empty for anonymous clients).
+    def cookie(self, client):
+        return '; '.join(f'{name}={morsel.value}' for name, morsel in client.cookies.items())
+
+    def summary(self, timings, status, **extra):
+        return {
+            'status' : status,
+            'p50' : round(percentile(timings, 50) * 1000, 2),
+            'p95' : round(percentile(timings, 95) * 1000, 2),
+            'p99' : round(percentile(timings, 99) * 1000, 2),
+            **extra,
+        }
+
+    def report(self, results):
+        self.stdout.write(f"{'page':<30} {'status':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'queries':>8} {'KiB':>8}")
+        for key, result in results.items():
+            self.stdout.write(
+                f"{key:<30} {result['status']:>6} {result['p50']:>8} {result['p95']:>8} {result['p99']:>8} "
+                f"{result.get('rps', '-'):>8} {result.get('queries', '-'):>8} {result.get('memory_kib', '-'):>8}"
+            )
+
+    # Prints the change of every page against the baseline, and fails when one of them regressed.
+    def compare(self, baseline, current, threshold):
+        if baseline.get('dataset') != current['dataset']:
+            self.stdout.write(self.style.WARNING(
+                f"The dataset is not the same as in the baseline ({baseline.get('dataset')}), the numbers may not be comparable."
+            ))
+        if baseline.get('cold') != current['cold']:
+            self.stdout.write(self.style.WARNING('The baseline was not run with the same --cold option.'))
+        regressions = []
+        for key, result in current['results'].items():
+            old = baseline['results'].get(key)
+            if old is None:
+                continue
+            change = (result['p95'] - old['p95']) / old['p95'] if old['p95'] else 0
+            line = f"{key:<30} p95 {old['p95']:>8} -> {result['p95']:>8} ms ({change:+.0%})"
+            if 'queries' in result and 'queries' in old:
+                line += f", queries {old['queries']} -> {result['queries']}"
+            slower = change > threshold and result['p95'] - old['p95'] > self.NOISE_MS
+            more_queries = result.get('queries', 0) > old.get('queries', math.inf)
+            if slower or more_queries:
+                regressions.append(key)
+                self.stdout.write(self.style.ERROR(line + '  REGRESSION'))
+            else:
+                self.stdout.write(line)
+        if regressions:
+            raise CommandError(f"{len(regressions)} page(s) regressed against the baseline: {', '.join(regressions)}")
+        self.stdout.write(self.style.SUCCESS('No regressions against the baseline.'))
@@ -0,0 +1,86 @@
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from base import search
+from base.models import Room, Topic, Message
+
+
+class Rollback(Exception):
+    pass
+
+
+# Usage: python manage.py benchmark_search [--rows 1000000]
+# Compares the full text search index with the old __icontains (LIKE '%q%') search of the home page.
+# The benchmark rows are created inside a transaction that is rolled back at the end, so the database is left as it was.
+class Command(BaseCommand):
+    help = 'Benchmarks the full text search index against the LIKE search.'
+
+    WORDS = ['python', 'django', 'design', 'frontend', 'backend', 'database', 'algorithms', 'calculus',
+             'physics', 'history', 'spanish', 'guitar', 'chemistry', 'biology', 'statistics', 'rust']
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000, help='Number of rooms and messages to create.')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of times each query is run.')
+        parser.add_argument('--query', nargs='+', default=['note42', 'algo'], help='Search texts used for both searches.')
+
+    def handle(self, *args, **options):
+        if search.get_backend() is None:
+            raise CommandError('This database has no full text search backend.')
+        try:
+            with transaction.atomic():
+                self.create_rows(options['rows'])
+                for q in options['query']:
+                    self.compare(q, options['repeat'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    # Creates half of the rows as rooms and half as messages, with bulk inserts, and then indexes them.
+    def create_rows(self, rows):
+        self.stdout.write(f'Creating {rows} rows...')
+        user = User.objects.create(username='benchmark-search-user')
+        topics = Topic.objects.bulk_create([Topic(name=f'{word} {i}') for i, word in enumerate(self.WORDS)])
+        room_count = max(rows // 2, 1)
+        rooms = Room.objects.bulk_create(
+            (Room(host=user, topic=topics[i % len(topics)], name=f'{self.WORDS[i % len(self.WORDS)]} room {i}',
+                  description=' '.join(self.WORDS[(i + j) % len(self.WORDS)] for j in range(5)) + f' note{i % 1000}')
+             for i in range(room_count)),
+            batch_size=5000,
+        )
+        Message.objects.bulk_create(
+            (Message(user=user, room=rooms[i % len(rooms)], body=f'message {i} about {self.WORDS[(i * 7) % len(self.WORDS)]}')
+             for i in range(rows - room_count)),
+            batch_size=5000,
+        )
+        start = time.perf_counter()
+        search.rebuild()
+        self.stdout.write(f'Indexed in {time.perf_counter() - start:.1f}s')
+
+    def compare(self, q, repeat):
+        self.stdout.write(f'Search for "{q}":')
+        # The search of the home page before the index: three LIKE predicates, and a fourth one for the activity stream.
+        def like():
+            list(Room.objects.filter(Q(topic__name__icontains=q) | Q(name__icontains=q) | Q(description__icontains=q))
+                 .values_list('id', flat=True))
+            list(Message.objects.filter(room__topic__name__icontains=q).values_list('id', flat=True))
+
+        backend = search.get_backend()
+        terms = search.parse_terms(q)
+
+        def indexed():
+            list(Room.objects.filter(id__in=RawSQL(*backend.room_ids_sql(terms))).values_list('id', flat=True))
+            list(Message.objects.filter(room_id__in=RawSQL(*backend.topic_room_ids_sql(terms))).values_list('id', flat=True))
+
+        def ranked():
+            search.rank_rooms(q, limit=50)
+
+        for name, function in [('LIKE', like), ('FTS', indexed), ('FTS ranked top 50', ranked)]:
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                function()
+                timings.append(time.perf_counter() - start)
+            self.stdout.write(f'{name:>18}: best {min(timings) * 1000:.1f} ms, mean {sum(timings) / len(timings) * 1000:.1f} ms')
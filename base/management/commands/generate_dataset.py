@@ -0,0 +1,124 @@
+import random
+import time
+from itertools import accumulate
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from base import search, timeline, trending
+from base.models import Room, Topic, Message
+
+
+# Usage: python manage.py generate_dataset [--users 1000] [--topics 50] [--rooms 2000] [--messages 100000] [--seed 1]
+# Fills the database with a realistic dataset for benchmarks (see benchmark_pages).
+# Like on a real site, a few users write most of the messages and a few rooms get most of the traffic:
+# users, rooms and topics are picked with Zipf weights (the n-th most popular gets 1/n^skew of the traffic).
+# The same --seed always generates the same dataset, so benchmark runs can be compared.
+# Use it on a separate database, for example: DATABASE_NAME=bench.sqlite3 python manage.py migrate && ...generate_dataset
+class Command(BaseCommand):
+    help = 'Generates users, topics, rooms and messages with skewed participation, for benchmarks.'
+
+    WORDS = ['python', 'django', 'design', 'frontend', 'backend', 'database', 'algorithms', 'calculus',
+             'physics', 'history', 'spanish', 'guitar', 'chemistry', 'biology', 'statistics', 'rust',
+             'exam', 'homework', 'project', 'question', 'help', 'notes', 'lecture', 'tomorrow']
+
+    # The users can log in with this password.
+    PASSWORD = 'dataset-password'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Number of users.')
+        parser.add_argument('--topics', type=int, default=50, help='Number of topics.')
+        parser.add_argument('--rooms', type=int, default=2000, help='Number of rooms.')
+        parser.add_argument('--messages', type=int, default=100000, help='Number of messages.')
+        parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent, 0 spreads the traffic evenly.')
+        parser.add_argument('--seed', type=int, default=1, help='Seed of the random generator.')
+        parser.add_argument('--prefix', default='dataset', help='Prefix of the usernames, so several datasets can be added.')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Number of rows per INSERT.')
+
+    def handle(self, *args, **options):
+        if min(options['users'], options['topics'], options['rooms']) < 1:
+            raise CommandError('At least one user, topic and room is needed.')
+        if User.objects.filter(username__startswith=f"{options['prefix']}-").exists():
+            raise CommandError(f"Users named {options['prefix']}-... already exist, use another --prefix.")
+
+        start = time.perf_counter()
+        rng = random.Random(options['seed'])
+        with transaction.atomic():
+            users = self.create_users(options)
+            topics = self.create_topics(options)
+            rooms = self.create_rooms(options, rng, users, topics)
+            participants = self.create_messages(options, rng, users, rooms)
+        # bulk_create does not send the signals, so the counters, the search index, the activity timelines
+        # and the trending scores are brought up to date at the end.
+        call_command('recount', stdout=self.stdout)
+        indexed = search.rebuild()
+        timeline.backfill()
+        trending.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {len(users)} users, {len(topics)} topics, {len(rooms)} rooms, {options['messages']} messages "
+            f"and {participants} participants, indexed {indexed} documents in {time.perf_counter() - start:.1f}s. "
+            f"Password of the users: {self.PASSWORD}"
+        ))
+
+    # Cumulative Zipf weights of n items, for rng.choices(cum_weights=...).
+    def zipf(self, n, skew):
+        return list(accumulate(1 / (rank ** skew) for rank in range(1, n + 1)))
+
+    def words(self, rng, low, high):
+        return ' '.join(rng.choices(self.WORDS, k=rng.randint(low, high)))
+
+    def create_users(self, options):
+        # Hashing a password is slow on purpose, so all users share the same hash.
+        password = make_password(self.PASSWORD)
+        return User.objects.bulk_create(
+            [User(username=f"{options['prefix']}-user-{i}", password=password) for i in range(options['users'])],
+            batch_size=options['batch_size'],
+        )
+
+    # Topic names are unique, topics that already exist are reused.
+    def create_topics(self, options):
+        names = [f'{self.WORDS[i % len(self.WORDS)]} {i // len(self.WORDS) + 1}' for i in range(options['topics'])]
+        existing = set(Topic.objects.filter(name__in=names).values_list('name', flat=True))
+        Topic.objects.bulk_create([Topic(name=name) for name in names if name not in existing], batch_size=options['batch_size'])
+        topics = Topic.objects.in_bulk(names, field_name='name')
+        return [topics[name] for name in names]
+
+    def create_rooms(self, options, rng, users, topics):
+        user_weights = self.zipf(len(users), options['skew'])
+        topic_weights = self.zipf(len(topics), options['skew'])
+        rooms = []
+        for i in range(options['rooms']):
+            topic = rng.choices(topics, cum_weights=topic_weights)[0]
+            rooms.append(Room(
+                host=rng.choices(users, cum_weights=user_weights)[0],
+                topic=topic,
+                name=f'{topic.name} {self.words(rng, 1, 3)}',
+                description=self.words(rng, 5, 30),
+            ))
+        rooms = Room.objects.bulk_create(rooms, batch_size=options['batch_size'])
+        # The most popular rooms should not simply be the oldest ones.
+        rng.shuffle(rooms)
+        return rooms
+
+    # Creates the messages batch by batch, and a participant row for every (room, user) pair that posted.
+    def create_messages(self, options, rng, users, rooms):
+        user_weights = self.zipf(len(users), options['skew'])
+        room_weights = self.zipf(len(rooms), options['skew'])
+        pairs = set()
+        remaining = options['messages']
+        while remaining > 0:
+            size = min(remaining, options['batch_size'])
+            batch = [
+                Message(user=user, room=room, body=self.words(rng, 3, 40))
+                for user, room in zip(rng.choices(users, cum_weights=user_weights, k=size),
+                                      rng.choices(rooms, cum_weights=room_weights, k=size))
+            ]
+            Message.objects.bulk_create(batch)
+            pairs.update((message.room_id, message.user_id) for message in batch)
+            remaining -= size
+        Participant = Room.participants.through
+        Participant.objects.bulk_create(
+            [Participant(room_id=room_id, user_id=user_id) for room_id, user_id in pairs], batch_size=options['batch_size']
+        )
+        return len(pairs)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from base import deletion
+from base.models import Room
+
+
+# Usage: python manage.py purge_deleted_rooms [--batch-size 1000]
+# Removes the rows of the rooms that were deleted (hidden) but not purged yet, for example because the process
+# stopped before its background thread was done (see deletion.py). Safe to run at any time, from cron for instance.
+class Command(BaseCommand):
+    help = 'Finishes the removal of deleted rooms, their messages and participants.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='Database to purge the rooms of.')
+        parser.add_argument('--batch-size', type=int, help='Number of rows deleted per transaction.')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        pks = list(Room.all_objects.using(using).filter(hidden=True).values_list('id', flat=True))
+        for pk in pks:
+            deletion.purge_room(pk, batch_size=options['batch_size'], using=using)
+        self.stdout.write(self.style.SUCCESS(f'Purged {len(pks)} deleted rooms.'))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from base import search
+
+
+# Usage: python manage.py rebuild_search_index
+# Empties the full text search index and fills it again from the Room, Topic and Message tables.
+# Needed after rows were written without signals (bulk_create, raw SQL, loaddata with --no-signals...).
+class Command(BaseCommand):
+    help = 'Rebuilds the full text search index of rooms, topics and messages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='Database to rebuild the index of.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Number of rows read from the database at a time.')
+
+    def handle(self, *args, **options):
+        backend = search.get_backend(options['database'])
+        if backend is None:
+            raise CommandError('This database has no full text search backend.')
+        backend.install()
+        with transaction.atomic(using=options['database']):
+            count = search.rebuild(using=options['database'], chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} documents.'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from base import trending
+
+
+# Usage: python manage.py rebuild_trending
+# Computes the trending scores of every room and topic (see base/trending.py) again from the messages.
+# Needed after messages were written without signals (generate_dataset, raw SQL...) or TRENDING['HALF_LIFE'] was changed.
+class Command(BaseCommand):
+    help = 'Recomputes the trending scores of the rooms and topics from the messages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='Database to rebuild the scores of.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Number of rows read and written at a time.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic(using=options['database']):
+            count = trending.rebuild(using=options['database'], chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Scored {count} rooms.'))
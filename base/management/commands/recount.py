@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from base.models import Room, Topic, Message, ArchivedMessage
+
+
+# Counts the rows of `model` per value of `field`, for use in an UPDATE ... SET counter = (subquery).
+def countOf(model, field):
+    counts = (
+        model.objects.filter(**{field : OuterRef('pk')})
+        .order_by()
+        .values(field)
+        .annotate(count=Count('*'))
+        .values('count')
+    )
+    return Coalesce(Subquery(counts), Value(0))
+
+
+# Usage: python manage.py recount
+# Recomputes the stored counters (Room.participant_count, Room.message_count and Topic.room_count) from the tables.
+# The counters are kept up to date by signals.py, this repairs them after rows were written without signals
+# (bulk_create, raw SQL, deleted users...).
+class Command(BaseCommand):
+    help = 'Repairs the stored participant, message and room counters.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='Database to repair the counters of.')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        with transaction.atomic(using=using):
+            rooms = Room.objects.using(using).update(
+                participant_count=countOf(Room.participants.through, 'room_id'),
+                # The archived messages are still messages of the room (see archive.py).
+                message_count=countOf(Message, 'room_id') + countOf(ArchivedMessage, 'room_id'),
+            )
+            topics = Topic.objects.using(using).update(room_count=countOf(Room, 'topic_id'))
+        self.stdout.write(self.style.SUCCESS(f'Recounted {rooms} rooms and {topics} topics.'))
@@ -0,0 +1,164 @@
+import random
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import FileResponse, HttpResponseNotModified
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+from .routers import get_replicas, read_from_primary
+from . import instrumentation, staticfiles
+
+# Read-your-writes for the read replicas (see routers.py).
+# A request that writes (any method other than GET, HEAD, OPTIONS) reads from the primary, and so do the requests of
+# the same browser for the next REPLICA_STICKY_SECONDS, until the replicas have caught up with the write.
+# Posting a message in a room and editing a room (updateRoom) are POST requests, so they are covered.
+# The deadline is kept in a cookie, a wrong value can only send more reads to the primary.
+#
+# Both middleware classes below work in sync and async mode. On the ASGI application the async views (for example the
+# room events of api.py, which wait for new messages) then never need a thread while they wait.
+
+PRIMARY_COOKIE = 'primary_until'
+
+
+def pinnedToPrimary(request):
+    try:
+        return float(request.COOKIES.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+class ReplicaStickinessMiddleware:
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        writes = request.method not in ('GET', 'HEAD', 'OPTIONS')
+        if not get_replicas() or not (writes or pinnedToPrimary(request)):
+            return self.get_response(request)
+        with read_from_primary():
+            response = self.get_response(request)
+        return self.pin(request, response, writes)
+
+    async def __acall__(self, request):
+        writes = request.method not in ('GET', 'HEAD', 'OPTIONS')
+        if not get_replicas() or not (writes or pinnedToPrimary(request)):
+            return await self.get_response(request)
+        # The context variable is copied to the threads that run the queries (sync_to_async).
+        with read_from_primary():
+            response = await self.get_response(request)
+        return self.pin(request, response, writes)
+
+    def pin(self, request, response, writes):
+        if writes:
+            seconds = getattr(settings, 'REPLICA_STICKY_SECONDS', 10)
+            response.set_cookie(PRIMARY_COOKIE, str(time.time() + seconds), max_age=seconds, httponly=True, samesite='Lax')
+        return response
+
+
+# Records the wall time, queries, template time and cache lookups of the requests (see instrumentation.py).
+# Put it first in settings.MIDDLEWARE, so the time of the other middleware is included.
+class InstrumentationMiddleware:
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        instrumentation.install()
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        options = instrumentation.get_settings()
+        if not options['ENABLED']:
+            return self.get_response(request)
+
+        start = time.perf_counter()
+        if random.random() >= options['SAMPLE_RATE']:
+            response = self.get_response(request)
+            instrumentation.finish(request, None, time.perf_counter() - start, response)
+            return response
+
+        with instrumentation.profile() as current:
+            response = self.get_response(request)
+        instrumentation.finish(request, current, time.perf_counter() - start, response)
+        return response
+
+    async def __acall__(self, request):
+        options = instrumentation.get_settings()
+        if not options['ENABLED']:
+            return await self.get_response(request)
+
+        start = time.perf_counter()
+        if random.random() >= options['SAMPLE_RATE']:
+            response = await self.get_response(request)
+            instrumentation.finish(request, None, time.perf_counter() - start, response)
+            return response
+
+        with instrumentation.profile() as current:
+            response = await self.get_response(request)
+        instrumentation.finish(request, current, time.perf_counter() - start, response)
+        return response
+
+
+# Serves the collected static files and the avatars (see staticfiles.py) before any other middleware runs,
+# so they never touch the sessions, the database or the instrumentation. Put it first in settings.MIDDLEWARE.
+# It is not used in development (DEBUG): runserver serves static/, and studybuddy/urls.py the avatars.
+class StaticFilesMiddleware:
+    async_capable = True
+    sync_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if settings.DEBUG:
+            raise MiddlewareNotUsed()
+        # Empty when collectstatic was not run.
+        self.files = staticfiles.build_index() or {}
+        self.prefix = '/' + settings.STATIC_URL.lstrip('/')
+        self.media_prefix = '/' + settings.MEDIA_URL.lstrip('/')
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.serve(request) or self.get_response(request)
+
+    async def __acall__(self, request):
+        return self.serve(request) or await self.get_response(request)
+
+    # Returns the response for a static file, or None when the request is not for one.
+    def serve(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        if request.path.startswith(self.prefix):
+            static_file = self.files.get(request.path[len(self.prefix):])
+        elif request.path.startswith(self.media_prefix):
+            static_file = staticfiles.avatar_file(request.path[len(self.media_prefix):])
+        else:
+            return None
+        if static_file is None:
+            return None
+        if not was_modified_since(request.headers.get('If-Modified-Since'), static_file.mtime):
+            response = HttpResponseNotModified()
+        else:
+            path, encoding = static_file.choose(request.headers.get('Accept-Encoding', ''))
+            # filename: the name of the original in Content-Disposition, not the one of the .br/.gz variant.
+            response = FileResponse(open(path, 'rb'), content_type=static_file.content_type, filename=static_file.name)
+            if encoding:
+                response['Content-Encoding'] = encoding
+            if request.method == 'HEAD':
+                response.streaming_content = []
+        response['Last-Modified'] = http_date(static_file.mtime)
+        response['Cache-Control'] = static_file.cache_control
+        response['Vary'] = 'Accept-Encoding'
+        return response
@@ -0,0 +1,41 @@
+from django.db import migrations
+
+
+# Creates the full text search index table (see base/search.py) and fills it with the existing rooms and messages.
+def create_index(apps, schema_editor):
+    from base import search
+
+    backend = search.get_backend(schema_editor.connection.alias)
+    if backend is None:
+        return
+    backend.install()
+    Room = apps.get_model('base', 'Room')
+    Message = apps.get_model('base', 'Message')
+    using = schema_editor.connection.alias
+    backend.add_many(search.ROOM, [
+        (room.id, room.id, search.room_document(room))
+        for room in Room.objects.using(using).select_related('topic')
+    ])
+    backend.add_many(search.MESSAGE, [
+        (message.id, message.room_id, search.message_document(message))
+        for message in Message.objects.using(using)
+    ])
+
+
+def drop_index(apps, schema_editor):
+    from base import search
+
+    backend = search.get_backend(schema_editor.connection.alias)
+    if backend is not None:
+        backend.uninstall()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0003_alter_room_options_room_participants'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Topic.name becomes unique. Topics that share a name are merged into the oldest one first, so the unique index can be created.
+def merge_duplicate_topics(apps, schema_editor):
+    Topic = apps.get_model('base', 'Topic')
+    Room = apps.get_model('base', 'Room')
+    kept = {}
+    for topic in Topic.objects.order_by('id'):
+        if topic.name in kept:
+            Room.objects.filter(topic=topic).update(topic=kept[topic.name])
+            topic.delete()
+        else:
+            kept[topic.name] = topic
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0004_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='message',
+            options={'ordering': ['-updated', '-created']},
+        ),
+        migrations.RunPython(merge_duplicate_topics, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='topic',
+            name='name',
+            field=models.CharField(max_length=200, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['-updated', '-created', '-id'], name='message_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', '-updated', '-created', '-id'], name='message_room_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['user', '-updated', '-created', '-id'], name='message_user_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['-updated', '-created', '-id'], name='room_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['host', '-updated', '-created', '-id'], name='room_host_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['topic', '-updated'], name='room_topic_recent_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:41
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+# Fills the new counters of the existing rooms and topics.
+def fill_counters(apps, schema_editor):
+    Room = apps.get_model('base', 'Room')
+    Topic = apps.get_model('base', 'Topic')
+    Message = apps.get_model('base', 'Message')
+    using = schema_editor.connection.alias
+
+    def count_of(model, field):
+        counts = model.objects.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(count=Count('*')).values('count')
+        return Coalesce(Subquery(counts), Value(0))
+
+    Room.objects.using(using).update(
+        participant_count=count_of(Room.participants.through, 'room_id'),
+        message_count=count_of(Message, 'room_id'),
+    )
+    Topic.objects.using(using).update(room_count=count_of(Room, 'topic_id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0005_feed_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='participant_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='room_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0007_archived_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='hidden',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0011_trend'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PageVersion',
+            fields=[
+                ('key', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('stamp', models.BigIntegerField()),
+            ],
+        ),
+    ]
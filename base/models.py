@@ -6,10 +6,34 @@ from django.contrib.auth.models import User
 # creating models of tables in the Rooms
 
 
+# Querysets used by the feed pages (home and userProfile).
+# Every related object the templates need is fetched up front,
+# so the number of queries stays the same no matter how many rows are rendered.
+# The counts shown on the pages are stored on the rows themselves (see the *_count fields and signals.py).
+class RoomQuerySet(models.QuerySet):
+    # Joins the host (with its avatar) and topic in the same query (used in feed_component.html).
+    def for_feed(self):
+        return self.select_related('host__avatar', 'topic')
+
+
+# The default manager of Room: rooms that are being deleted (hidden, see deletion.py) are left out everywhere.
+# Room.all_objects still sees them, and so do the foreign keys (message.room), which use the base manager.
+class RoomManager(models.Manager.from_queryset(RoomQuerySet)):
+    def get_queryset(self):
+        return super().get_queryset().filter(hidden=False)
+
+
 # Topic class, represents the topic of the discussion.
 # Rooms are children of the topic class
 class Topic(models.Model):
-    name = models.CharField(max_length = 200) # Name of the topic
+    name = models.CharField(max_length = 200, unique = True) # Name of the topic. Unique, so get_or_create(name=...) is an index lookup.
+    room_count = models.PositiveIntegerField(default = 0, editable = False) # Number of rooms in the topic. Kept up to date by signals.py, repaired by the recount command.
+    trend = models.FloatField(default = 0, editable = False) # Decayed activity of the rooms of the topic (trending.py).
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-trend'], name='topic_trending_idx'), # trending topics
+        ]
     
     def __str__(self): # string representation of the topic
         return self.name
@@ -24,13 +48,35 @@ class Room(models.Model):
     participants = models.ManyToManyField(User, related_name='participants', blank = True)  # Stores all the users active in a room. Creates a many to many relationship.
     updated = models.DateTimeField(auto_now = True) # Takes a snapshot of anytime the table (model instance) is updated. Takes a timestamp every time room is updated.
     created = models.DateTimeField(auto_now_add = True) # Takes a timestamp of when the instance was created.
+    participant_count = models.PositiveIntegerField(default = 0, editable = False) # Number of participants. Kept up to date by signals.py, repaired by the recount command.
+    message_count = models.PositiveIntegerField(default = 0, editable = False) # Number of messages in the room. Kept up to date the same way.
+    hidden = models.BooleanField(default = False, editable = False) # Set when the room is deleted, its rows are then removed in the background (deletion.py).
+    trend = models.FloatField(default = 0, editable = False) # Decayed number of messages and participants (trending.py).
+
+    objects = RoomManager()
+    all_objects = RoomQuerySet.as_manager() # Hidden rooms included.
     
     # Newest updated room is first in the list
     class Meta:
         ordering = ['-updated', '-created']
+        # Indexes that match the filters + ordering used by the feed pages, so the database never has to sort the rooms itself.
+        indexes = [
+            models.Index(fields=['-updated', '-created', '-id'], name='room_recent_idx'), # home feed (keyset pages)
+            models.Index(fields=['host', '-updated', '-created', '-id'], name='room_host_recent_idx'), # rooms of a user (profile page)
+            models.Index(fields=['topic', '-updated'], name='room_topic_recent_idx'), # rooms of a topic
+            models.Index(fields=['-trend', '-id'], name='room_trending_idx'), # home feed, ?sort=trending
+        ]
     
     def __str__(self): # string representation of the room
         return self.name
+
+    # Saves a message sent by a user in the room, and adds the user to the participants.
+    # Used by the room view (form POST) and the WebSocket chat (consumers.py).
+    def post_message(self, user, body):
+        message = Message.objects.create(user=user, room=self, body=body)
+        # The user will be added to the many to many field for the participants, so that we can render out the participants of a chatroom.  
+        self.participants.add(user)
+        return message
     
 
 
@@ -52,9 +98,83 @@ class Message(models.Model):
     # Newest updated room is first in the list
     class Meta:
         ordering = ['-updated', '-created']
+        # Indexes that match the filters + ordering used by the room page and the activity stream.
+        indexes = [
+            models.Index(fields=['-updated', '-created', '-id'], name='message_recent_idx'), # activity stream (keyset pages)
+            models.Index(fields=['room', '-updated', '-created', '-id'], name='message_room_recent_idx'), # room.message_set.all()
+            models.Index(fields=['user', '-updated', '-created', '-id'], name='message_user_recent_idx'), # user.message_set.all()
+        ]
     
     def __str__(self): # string representation of the message
         return self.body[0:50] # trim it down, only the first 50 characters in the preview. 
-    
-      
-    
\ No newline at end of file
+
+
+# ArchivedMessage class, an old message moved out of the Message table by the archive_messages command (see archive.py).
+# The Message table only keeps the recent messages, so its indexes stay small and the pages that read it stay fast.
+# The archived messages keep their id, so links and cursors to them still work, and they are read by the "older messages" pages.
+class ArchivedMessage(models.Model):
+    id = models.BigIntegerField(primary_key = True) # The id the message had in the Message table.
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+    body = models.TextField()
+    updated = models.DateTimeField() # Copied from the message, not changed when it is archived.
+    created = models.DateTimeField()
+    archived = models.DateTimeField(auto_now_add = True) # When the message was moved to the archive.
+
+    # Archived messages are read-only, the templates use this to hide the delete button.
+    is_archived = True
+
+    class Meta:
+        ordering = ['-updated', '-created']
+        indexes = [
+            models.Index(fields=['room', '-updated', '-created', '-id'], name='archived_room_recent_idx'), # older messages of a room
+        ]
+
+    def __str__(self):
+        return self.body[0:50]
+
+
+# Avatar class, the picture of a user (see avatars.py).
+# The uploaded image is stored as thumbnails named after the hash of the image, so a name never points to another
+# picture and the files can be cached forever. Users without an avatar get static/images/avatar.svg.
+class Avatar(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key = True) # user.avatar
+    digest = models.CharField(max_length = 64) # SHA-256 of the uploaded image, the name of its thumbnails.
+    updated = models.DateTimeField(auto_now = True)
+
+    def __str__(self):
+        return f'avatar of {self.user_id}'
+
+
+# ActivityEvent class, one line of an activity timeline ("@user replied to post “room”", see timeline.py).
+# Every message is written to the site timeline (owner is empty) and to the timeline of its author, with the names
+# copied in, so the "Recent Activities" column reads a timeline with one indexed query instead of joining the messages.
+class ActivityEvent(models.Model):
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, null = True, related_name = 'timeline') # Whose timeline, empty for the site timeline.
+    message_id = models.BigIntegerField(db_index = True) # Not a foreign key: the event goes away with its message (timeline.py).
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name = '+') # Author of the message.
+    username = models.CharField(max_length = 150) # Copied from the author.
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name = '+')
+    room_name = models.CharField(max_length = 200) # Copied from the room.
+    body = models.TextField()
+    updated = models.DateTimeField() # Copied from the message, the timeline is ordered like the messages (pagination.py).
+    created = models.DateTimeField()
+
+    class Meta:
+        ordering = ['-updated', '-created']
+        indexes = [
+            models.Index(fields=['owner', '-updated', '-created', '-id'], name='activity_timeline_idx'), # a timeline, newest first
+        ]
+
+    def __str__(self):
+        return f'{self.username} replied to {self.room_name}'
+
+
+# PageVersion class, a version stamp of the page cache (see cache.py): the global stamp of the feed pages, or the stamp
+# of one room page. It is a table, not a cache entry, so every process sees a bump at once and no stamp is ever evicted.
+class PageVersion(models.Model):
+    key = models.CharField(max_length = 100, primary_key = True)
+    stamp = models.BigIntegerField() # time.time_ns() of the last bump. A key without a row has never been bumped (stamp 0).
+
+    def __str__(self):
+        return f'{self.key} {self.stamp}'
@@ -0,0 +1,76 @@
+import time
+from collections import Counter
+from django.db import transaction
+from .models import Room, Topic, Message, ActivityEvent
+from . import search
+from .cache import bump_topics_version
+from .deletion import get_settings, uncount
+
+# Bulk moderation of the admin (admin.py): moving messages to another room and rooms to another topic.
+# Like the batched deletes of deletion.py, the rows are changed with plain UPDATEs, BATCH_SIZE rows at a time
+# (settings.ROOM_DELETION), each batch in its own short transaction, without loading the objects or sending signals.
+# What the signals would have done (counters, search index, timelines, cached pages) is done once per batch.
+# The trending scores stay where the activity happened, rebuild_trending moves them.
+
+
+# Calls on_batch(rows) with the rows of queryset (dicts with the id and `fields` values), batch_size at a time, in id
+# order, each batch in its own transaction. The rows may stop matching the queryset once changed. Returns the number of rows.
+def update_in_batches(queryset, fields, on_batch, batch_size=None, pause=None, using='default'):
+    options = get_settings()
+    batch_size = batch_size or options['BATCH_SIZE']
+    pause = options['PAUSE'] if pause is None else pause
+    queryset = queryset.using(using).order_by('id')
+    last, changed = None, 0
+    while True:
+        with transaction.atomic(using=using):
+            batch = queryset if last is None else queryset.filter(id__gt=last)
+            rows = list(batch.values('id', *fields)[:batch_size])
+            if rows:
+                on_batch(rows)
+        changed += len(rows)
+        if len(rows) < batch_size:
+            return changed
+        last = rows[-1]['id']
+        time.sleep(pause)
+
+
+# Moves the messages of queryset to `room`. Their authors become participants of the room.
+# Returns the number of messages moved.
+def move_messages(queryset, room, batch_size=None, pause=None, using='default'):
+    from .signals import changeCount, invalidateRoomPages
+
+    def moved(rows):
+        ids = [row['id'] for row in rows]
+        Message.objects.using(using).filter(id__in=ids).update(room_id=room.id)
+        uncount(rows, 'message_count', using)
+        changeCount(Room.all_objects.using(using).filter(id=room.id), 'message_count', len(rows))
+        search.move_messages(ids, room.id, using=using)
+        ActivityEvent.objects.using(using).filter(message_id__in=ids).update(room_id=room.id, room_name=room.name)
+        # Counted by the participant signals.
+        room.participants.add(*{row['user_id'] for row in rows})
+        room_ids = {row['room_id'] for row in rows} | {room.id}
+        transaction.on_commit(lambda: invalidateRoomPages(room_ids), using=using)
+
+    return update_in_batches(queryset.exclude(room_id=room.id), ['room_id', 'user_id'], moved, batch_size, pause, using)
+
+
+# Moves the rooms of queryset to `topic`. Returns the number of rooms moved.
+def move_rooms(queryset, topic, batch_size=None, pause=None, using='default'):
+    from .signals import changeCount, countSuggestedTopic, invalidateRoomPages
+
+    def moved(rows):
+        ids = [row['id'] for row in rows]
+        Room.all_objects.using(using).filter(id__in=ids).update(topic=topic)
+        topics = Topic.objects.using(using)
+        for topic_id, count in Counter(row['topic_id'] for row in rows if row['topic_id']).items():
+            changeCount(topics.filter(id=topic_id), 'room_count', -count)
+            countSuggestedTopic(topic_id, -count, using)
+        changeCount(topics.filter(id=topic.id), 'room_count', len(rows))
+        countSuggestedTopic(topic.id, len(rows), using)
+        # The topic name is part of the search document of the room.
+        for room in Room.all_objects.using(using).filter(id__in=ids).select_related('topic').only('id', 'name', 'description', 'topic__name'):
+            search.index_room(room, using=using)
+        transaction.on_commit(bump_topics_version, using=using)
+        transaction.on_commit(lambda: invalidateRoomPages(ids), using=using)
+
+    return update_in_batches(queryset.exclude(topic_id=topic.id), ['topic_id'], moved, batch_size, pause, using)
@@ -0,0 +1,111 @@
+import base64
+from datetime import datetime
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+# Keyset (cursor) pagination for the room feed and the activity stream.
+# Instead of OFFSET pages, the cursor remembers the (updated, created, id) of the last row that was shown,
+# and the next page starts right after it. This way every page costs the same, no matter how deep the user scrolls.
+
+# Number of rooms/messages shown per page.
+FEED_PAGE_SIZE = 20
+
+# Number of messages shown per page of a room, the older ones are behind the "older messages" link.
+ROOM_PAGE_SIZE = 50
+
+# The order the pages are walked in. id is added so that rows with the same timestamps still have a stable order.
+KEYSET_ORDERING = ['-updated', '-created', '-id']
+
+
+# Turns the last row of a page (a model instance, or a dict from .values()) into a short url safe string.
+def encode_cursor(obj):
+    if isinstance(obj, dict):
+        updated, created, pk = obj['updated'], obj['created'], obj['id']
+    else:
+        updated, created, pk = obj.updated, obj.created, obj.id
+    raw = f'{updated.isoformat()}|{created.isoformat()}|{pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+# Turns a cursor string back into the (updated, created, id) values. Raises ValueError if the cursor is not valid.
+def decode_cursor(cursor):
+    updated, created, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(updated), datetime.fromisoformat(created), int(pk)
+
+
+# Returns one page of the queryset and the cursor of the next page (None if this was the last page).
+# A .values() queryset works too, as long as its rows have the updated, created and id keys.
+def paginate(queryset, cursor=None, size=FEED_PAGE_SIZE):
+    queryset = queryset.order_by(*KEYSET_ORDERING)
+    if cursor:
+        updated, created, pk = decode_cursor(cursor)
+        # Only the rows that come after the last row of the previous page.
+        queryset = queryset.filter(
+            Q(updated__lt=updated) |
+            Q(updated=updated, created__lt=created) |
+            Q(updated=updated, created=created, id__lt=pk)
+        )
+    # One extra row is fetched to find out if there is a next page.
+    items = list(queryset[:size + 1])
+    if len(items) > size:
+        items = items[:size]
+        return items, encode_cursor(items[-1])
+    return items, None
+
+
+# Numbered pages of the admin (admin.py).
+# Django's Paginator runs a COUNT(*) for the number of pages, which reads the whole table (or index) every time,
+# seconds on a large Message table. When the changelist is not filtered, the number of rows is estimated instead,
+# from what the database already knows: the table statistics on PostgreSQL, the lowest and highest id on SQLite
+# (two index lookups, ids missing because of deleted or archived messages are counted too). Tables with fewer
+# rows than ESTIMATED_COUNT_MIN are counted exactly.
+ESTIMATED_COUNT_MIN = 10000
+
+
+# The estimated number of rows of a table, or None when the database can not tell.
+def estimated_count(model, using='default'):
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+        elif connection.vendor == 'sqlite':
+            pk = model._meta.pk.column
+            # Two subqueries: SQLite only reads the ends of the index for a query with a single MIN() or MAX().
+            cursor.execute(f'SELECT (SELECT MAX("{pk}") FROM "{table}") - (SELECT MIN("{pk}") FROM "{table}") + 1')
+        else:
+            return None
+        row = cursor.fetchone()
+    # reltuples is -1 for a table that was never analyzed, MAX() is NULL for an empty table.
+    return row[0] if row and row[0] is not None and row[0] >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.has_filters():
+            estimate = estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= ESTIMATED_COUNT_MIN:
+                return estimate
+        return super().count
+
+    # The estimate can be too high (the ids of deleted or archived rows on SQLite), so the last pages may not exist.
+    # A short page tells the real number of rows, and a page past the end is replaced by the real last page (found
+    # with one exact count, only then), instead of the error of the admin.
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        items = list(self.object_list[bottom:bottom + self.per_page])
+        if not items and number > 1:
+            self.clamp(self.object_list.count())
+            return self.page(self.num_pages)
+        if len(items) < self.per_page:
+            self.clamp(bottom + len(items))
+        return self._get_page(items, number, self)
+
+    def clamp(self, count):
+        self.__dict__['count'] = count
+        self.__dict__.pop('num_pages', None)
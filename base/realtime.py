@@ -0,0 +1,149 @@
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Publish/subscribe layer for the real-time room chat (see consumers.py).
+# Every room has its own channel. When a message is created or deleted, a small JSON "delta" is published on the
+# channel of its room, and every WebSocket connected to that room forwards it to the browser.
+#
+# The broker is pluggable, settings.CHAT_BROKER holds the import path of the broker class.
+# The default LocalBroker keeps everything in this process, which is enough for a single ASGI worker and for tests.
+# A broker for several processes (Redis, PostgreSQL LISTEN/NOTIFY...) only has to implement the Broker interface.
+# A broker that misses one of its methods can not be created, instead of failing on the first publish.
+#
+# The deltas are published once the transaction is committed, and only built when the channel has subscribers
+# (publish_to_room), so posting in a room nobody is watching costs nothing more than the message itself.
+
+
+# The interface every broker implements.
+class Broker(ABC):
+    # Returns a Subscription for the channel. Messages published after this call are delivered to it.
+    @abstractmethod
+    def subscribe(self, channel):
+        pass
+
+    # Sends data (a dict) to every subscription of the channel. Must be safe to call from any thread, sync or async.
+    @abstractmethod
+    def publish(self, channel, data):
+        pass
+
+    # True when something may be subscribed to the channel. A broker that can not tell cheaply returns True.
+    @abstractmethod
+    def has_subscribers(self, channel):
+        pass
+
+
+class Subscription:
+    def __init__(self, broker, channel, maxsize):
+        self.broker = broker
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+
+    # Waits for the next published message.
+    async def get(self):
+        return await self.queue.get()
+
+    # The messages that are already waiting, without waiting for more.
+    def pending(self):
+        messages = []
+        while not self.queue.empty():
+            messages.append(self.queue.get_nowait())
+        return messages
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    # Called on the event loop of the subscriber. A subscriber that falls too far behind loses the oldest messages,
+    # so one slow browser can never make the memory grow without a limit.
+    def deliver(self, data):
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(data)
+
+
+class LocalBroker(Broker):
+    # Number of messages kept for a subscriber that has not read them yet.
+    QUEUE_SIZE = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    # Must be called from a coroutine, the subscription belongs to the running event loop.
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel, self.QUEUE_SIZE)
+        with self.lock:
+            self.subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.channel, None)
+
+    def has_subscribers(self, channel):
+        with self.lock:
+            return channel in self.subscriptions
+
+    # Publishers can run in a sync view (another thread), so the message is handed to the event loop of each subscriber.
+    def publish(self, channel, data):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, data)
+            except RuntimeError:
+                # The event loop of the subscriber is closed, the subscription is dead.
+                self.unsubscribe(subscription)
+
+
+_broker = None
+
+
+# Returns the broker of this process, created from settings.CHAT_BROKER the first time.
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = import_string(getattr(settings, 'CHAT_BROKER', 'base.realtime.LocalBroker'))()
+    return _broker
+
+
+# Replaces the broker of this process (used by the tests).
+def set_broker(broker):
+    global _broker
+    _broker = broker
+
+
+def room_channel(room_id):
+    return f'room.{room_id}'
+
+
+# Publishes the delta made by make_delta() on the channel of the room, if anybody is subscribed to it.
+def publish_to_room(room_id, make_delta):
+    broker = get_broker()
+    channel = room_channel(room_id)
+    if broker.has_subscribers(channel):
+        broker.publish(channel, make_delta())
+
+
+# The delta sent to the browsers when a message is created. Only what the room page needs to draw the message.
+def message_delta(message):
+    from .avatars import avatar_url
+
+    return {
+        'type' : 'message',
+        'id' : message.id,
+        'room' : message.room_id,
+        'user' : {'id' : message.user_id, 'username' : message.user.username, 'avatar' : avatar_url(message.user)},
+        'body' : message.body,
+        'created' : message.created.isoformat(),
+    }
+
+
+def message_deleted_delta(message):
+    return {'type' : 'message_deleted', 'id' : message.id, 'room' : message.room_id}
@@ -0,0 +1,58 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+
+# Database router for a primary database with read replicas.
+# Every write goes to the primary ('default'), reads go to one of the replicas listed in settings.DATABASE_REPLICAS.
+# Replicas are a little behind the primary (replication lag), so some reads still have to go to the primary:
+#   - the whole request, while it writes (POST...), and for REPLICA_STICKY_SECONDS after it, so users always see
+#     the message they just posted or the room they just edited (see middleware.py).
+#   - the sessions, a session is written at login and read again by the very next request.
+# Without DATABASE_REPLICAS every query simply goes to 'default'.
+
+PRIMARY = 'default'
+
+# True while the queries of the current request (or thread) must read from the primary.
+_use_primary = ContextVar('use_primary', default=False)
+
+# Apps whose rows are always read from the primary.
+PRIMARY_ONLY_APPS = {'sessions'}
+
+
+def get_replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+# Sends the reads inside the with block to the primary.
+@contextmanager
+def read_from_primary():
+    token = _use_primary.set(True)
+    try:
+        yield
+    finally:
+        _use_primary.reset(token)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = get_replicas()
+        if not replicas or _use_primary.get() or model._meta.app_label in PRIMARY_ONLY_APPS:
+            return PRIMARY
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    # The primary and its replicas hold the same rows, so objects from any of them can be related.
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY, *get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    # The replicas get their tables and rows from the primary, migrations only run there.
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in get_replicas():
+            return False
+        return None
@@ -0,0 +1,324 @@
+import re
+from itertools import islice
+from django.db import connections
+
+# Full text search for rooms, topics and messages.
+# Every room and every message gets one row (a "document") in a search index table, which is kept in sync by the
+# signals in signals.py. The home page search then looks words up in the index, instead of scanning the
+# Room, Topic and Message tables with LIKE '%q%'.
+#
+# Each database has its own backend behind the same interface:
+#   - SQLite uses an FTS5 virtual table.
+#   - PostgreSQL uses a regular table with tsvector columns and GIN indexes.
+# Any other database has no backend, and the views fall back to the old __icontains search.
+
+INDEX_TABLE = 'base_search_index'
+
+# Rooms and messages share the index table, so their ids are spread out over even and odd row ids.
+# This way a document can always be found (and replaced) by its row id, without scanning the table.
+ROOM = 'room'
+MESSAGE = 'message'
+
+
+def document_id(kind, pk):
+    return pk * 2 if kind == ROOM else pk * 2 + 1
+
+
+# Splits the search text into lowercase words. Anything that is not a letter or a digit is thrown away,
+# so user input can never break the query syntax of the index.
+def parse_terms(q):
+    return re.findall(r'\w+', (q or '').lower())
+
+
+# The text of each column of a room document.
+def room_document(room):
+    return {
+        'name' : room.name or '',
+        'topic' : room.topic.name if room.topic_id else '',
+        'description' : room.description or '',
+        'body' : '',
+    }
+
+
+# The text of each column of a message document. Messages only fill in the body.
+def message_document(message):
+    return {'name' : '', 'topic' : '', 'description' : '', 'body' : message.body or ''}
+
+
+class SqliteSearchBackend:
+    # prefix='2 3' builds extra indexes for 2 and 3 letter prefixes, which makes search-as-you-type queries cheap.
+    CREATE_SQL = (
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {INDEX_TABLE} USING fts5("
+        "kind UNINDEXED, object_id UNINDEXED, room_id UNINDEXED, name, topic, description, body, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    )
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(self.CREATE_SQL)
+
+    def uninstall(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {INDEX_TABLE}')
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {INDEX_TABLE}')
+
+    # Adds or replaces the document of a room or a message.
+    def index(self, kind, pk, room_id, document):
+        rowid = document_id(kind, pk)
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {INDEX_TABLE} WHERE rowid = %s', [rowid])
+            cursor.execute(
+                f'INSERT INTO {INDEX_TABLE} (rowid, kind, object_id, room_id, name, topic, description, body) '
+                'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)',
+                [rowid, kind, pk, room_id, document['name'], document['topic'], document['description'], document['body']],
+            )
+
+    # Adds many new documents at once, used when the index is rebuilt. rows are (pk, room_id, document) tuples.
+    def add_many(self, kind, rows):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {INDEX_TABLE} (rowid, kind, object_id, room_id, name, topic, description, body) '
+                'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)',
+                [(document_id(kind, pk), kind, pk, room_id, document['name'], document['topic'], document['description'], document['body'])
+                 for pk, room_id, document in rows],
+            )
+
+    def remove(self, kind, pk):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {INDEX_TABLE} WHERE rowid = %s', [document_id(kind, pk)])
+
+    # Removes many documents at once, used when messages are archived.
+    def remove_many(self, kind, pks):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {INDEX_TABLE} WHERE rowid = %s', [(document_id(kind, pk),) for pk in pks])
+
+    # Moves many documents to another room, used when messages are moved (moderation.py).
+    def move_many(self, kind, pks, room_id):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(f'UPDATE {INDEX_TABLE} SET room_id = %s WHERE rowid = %s', [(room_id, document_id(kind, pk)) for pk in pks])
+
+    # Every word has to be in the document, and the last letters of every word may be missing (prefix matching).
+    def match(self, terms, column=None):
+        expression = ' '.join(f'"{term}"*' for term in terms)
+        return f'{column} : ({expression})' if column else expression
+
+    # Subquery with the ids of the rooms whose name, topic, description or messages match the words.
+    def room_ids_sql(self, terms):
+        return f'SELECT room_id FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH %s', [self.match(terms)]
+
+    # Subquery with the ids of the rooms whose topic matches the words.
+    def topic_room_ids_sql(self, terms):
+        return f'SELECT room_id FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH %s', [self.match(terms, 'topic')]
+
+    # Subquery with the ids of the messages whose body matches the words.
+    def message_ids_sql(self, terms):
+        return (
+            f"SELECT object_id FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH %s AND kind = '{MESSAGE}'",
+            [self.match(terms, 'body')],
+        )
+
+    # Room ids, best match first. bm25 gives lower scores to better matches.
+    # Name and topic matches count more than description and message matches.
+    # A room is ranked by its best document. bm25 can not be used inside GROUP BY, so it is computed in a subquery,
+    # which the LIMIT -1 keeps SQLite from merging into the outer query.
+    def rank_rooms(self, terms, limit):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT room_id FROM ('
+                f'SELECT room_id, bm25({INDEX_TABLE}, 0, 0, 0, 10.0, 5.0, 2.0, 1.0) AS score '
+                f'FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH %s LIMIT -1'
+                ') GROUP BY room_id ORDER BY MIN(score), room_id DESC LIMIT %s',
+                [self.match(terms), limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresSearchBackend:
+    # The 'simple' configuration does no stemming, so every word (in any language) is indexed as it is written.
+    CREATE_SQL = [
+        f'CREATE TABLE IF NOT EXISTS {INDEX_TABLE} ('
+        'id bigint PRIMARY KEY, kind varchar(10) NOT NULL, object_id bigint NOT NULL, room_id bigint NOT NULL, '
+        'document tsvector NOT NULL, topic tsvector NOT NULL)',
+        f'CREATE INDEX IF NOT EXISTS {INDEX_TABLE}_document ON {INDEX_TABLE} USING GIN (document)',
+        f'CREATE INDEX IF NOT EXISTS {INDEX_TABLE}_topic ON {INDEX_TABLE} USING GIN (topic)',
+    ]
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            for sql in self.CREATE_SQL:
+                cursor.execute(sql)
+
+    def uninstall(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {INDEX_TABLE}')
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'TRUNCATE {INDEX_TABLE}')
+
+    # Adds or replaces the document of a room or a message. The weights play the same role as the bm25 weights of SQLite.
+    def index(self, kind, pk, room_id, document):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {INDEX_TABLE} (id, kind, object_id, room_id, document, topic) VALUES ('
+                '%s, %s, %s, %s, '
+                "setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B') || "
+                "setweight(to_tsvector('simple', %s), 'C') || setweight(to_tsvector('simple', %s), 'D'), "
+                "to_tsvector('simple', %s)) "
+                'ON CONFLICT (id) DO UPDATE SET document = EXCLUDED.document, topic = EXCLUDED.topic, room_id = EXCLUDED.room_id',
+                [document_id(kind, pk), kind, pk, room_id, document['name'], document['topic'],
+                 document['description'], document['body'], document['topic']],
+            )
+
+    # Adds many new documents at once, used when the index is rebuilt. rows are (pk, room_id, document) tuples.
+    def add_many(self, kind, rows):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {INDEX_TABLE} (id, kind, object_id, room_id, document, topic) VALUES ('
+                '%s, %s, %s, %s, '
+                "setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B') || "
+                "setweight(to_tsvector('simple', %s), 'C') || setweight(to_tsvector('simple', %s), 'D'), "
+                "to_tsvector('simple', %s))",
+                [(document_id(kind, pk), kind, pk, room_id, document['name'], document['topic'],
+                  document['description'], document['body'], document['topic'])
+                 for pk, room_id, document in rows],
+            )
+
+    def remove(self, kind, pk):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {INDEX_TABLE} WHERE id = %s', [document_id(kind, pk)])
+
+    # Removes many documents at once, used when messages are archived.
+    def remove_many(self, kind, pks):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {INDEX_TABLE} WHERE id = ANY(%s)', [[document_id(kind, pk) for pk in pks]])
+
+    def move_many(self, kind, pks, room_id):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'UPDATE {INDEX_TABLE} SET room_id = %s WHERE id = ANY(%s)', [room_id, [document_id(kind, pk) for pk in pks]])
+
+    # Every word has to be in the document, and the last letters of every word may be missing (prefix matching).
+    def match(self, terms):
+        return ' & '.join(f'{term}:*' for term in terms)
+
+    def room_ids_sql(self, terms):
+        return f"SELECT room_id FROM {INDEX_TABLE} WHERE document @@ to_tsquery('simple', %s)", [self.match(terms)]
+
+    def topic_room_ids_sql(self, terms):
+        return f"SELECT room_id FROM {INDEX_TABLE} WHERE topic @@ to_tsquery('simple', %s)", [self.match(terms)]
+
+    def message_ids_sql(self, terms):
+        return (
+            f"SELECT object_id FROM {INDEX_TABLE} WHERE document @@ to_tsquery('simple', %s) AND kind = '{MESSAGE}'",
+            [self.match(terms)],
+        )
+
+    # Room ids, best match first. ts_rank gives higher scores to better matches.
+    def rank_rooms(self, terms, limit):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT room_id, MAX(ts_rank(document, to_tsquery('simple', %s))) AS score "
+                f"FROM {INDEX_TABLE} WHERE document @@ to_tsquery('simple', %s) "
+                'GROUP BY room_id ORDER BY score DESC, room_id DESC LIMIT %s',
+                [self.match(terms), self.match(terms), limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+BACKENDS = {
+    'sqlite' : SqliteSearchBackend,
+    'postgresql' : PostgresSearchBackend,
+}
+
+
+# Returns the search backend of a database, or None if the database has no full text search support.
+def get_backend(using='default'):
+    connection = connections[using]
+    backend = BACKENDS.get(connection.vendor)
+    return backend(connection) if backend else None
+
+
+# Adds or replaces the document of a room in the index.
+def index_room(room, using='default'):
+    backend = get_backend(using)
+    if backend:
+        backend.index(ROOM, room.id, room.id, room_document(room))
+
+
+# Adds or replaces the document of a message in the index.
+def index_message(message, using='default'):
+    backend = get_backend(using)
+    if backend:
+        backend.index(MESSAGE, message.id, message.room_id, message_document(message))
+
+
+def remove_room(pk, using='default'):
+    backend = get_backend(using)
+    if backend:
+        backend.remove(ROOM, pk)
+
+
+def remove_message(pk, using='default'):
+    backend = get_backend(using)
+    if backend:
+        backend.remove(MESSAGE, pk)
+
+
+# Archived messages are not searched, their documents are removed in bulk (see archive.py).
+def remove_messages(pks, using='default'):
+    backend = get_backend(using)
+    if backend and pks:
+        backend.remove_many(MESSAGE, pks)
+
+
+def move_messages(pks, room_id, using='default'):
+    backend = get_backend(using)
+    if backend and pks:
+        backend.move_many(MESSAGE, pks, room_id)
+
+
+# True when the search text can be ranked: the database has a search index, and the text has words.
+def can_rank(q, using='default'):
+    return get_backend(using) is not None and bool(parse_terms(q))
+
+
+# Room ids that match the search text, best match first.
+def rank_rooms(q, limit=50, using='default'):
+    backend = get_backend(using)
+    terms = parse_terms(q)
+    if backend is None or not terms:
+        return []
+    return backend.rank_rooms(terms, limit)
+
+
+# Empties the index and adds every room and message again, chunk_size documents at a time. Used by the rebuild_search_index command.
+def rebuild(using='default', chunk_size=2000):
+    from .models import Room, Message
+
+    backend = get_backend(using)
+    if backend is None:
+        return 0
+    backend.clear()
+    rooms = (
+        (room.id, room.id, room_document(room))
+        for room in Room.objects.using(using).select_related('topic').iterator(chunk_size=chunk_size)
+    )
+    messages = (
+        (message.id, message.room_id, message_document(message))
+        for message in Message.objects.using(using).only('id', 'room_id', 'body').iterator(chunk_size=chunk_size)
+    )
+    count = 0
+    for kind, rows in [(ROOM, rooms), (MESSAGE, messages)]:
+        for chunk in iter(lambda: list(islice(rows, chunk_size)), []):
+            backend.add_many(kind, chunk)
+            count += len(chunk)
+    return count
@@ -0,0 +1,280 @@
+from django.db import transaction
+from django.db.models import F, Q, DEFERRED
+from django.db.models.signals import post_init, post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from django.contrib.auth.models import User
+from .models import Room, Topic, Message, Avatar, ActivityEvent
+from . import search, realtime, auth, timeline, trending, autocomplete
+from .cache import bump_topics_version, bump_page_versions, room_version_key, GLOBAL_VERSION
+
+# Signal handlers that keep derived data (like the search index and the stored counters) in sync with the models.
+# They are connected in BaseConfig.ready() (apps.py).
+
+
+# Re-indexes a room every time it is created or edited.
+@receiver(post_save, sender=Room)
+def indexRoom(sender, instance, using, **kwargs):
+    search.index_room(instance, using=using)
+
+
+@receiver(post_delete, sender=Room)
+def unindexRoom(sender, instance, using, **kwargs):
+    search.remove_room(instance.id, using=using)
+
+
+@receiver(post_save, sender=Message)
+def indexMessage(sender, instance, using, **kwargs):
+    search.index_message(instance, using=using)
+
+
+@receiver(post_delete, sender=Message)
+def unindexMessage(sender, instance, using, **kwargs):
+    search.remove_message(instance.id, using=using)
+
+
+# The topic name is part of the document of every room in the topic, so those rooms are re-indexed when it changes.
+@receiver(post_save, sender=Topic)
+def reindexTopicRooms(sender, instance, created, using, **kwargs):
+    if created:
+        return
+    for room in instance.room_set.using(using).select_related('topic'):
+        search.index_room(room, using=using)
+
+
+# When a topic is deleted its rooms lose their topic (SET_NULL), without a save signal.
+# The ids of the rooms are remembered before the delete, so they can be re-indexed after it.
+@receiver(pre_delete, sender=Topic)
+def rememberTopicRooms(sender, instance, using, **kwargs):
+    instance._room_ids = list(instance.room_set.using(using).values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Topic)
+def reindexOrphanedRooms(sender, instance, using, **kwargs):
+    for room in Room.objects.using(using).filter(id__in=getattr(instance, '_room_ids', [])):
+        search.index_room(room, using=using)
+
+
+# Counters
+# Room.participant_count, Room.message_count and Topic.room_count are changed with F() expressions,
+# so the database does the +1/-1 itself and two requests at the same time can never overwrite each other's count.
+# A counter is never decremented below zero. If a counter drifts anyway (rows written without signals), the recount command repairs it.
+def changeCount(queryset, field, amount):
+    if amount > 0:
+        queryset.update(**{field : F(field) + amount})
+    elif amount < 0:
+        queryset.filter(**{f'{field}__gte' : -amount}).update(**{field : F(field) + amount})
+
+
+# Remembers the topic a room was loaded with, to find out later if the topic was changed.
+@receiver(post_init, sender=Room)
+def rememberTopic(sender, instance, **kwargs):
+    instance._loaded_topic_id = instance.__dict__.get('topic_id', DEFERRED)
+
+
+@receiver(post_save, sender=Room)
+def countTopicRooms(sender, instance, created, using, **kwargs):
+    topics = Topic.objects.using(using)
+    old_topic_id = None if created else instance._loaded_topic_id
+    if old_topic_id is DEFERRED:
+        # The room was loaded without its topic (.only()/.defer()), so it is not known if the topic changed.
+        return
+    if instance.topic_id != old_topic_id:
+        # The room moved to another topic (for example in updateRoom), or is new.
+        if old_topic_id:
+            changeCount(topics.filter(id=old_topic_id), 'room_count', -1)
+            countSuggestedTopic(old_topic_id, -1, using)
+        if instance.topic_id:
+            changeCount(topics.filter(id=instance.topic_id), 'room_count', 1)
+            countSuggestedTopic(instance.topic_id, 1, using)
+        if old_topic_id or instance.topic_id:
+            # The room counts of the topic sidebar changed.
+            bump_topics_version()
+    instance._loaded_topic_id = instance.topic_id
+
+
+@receiver(post_delete, sender=Room)
+def uncountTopicRoom(sender, instance, using, **kwargs):
+    if instance.topic_id:
+        changeCount(Topic.objects.using(using).filter(id=instance.topic_id), 'room_count', -1)
+        countSuggestedTopic(instance.topic_id, -1, using)
+        bump_topics_version()
+
+
+@receiver(post_save, sender=Message)
+def countRoomMessage(sender, instance, created, using, **kwargs):
+    if created:
+        changeCount(Room.objects.using(using).filter(id=instance.room_id), 'message_count', 1)
+
+
+@receiver(post_delete, sender=Message)
+def uncountRoomMessage(sender, instance, using, **kwargs):
+    changeCount(Room.objects.using(using).filter(id=instance.room_id), 'message_count', -1)
+
+
+# room.participants.add/remove/clear and the reverse user.participants.add/remove/clear.
+# pk_set only holds the rows that were really added or removed, so adding an existing participant again changes nothing.
+@receiver(m2m_changed, sender=Room.participants.through)
+def countParticipants(sender, instance, action, reverse, pk_set, using, **kwargs):
+    rooms = Room.objects.using(using)
+    if action == 'pre_clear' and reverse:
+        # The user is removed from all of their rooms, the ids of those rooms are needed after the clear.
+        instance._cleared_room_ids = list(instance.participants.using(using).values_list('id', flat=True))
+    elif action == 'post_clear':
+        if reverse:
+            changeCount(rooms.filter(id__in=instance._cleared_room_ids), 'participant_count', -1)
+        else:
+            rooms.filter(id=instance.id).update(participant_count=0)
+    elif action in ('post_add', 'post_remove') and pk_set:
+        sign = 1 if action == 'post_add' else -1
+        if reverse:
+            # instance is a user, pk_set are the ids of the rooms.
+            changeCount(rooms.filter(id__in=pk_set), 'participant_count', sign)
+        else:
+            changeCount(rooms.filter(id=instance.id), 'participant_count', sign * len(pk_set))
+
+
+# Real-time chat
+# The delta of a new or deleted message is published on the channel of its room once the transaction is committed,
+# so browsers never see a message that was rolled back. It is only built then, and only for a room somebody watches.
+@receiver(post_save, sender=Message)
+def publishMessage(sender, instance, created, using, **kwargs):
+    if created:
+        transaction.on_commit(lambda: realtime.publish_to_room(instance.room_id, lambda: realtime.message_delta(instance)), using=using)
+
+
+@receiver(post_delete, sender=Message)
+def publishDeletedMessage(sender, instance, using, **kwargs):
+    transaction.on_commit(lambda: realtime.publish_to_room(instance.room_id, lambda: realtime.message_deleted_delta(instance)), using=using)
+
+
+# Trending scores (see trending.py): a new message or participant adds to the score of the room and its topic.
+@receiver(post_save, sender=Message)
+def scoreMessage(sender, instance, created, using, **kwargs):
+    if created:
+        trending.record(instance.room_id, messages=1, using=using)
+
+
+@receiver(m2m_changed, sender=Room.participants.through)
+def scoreParticipants(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if action != 'post_add' or not pk_set:
+        return
+    if reverse:
+        # instance is a user, pk_set are the ids of the rooms.
+        for room_id in pk_set:
+            trending.record(room_id, participants=1, using=using)
+    else:
+        trending.record(instance.id, participants=len(pk_set), using=using)
+
+
+# Activity timelines (see timeline.py)
+@receiver(post_save, sender=Message)
+def addActivityEvents(sender, instance, created, using, **kwargs):
+    if created:
+        timeline.add_events([instance], using=using)
+
+
+@receiver(post_delete, sender=Message)
+def removeActivityEvents(sender, instance, using, **kwargs):
+    timeline.remove_events([instance.id], using=using)
+
+
+# The events show the names of the room and the author, they are updated when these change.
+@receiver(post_save, sender=Room)
+def renameRoomEvents(sender, instance, created, using, **kwargs):
+    if not created:
+        ActivityEvent.objects.using(using).filter(room_id=instance.id).exclude(room_name=instance.name).update(room_name=instance.name)
+
+
+# Remembers the username a user was loaded with, to find out later if it was changed.
+@receiver(post_init, sender=User)
+def rememberUsername(sender, instance, **kwargs):
+    instance._loaded_username = instance.__dict__.get('username')
+
+
+@receiver(post_save, sender=User)
+def renameUserEvents(sender, instance, created, using, update_fields, **kwargs):
+    # Logging in saves the user with update_fields=['last_login'].
+    if created or (update_fields and 'username' not in update_fields) or instance.username == instance._loaded_username:
+        return
+    instance._loaded_username = instance.username
+    ActivityEvent.objects.using(using).filter(user_id=instance.id).exclude(username=instance.username).update(username=instance.username)
+    # The username is shown with the rooms of the host and the messages of the author (pages and API).
+    rooms = Room.all_objects.using(using).filter(Q(host_id=instance.id) | Q(participants=instance.id))
+    invalidateRoomPages(set(rooms.values_list('id', flat=True)))
+
+
+# Topic autocomplete
+# The index of the process (autocomplete.py) follows the topics and their room counts, once the change is committed.
+@receiver(post_save, sender=Topic)
+def suggestTopic(sender, instance, using, **kwargs):
+    pk, name, weight = instance.id, instance.name, instance.room_count
+    transaction.on_commit(lambda: autocomplete.topic_saved(pk, name, weight), using=using)
+
+
+@receiver(post_delete, sender=Topic)
+def unsuggestTopic(sender, instance, using, **kwargs):
+    pk = instance.id
+    transaction.on_commit(lambda: autocomplete.topic_deleted(pk), using=using)
+
+
+def countSuggestedTopic(topic_id, amount, using):
+    transaction.on_commit(lambda: autocomplete.topic_counted(topic_id, amount), using=using)
+
+
+# Fragment cache
+# The topic sidebar (names and room counts of every topic) is invalidated by bumping the topic-list version (see cache.py):
+# here when a topic changes, and by countTopicRooms/uncountTopicRoom when a room comes, goes or changes topic.
+# Room cards and activity items are keyed on their own `updated` timestamp (and the name of the room's topic), so they need no signal.
+@receiver(post_save, sender=Topic)
+@receiver(post_delete, sender=Topic)
+def invalidateTopicFragments(sender, **kwargs):
+    bump_topics_version()
+
+
+# Page cache
+# Bumps the version stamps of the cached anonymous pages (see cache.py) that show the changed data:
+# the feed pages (global stamp) and the page of the room.
+def invalidateRoomPages(room_ids):
+    bump_page_versions([GLOBAL_VERSION] + [room_version_key(room_id) for room_id in room_ids])
+
+
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+def invalidateRoomPage(sender, instance, **kwargs):
+    invalidateRoomPages([instance.id])
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def invalidateMessagePages(sender, instance, **kwargs):
+    invalidateRoomPages([instance.room_id])
+
+
+@receiver(m2m_changed, sender=Room.participants.through)
+def invalidateParticipantPages(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        # For user.participants changes the rooms are in pk_set, or unknown after a clear (only the feed pages are bumped then).
+        invalidateRoomPages((pk_set or []) if reverse else [instance.id])
+
+
+# A topic name is shown on the page of every room in the topic.
+@receiver(post_save, sender=Topic)
+@receiver(post_delete, sender=Topic)
+def invalidateTopicPages(sender, instance, **kwargs):
+    invalidateRoomPages(getattr(instance, '_room_ids', None) or instance.room_set.values_list('id', flat=True))
+
+
+# Logged in users are cached (see auth.py), a saved or deleted user is dropped from the cache.
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forgetCachedUser(sender, instance, **kwargs):
+    auth.forget_user(instance.id)
+
+
+# A new avatar is shown on the pages of the rooms the user hosts or posted in, and in the navbar (cached user).
+@receiver(post_save, sender=Avatar)
+def invalidateAvatarPages(sender, instance, **kwargs):
+    auth.forget_user(instance.user_id)
+    room_ids = set(Room.objects.filter(host_id=instance.user_id).values_list('id', flat=True))
+    room_ids.update(instance.user.participants.values_list('id', flat=True))
+    invalidateRoomPages(room_ids)
@@ -0,0 +1,135 @@
+import gzip
+import json
+import mimetypes
+import os
+import re
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+# Optional: pip install brotli, for the .br variants (smaller than gzip, and every current browser accepts them).
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Static files pipeline for production.
+#
+# python manage.py collectstatic copies the files of static/ to STATIC_ROOT, and with this storage:
+#   - every file also gets a copy with the hash of its content in the name (style.css -> style.1a2b3c4d5e6f.css),
+#     and {% static %} links to that copy. A changed file gets a new name, so the old one can be cached forever.
+#     The names are listed in STATIC_ROOT/staticfiles.json (the manifest).
+#   - the text files (css, js, svg...) get a gzip (.gz) and a brotli (.br) variant next to them, compressed once at
+#     deploy time with the highest levels instead of on every request.
+#
+# StaticFilesMiddleware (middleware.py) then serves STATIC_ROOT from the Python process: the hashed files with a
+# Cache-Control of one year and "immutable" (the browser never asks again), the compressed variant the browser accepts,
+# and a FileResponse, which WSGI servers send with sendfile() (wsgi.file_wrapper) without copying it through Python.
+# In development (DEBUG) nothing changes: runserver serves static/ directly and {% static %} uses the plain names.
+# The avatars (MEDIA_ROOT/avatars, see avatars.py) are served the same way: their names are content hashes too.
+
+COMPRESSED_EXTENSIONS = {'.css', '.js', '.svg', '.html', '.txt', '.json', '.xml', '.map', '.ico'}
+
+# (Accept-Encoding token, file suffix), best first.
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# Seconds the files without a hash in their name may be cached.
+DEFAULT_MAX_AGE = 60
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def compress(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data, quality=11)))
+    for suffix, compressed in variants:
+        # Not worth it for tiny or already compressed files, the browser gets the original then.
+        if len(compressed) < len(data) * 0.95:
+            with open(path + suffix, 'wb') as file:
+                file.write(compressed)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        # The originals and the hashed copies are both compressed: both can be requested.
+        for name in set(paths) | set(self.hashed_files.values()):
+            if os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS and self.exists(name):
+                compress(self.path(name))
+
+    # Files that were not collected (development, tests) are linked with their plain name instead of failing the page.
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+
+# A file that StaticFilesMiddleware can serve.
+class StaticFile:
+    def __init__(self, path, immutable):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.cache_control = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable' if immutable else f'public, max-age={DEFAULT_MAX_AGE}'
+        # Accept-Encoding token -> path of the compressed variant.
+        self.variants = {encoding : path + suffix for encoding, suffix in ENCODINGS if os.path.exists(path + suffix)}
+
+    # The path and Content-Encoding (None for the original) of the best variant the browser accepts.
+    def choose(self, accept_encoding):
+        accepted = {token.split(';')[0].strip() for token in accept_encoding.lower().split(',')}
+        for encoding, _ in ENCODINGS:
+            if encoding in accepted and encoding in self.variants:
+                return self.variants[encoding], encoding
+        return self.path, None
+
+
+# Lists the collected files of STATIC_ROOT once: {url path under STATIC_URL : StaticFile}.
+# Returns None when collectstatic was not run (no manifest), the middleware then does nothing.
+# Requests are looked up in this dict, so a path that is not a collected file (../settings.py...) is never opened.
+def build_index(root=None):
+    root = str(root or getattr(settings, 'STATIC_ROOT', None) or '')
+    manifest = os.path.join(root, 'staticfiles.json')
+    if not root or not os.path.exists(manifest):
+        return None
+    with open(manifest) as file:
+        hashed = set(json.load(file).get('paths', {}).values())
+    index = {}
+    for directory, _, names in os.walk(root):
+        for filename in names:
+            if filename.endswith(('.gz', '.br')) or filename == 'staticfiles.json':
+                continue
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, root).replace(os.sep, '/')
+            index[name] = StaticFile(path, name in hashed)
+    return index
+
+
+# Names of the avatar thumbnails (avatars.avatar_name). Only these are served from MEDIA_ROOT.
+AVATAR_NAME = re.compile(r'avatars/[0-9a-f]{2}/[0-9a-f]{64}-[a-z]+\.webp')
+
+# name -> StaticFile of the avatars served so far. The files never change, so they are looked up on the disk once.
+_avatars = {}
+MAX_AVATARS = 10000
+
+
+# The StaticFile of an avatar thumbnail (name under MEDIA_URL), or None when there is no such avatar.
+def avatar_file(name):
+    if not AVATAR_NAME.fullmatch(name):
+        return None
+    static_file = _avatars.get(name)
+    if static_file is None:
+        path = os.path.join(settings.MEDIA_ROOT, name)
+        if not os.path.isfile(path):
+            return None
+        if len(_avatars) >= MAX_AVATARS:
+            _avatars.clear()
+        static_file = _avatars[name] = StaticFile(path, immutable=True)
+    return static_file
@@ -0,0 +1,92 @@
+import contextvars
+import uuid
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+# Streamed pages.
+# render() builds the whole page in memory before the first byte is sent, so with a long room thread both the time to
+# the first byte and the memory of the request grow with the thread.
+#
+# stream_page() sends the page in parts instead. The template is rendered once with a marker in place of every long
+# list ({{ stream.messages }} in room.html), and the html before the first marker (the header, the room details...)
+# is sent right away, so the browser starts loading the css and drawing the page. Then every list is rendered and sent
+# piece by piece by its generator, which reads the rows with .iterator(chunk_size) (a server-side cursor on PostgreSQL,
+# fetchmany() on SQLite): only one chunk of rows is in memory at a time. Then the rest of the page.
+#
+# Works under wsgi.py (the server writes every part as it comes) and asgi.py (the parts are made in the thread of the
+# view, see aiterate). The queries of the streamed parts run after the view has returned, so InstrumentationMiddleware
+# does not count them.
+#
+# Settings (settings.STREAMING_PAGES, all optional):
+#   ENABLED        stream the room and profile pages of logged in users. The anonymous pages are cached whole
+#                  (cache.anonymous_page_cache) and are always rendered with render().
+#   CHUNK_SIZE     number of rows read from the database and rendered per part.
+#   ROOM_MESSAGES  number of messages on a streamed room page (ROOM_PAGE_SIZE otherwise), older ones are behind
+#                  the "older messages" link.
+
+DEFAULTS = {
+    'ENABLED' : True,
+    'CHUNK_SIZE' : 100,
+    'ROOM_MESSAGES' : 500,
+}
+
+
+def get_settings():
+    return {**DEFAULTS, **getattr(settings, 'STREAMING_PAGES', {})}
+
+
+# Lists of up to chunk_size rows of the queryset, read from the database chunk_size rows at a time.
+def chunks(queryset, chunk_size):
+    chunk = []
+    for row in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Renders template_name with context, except the lists of `parts` (name -> generator of html strings), which are
+# streamed where the template outputs {{ stream.<name> }}.
+def stream_page(request, template_name, context, parts):
+    markers = {name : mark_safe(f'<!--stream:{name}:{uuid.uuid4().hex}-->') for name in parts}
+    page = render_to_string(template_name, {**context, 'stream' : markers}, request)
+
+    def content():
+        rest = page
+        for name, part in parts.items():
+            before, _, rest = rest.partition(markers[name])
+            yield before
+            yield from part
+        yield rest
+
+    iterator = in_context(content())
+    if isinstance(request, ASGIRequest):
+        # The ASGI handler reads a plain iterator to the end before sending anything.
+        iterator = aiterate(iterator)
+    response = StreamingHttpResponse(iterator, content_type='text/html; charset=utf-8')
+    # Proxies like nginx buffer responses by default, which would hold the first part back.
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# The parts are made after the view has returned, but with the context variables the view saw
+# (routers.read_from_primary after a POST...).
+def in_context(iterator):
+    context = contextvars.copy_context()
+    done = object()
+    return iter(lambda: context.run(next, iterator, done), done)
+
+
+# Async iterator over a sync iterator, advanced one part at a time in the thread of the view
+# (thread_sensitive), which owns the database connection and the open cursor.
+async def aiterate(iterator):
+    done = object()
+    advance = sync_to_async(next, thread_sensitive=True)
+    while (part := await advance(iterator, done)) is not done:
+        yield part
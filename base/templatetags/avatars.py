@@ -0,0 +1,10 @@
+from django import template
+from base.avatars import avatar_url
+
+register = template.Library()
+
+
+# {% load avatars %} <img src="{{ message.user|avatar:'small' }}" />
+@register.filter
+def avatar(user, size='small'):
+    return avatar_url(user, size)
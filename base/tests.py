@@ -1,3 +1,1462 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import re
+import tempfile
+import unittest.mock
+from datetime import timedelta
+from pathlib import Path
+from io import BytesIO, StringIO
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.templatetags.static import static
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.http import http_date
+from django.contrib.auth.models import User
+from django.utils import timezone
+from .models import Room, Topic, Message, ArchivedMessage, Avatar, ActivityEvent, PageVersion
+from .pagination import FEED_PAGE_SIZE, ROOM_PAGE_SIZE, KEYSET_ORDERING, paginate, EstimatedCountPaginator
+from .admin import MessageAdmin
+from .views import filterRooms, filterActivity
+from .consumers import websocketRouter
+from .ingest import MessageIngestor, IngestQueueFull, get_ingestor, write_batch
+from . import search, realtime, instrumentation, deletion, avatars, timeline, trending, autocomplete, checks, archive
+from .cache import cache_stats, topics_version, room_version_key
+from .middleware import StaticFilesMiddleware
 
 # Create your tests here.
+
+# The query problems of every test request would be logged, InstrumentationTests checks them with assertLogs.
+logging.getLogger('base.instrumentation').setLevel(logging.ERROR)
+
+
+# The caches live in memory for the whole test run, so every test starts with empty ones.
+def clear_caches():
+    for cache in caches.all():
+        cache.clear()
+
+
+# Helper that creates `count` rooms (each with a topic, a participant and a message) in a few bulk queries.
+def make_rooms(user, count, offset=0):
+    # bulk_create skips the signals, so the stored counters and the activity events are set by hand.
+    topics = Topic.objects.bulk_create(
+        [Topic(name=f'topic {offset + i}', room_count=1) for i in range(count)]
+    )
+    rooms = Room.objects.bulk_create(
+        [Room(host=user, topic=topic, name=f'room {offset + i}', participant_count=1, message_count=1)
+         for i, topic in enumerate(topics)]
+    )
+    Room.participants.through.objects.bulk_create(
+        [Room.participants.through(room_id=room.id, user_id=user.id) for room in rooms]
+    )
+    timeline.add_events(Message.objects.bulk_create(
+        [Message(user=user, room=room, body='hello') for room in rooms]
+    ))
+    return rooms
+
+
+# Makes sure the feed pages run a fixed number of queries, no matter how many rooms, topics and messages there are.
+class FeedQueryCountTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+
+    # Renders the page at `url` without cached fragments, and returns how many queries it ran.
+    def count_queries(self, url):
+        clear_caches()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_home_query_count_is_constant(self):
+        make_rooms(self.user, 10)
+        small = self.count_queries(reverse('home'))
+        make_rooms(self.user, 1000, offset=10)
+        large = self.count_queries(reverse('home'))
+        self.assertEqual(small, large)
+
+    def test_profile_query_count_is_constant(self):
+        url = reverse('user-profile', args=[self.user.id])
+        make_rooms(self.user, 10)
+        small = self.count_queries(url)
+        make_rooms(self.user, 1000, offset=10)
+        large = self.count_queries(url)
+        self.assertEqual(small, large)
+
+
+# Makes sure the keyset pages of the room feed and the activity stream cover every row exactly once.
+class FeedPaginationTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        make_rooms(self.user, 45)
+
+    def test_pages_walk_every_room_once(self):
+        seen = []
+        cursor = None
+        while True:
+            rooms, cursor = paginate(Room.objects.for_feed(), cursor)
+            seen.extend(room.id for room in rooms)
+            if cursor is None:
+                break
+        self.assertEqual(len(seen), 45)
+        self.assertEqual(set(seen), set(Room.objects.values_list('id', flat=True)))
+
+    def test_home_renders_first_page_only(self):
+        response = self.client.get(reverse('home'))
+        self.assertEqual(len(response.context['rooms']), FEED_PAGE_SIZE)
+        self.assertEqual(len(response.context['room_messages']), FEED_PAGE_SIZE)
+        self.assertEqual(response.context['room_count'], 45)
+        self.assertIsNotNone(response.context['rooms_next_url'])
+
+    def test_load_more_endpoints_return_next_page(self):
+        response = self.client.get(reverse('home'))
+        next_rooms = self.client.get(response.context['rooms_next_url'])
+        next_messages = self.client.get(response.context['messages_next_url'])
+        self.assertEqual(next_rooms.status_code, 200)
+        self.assertEqual(next_messages.status_code, 200)
+        first_ids = {room.id for room in response.context['rooms']}
+        next_ids = {room.id for room in next_rooms.context['rooms']}
+        self.assertEqual(len(next_ids), FEED_PAGE_SIZE)
+        self.assertFalse(first_ids & next_ids)
+
+    def test_deep_page_query_count_is_constant(self):
+        cursor = paginate(Room.objects.all(), size=1)[1]
+        deep_cursor = paginate(Room.objects.all(), size=40)[1]
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(reverse('load-rooms'), {'cursor': cursor})
+        with CaptureQueriesContext(connection) as deep:
+            self.client.get(reverse('load-rooms'), {'cursor': deep_cursor})
+        self.assertEqual(len(first), len(deep))
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(reverse('load-rooms'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+
+# Makes sure the full text search index follows the Room, Topic and Message tables.
+class SearchIndexTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.topic = Topic.objects.create(name='Python')
+        self.room = Room.objects.create(host=self.user, topic=self.topic, name='Lets learn together', description='Beginner friendly')
+        self.other = Room.objects.create(host=self.user, name='Design with me', description='Figma and python tips')
+
+    def search_rooms(self, q):
+        return set(room.id for room in filterRooms(q))
+
+    def test_prefix_matching_on_name_topic_and_description(self):
+        self.assertEqual(self.search_rooms('learn'), {self.room.id})
+        self.assertEqual(self.search_rooms('beginn'), {self.room.id})
+        self.assertEqual(self.search_rooms('pyth'), {self.room.id, self.other.id})
+        self.assertEqual(self.search_rooms('nothing-like-this'), set())
+
+    def test_message_body_search(self):
+        message = Message.objects.create(user=self.user, room=self.other, body='Anyone up for calculus?')
+        self.assertEqual(self.search_rooms('calc'), {self.other.id})
+        self.assertEqual([event.message_id for event in filterActivity('calculus')], [message.id])
+        message.delete()
+        self.assertEqual(self.search_rooms('calc'), set())
+
+    def test_topic_rename_and_delete_reindex_rooms(self):
+        self.topic.name = 'Rust'
+        self.topic.save()
+        self.assertEqual(self.search_rooms('rust'), {self.room.id})
+        self.topic.delete()
+        self.assertEqual(self.search_rooms('rust'), set())
+
+    def test_deleted_room_is_removed(self):
+        self.room.delete()
+        self.assertEqual(self.search_rooms('learn'), set())
+
+    def test_ranked_results(self):
+        # A match in the room name ranks above a match in the description.
+        self.assertEqual(search.rank_rooms('python'), [self.room.id, self.other.id])
+
+    def test_rebuild_command_indexes_bulk_created_rows(self):
+        make_rooms(self.user, 3, offset=100)
+        self.assertEqual(self.search_rooms('room'), set())
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(len(self.search_rooms('room')), 3)
+
+    def test_home_search_uses_index(self):
+        response = self.client.get(reverse('home'), {'q': 'learn'})
+        self.assertEqual([room.id for room in response.context['rooms']], [self.room.id])
+        self.assertEqual(response.context['room_count'], 1)
+
+    def test_home_search_is_ranked(self):
+        # The best match comes first, although the other room is newer. ?sort=latest gives the newest first.
+        response = self.client.get(reverse('home'), {'q': 'python'})
+        self.assertEqual(response.context['sort'], 'relevance')
+        self.assertEqual([room.id for room in response.context['rooms']], [self.room.id, self.other.id])
+        response = self.client.get(reverse('home'), {'q': 'python', 'sort': 'latest'})
+        self.assertEqual([room.id for room in response.context['rooms']], [self.other.id, self.room.id])
+        # The "load more" pages carry on from the position in the ranking.
+        response = self.client.get(reverse('load-rooms'), {'q': 'python', 'sort': 'relevance', 'cursor': '1'})
+        self.assertEqual([room.id for room in response.context['rooms']], [self.other.id])
+        for cursor in ['-1', 'x', '1.5']:
+            response = self.client.get(reverse('load-rooms'), {'q': 'python', 'sort': 'relevance', 'cursor': cursor})
+            self.assertEqual(response.status_code, 400)
+
+
+# Makes sure the queries of the feed and room pages are answered by an index, without sorting in a temporary B-tree.
+class QueryPlanTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.room = make_rooms(self.user, 5)[0]
+
+    # Returns the EXPLAIN QUERY PLAN output of a queryset as one string.
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' | '.join(row[-1] for row in cursor.fetchall())
+
+    def assertUsesIndex(self, queryset, index):
+        plan = self.query_plan(queryset)
+        self.assertIn(index, plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_room_messages_use_index(self):
+        self.assertUsesIndex(self.room.message_set.all(), 'message_room_recent_idx')
+
+    def test_user_messages_use_index(self):
+        self.assertUsesIndex(self.user.message_set.all(), 'message_user_recent_idx')
+
+    def test_rooms_of_topic_use_index(self):
+        self.assertIn('room_topic_recent_idx', self.query_plan(Room.objects.filter(topic_id=self.room.topic_id)))
+
+    def test_feed_pages_use_index(self):
+        self.assertUsesIndex(Room.objects.order_by(*KEYSET_ORDERING)[:FEED_PAGE_SIZE + 1], 'room_recent_idx')
+        self.assertUsesIndex(Message.objects.order_by(*KEYSET_ORDERING)[:FEED_PAGE_SIZE + 1], 'message_recent_idx')
+        self.assertUsesIndex(Room.objects.filter(host=self.user).order_by(*KEYSET_ORDERING), 'room_host_recent_idx')
+
+    def test_topic_lookup_by_name_uses_index(self):
+        plan = self.query_plan(Topic.objects.filter(name='topic 1'))
+        self.assertRegex(plan, r'SEARCH base_topic USING (COVERING )?INDEX')
+
+
+# Makes sure the stored counters follow the participants, messages and rooms, and that the recount command repairs them.
+class CounterTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.other_user = User.objects.create_user(username='guest', password='secret-password')
+        self.python = Topic.objects.create(name='Python')
+        self.design = Topic.objects.create(name='Design')
+        self.room = Room.objects.create(host=self.user, topic=self.python, name='Lets learn python')
+
+    def assertCounts(self, participants, messages, python_rooms, design_rooms):
+        self.room.refresh_from_db()
+        self.python.refresh_from_db()
+        self.design.refresh_from_db()
+        self.assertEqual(
+            (self.room.participant_count, self.room.message_count, self.python.room_count, self.design.room_count),
+            (participants, messages, python_rooms, design_rooms),
+        )
+
+    def test_participants_and_messages(self):
+        self.room.participants.add(self.user)
+        self.room.participants.add(self.user)
+        self.other_user.participants.add(self.room)
+        message = Message.objects.create(user=self.user, room=self.room, body='hello')
+        Message.objects.create(user=self.other_user, room=self.room, body='hi')
+        self.assertCounts(2, 2, 1, 0)
+        message.delete()
+        self.room.participants.remove(self.user)
+        self.assertCounts(1, 1, 1, 0)
+        self.other_user.participants.clear()
+        self.assertCounts(0, 1, 1, 0)
+
+    def test_room_post_counts_participant_and_message(self):
+        self.client.force_login(self.other_user)
+        self.client.post(reverse('room', args=[self.room.id]), {'body': 'hello'})
+        self.client.post(reverse('room', args=[self.room.id]), {'body': 'again'})
+        self.assertCounts(1, 2, 1, 0)
+
+    def test_topic_reassignment_and_room_delete(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('update-room', args=[self.room.id]), {'topic': 'Design', 'name': 'Renamed', 'description': ''})
+        self.assertCounts(0, 0, 0, 1)
+        self.room.delete()
+        self.design.refresh_from_db()
+        self.assertEqual(self.design.room_count, 0)
+
+    def test_recount_repairs_drift(self):
+        self.room.participants.add(self.user)
+        Message.objects.create(user=self.user, room=self.room, body='hello')
+        Room.objects.update(participant_count=7, message_count=0)
+        Topic.objects.update(room_count=3)
+        call_command('recount', stdout=StringIO())
+        self.assertCounts(1, 1, 1, 0)
+
+    def test_feed_pages_do_not_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('home'))
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql'] and 'participants' in query['sql']])
+
+
+# The deltas are only built for rooms with subscribers, and a broker must implement the whole interface.
+class BrokerTests(TestCase):
+    def setUp(self):
+        realtime.set_broker(realtime.LocalBroker())
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.room = Room.objects.create(host=self.user, name='Nobody here')
+
+    def tearDown(self):
+        realtime.set_broker(None)
+
+    def test_no_delta_without_subscribers(self):
+        with unittest.mock.patch('base.realtime.message_delta') as message_delta:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.room.post_message(self.user, 'hello')
+        message_delta.assert_not_called()
+
+    def test_incomplete_broker_is_refused(self):
+        class PublishOnlyBroker(realtime.Broker):
+            def publish(self, channel, data):
+                pass
+
+        with self.assertRaises(TypeError):
+            PublishOnlyBroker()
+
+
+# Makes sure the WebSocket room chat saves the messages and sends the deltas to the connected browsers.
+# TransactionTestCase, because the deltas are only published once the transaction is committed.
+class RoomChatTests(TransactionTestCase):
+    def setUp(self):
+        realtime.set_broker(realtime.LocalBroker())
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.room = Room.objects.create(host=self.user, name='Lets chat')
+        self.client.force_login(self.user)
+        self.session_cookie = f'{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}'
+
+    def connect(self, path=None, cookie='', origin='http://testserver'):
+        headers = [(b'host', b'testserver'), (b'origin', origin.encode()), (b'cookie', cookie.encode())]
+        scope = {'type': 'websocket', 'path': path or f'/ws/room/{self.room.id}/', 'headers': headers}
+        return ApplicationCommunicator(websocketRouter(None), scope)
+
+    async def open(self, communicator):
+        await communicator.send_input({'type': 'websocket.connect'})
+        return await communicator.receive_output(timeout=5)
+
+    async def test_posting_saves_and_broadcasts_message(self):
+        sender = self.connect(cookie=self.session_cookie)
+        reader = self.connect()
+        self.assertEqual((await self.open(sender))['type'], 'websocket.accept')
+        self.assertEqual((await self.open(reader))['type'], 'websocket.accept')
+        await sender.send_input({'type': 'websocket.receive', 'text': json.dumps({'body': 'hello there'})})
+        for communicator in (sender, reader):
+            delta = json.loads((await communicator.receive_output(timeout=5))['text'])
+            self.assertEqual((delta['type'], delta['body'], delta['user']['username']), ('message', 'hello there', 'host'))
+        message = await Message.objects.aget(room=self.room)
+        self.assertEqual(message.body, 'hello there')
+        self.assertTrue(await self.room.participants.filter(id=self.user.id).aexists())
+        for communicator in (sender, reader):
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(timeout=5)
+
+    async def test_anonymous_reader_can_not_post(self):
+        reader = self.connect()
+        await self.open(reader)
+        await reader.send_input({'type': 'websocket.receive', 'text': json.dumps({'body': 'hi'})})
+        self.assertEqual(json.loads((await reader.receive_output(timeout=5))['text'])['type'], 'error')
+        self.assertFalse(await Message.objects.aexists())
+        await reader.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await reader.wait(timeout=5)
+
+    async def test_refused_connections(self):
+        self.assertEqual((await self.open(self.connect(path='/ws/room/999/')))['code'], 4404)
+        self.assertEqual((await self.open(self.connect(origin='http://evil.example')))['code'], 4403)
+
+
+# Makes sure batched ingestion writes the same rows and counters as the direct path, and refuses messages when full.
+class IngestTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.other_user = User.objects.create_user(username='guest', password='secret-password')
+        self.room = Room.objects.create(host=self.user, name='Busy room')
+
+    def test_write_batch_deduplicates_participants(self):
+        self.room.participants.add(self.user)
+        write_batch([
+            Message(room=self.room, user=self.user, body='one'),
+            Message(room=self.room, user=self.other_user, body='two'),
+            Message(room=self.room, user=self.other_user, body='three'),
+        ])
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.message_count, self.room.participant_count), (3, 2))
+        self.assertEqual(self.room.participants.count(), 2)
+        self.assertEqual([room.id for room in filterRooms('three')], [self.room.id])
+
+    def test_full_queue_refuses_messages(self):
+        ingestor = MessageIngestor(batch_size=10, max_latency=0, max_queue=1, block_timeout=0, background=False)
+        ingestor.submit(self.room, self.user, 'first')
+        with self.assertRaises(IngestQueueFull):
+            ingestor.submit(self.room, self.user, 'second')
+        self.assertEqual(ingestor.flush(), 1)
+        self.assertEqual(Message.objects.get().body, 'first')
+
+    def test_failed_batch_keeps_the_good_messages(self):
+        ingestor = MessageIngestor(batch_size=10, max_latency=0, max_queue=10, block_timeout=0, background=False)
+        for body in ['one', None, 'three']:
+            ingestor.submit(self.room, self.user, body)
+        with self.assertLogs('base.ingest', 'ERROR'):
+            self.assertEqual(ingestor.flush(), 3)
+        self.assertEqual(sorted(Message.objects.values_list('body', flat=True)), ['one', 'three'])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 2)
+
+
+# The queue is written by flush() in the test, instead of racing the background thread for the test database.
+@override_settings(MESSAGE_INGEST={'ENABLED': True, 'BACKGROUND': False})
+class IngestViewTests(TestCase):
+    def test_room_posts_are_written_in_a_batch(self):
+        user = User.objects.create_user(username='host', password='secret-password')
+        room = Room.objects.create(host=user, name='Busy room')
+        self.client.force_login(user)
+        for body in ['one', 'two', 'three']:
+            response = self.client.post(reverse('room', args=[room.id]), {'body': body})
+            self.assertEqual(response.status_code, 302)
+        self.assertFalse(Message.objects.filter(room=room).exists())
+        self.assertEqual(get_ingestor().flush(), 3)
+        room.refresh_from_db()
+        self.assertEqual((room.message_count, room.participant_count), (3, 1))
+        self.assertEqual(Message.objects.filter(room=room).count(), 3)
+
+
+# Makes sure the fragments of the feed pages are served from the cache, and are invalidated when their objects change.
+class FragmentCacheTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.topic = Topic.objects.create(name='Python')
+        self.room = Room.objects.create(host=self.user, topic=self.topic, name='Lets learn python')
+        Message.objects.create(user=self.user, room=self.room, body='hello')
+
+    def fragment_stats(self):
+        return cache_stats().get(settings.CACHES['fragments']['LOCATION'], {'hits': 0, 'misses': 0})
+
+    def test_second_render_is_served_from_cache(self):
+        # Logged in as another user, so the page is rendered (not served from the page cache) and no activity item is owned.
+        self.client.force_login(User.objects.create_user(username='guest', password='secret-password'))
+        self.client.get(reverse('home'))
+        before = self.fragment_stats()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('home'))
+        after = self.fragment_stats()
+        # The topic sidebar, the trending topics, the room card and the activity item.
+        self.assertEqual(after['hits'] - before['hits'], 4)
+        self.assertEqual(after['misses'], before['misses'])
+        self.assertFalse([query for query in queries if 'FROM "base_topic"' in query['sql']])
+
+    def test_changes_invalidate_fragments(self):
+        self.client.get(reverse('home'))
+        self.topic.name = 'Rust'
+        self.topic.save()
+        self.room.name = 'Renamed room'
+        self.room.save()
+        response = self.client.get(reverse('home'))
+        self.assertContains(response, 'Rust')
+        self.assertContains(response, 'Renamed room')
+        self.assertNotContains(response, 'Lets learn python')
+
+    def test_room_edit_keeps_topic_sidebar(self):
+        # Only a room that comes, goes or changes topic changes the room counts of the sidebar.
+        rust = Topic.objects.create(name='Rust')
+        version = topics_version()
+        self.room.name = 'Renamed room'
+        self.room.save()
+        self.assertEqual(topics_version(), version)
+        self.room.topic = rust
+        self.room.save()
+        self.assertNotEqual(topics_version(), version)
+        version = topics_version()
+        Room.objects.create(host=self.user, topic=self.topic, name='Another room')
+        self.assertNotEqual(topics_version(), version)
+
+    def test_own_activity_items_keep_delete_button(self):
+        self.client.get(reverse('home'))
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('home'))
+        self.assertContains(response, reverse('delete-message', args=[Message.objects.get().id]))
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('home'))
+        response = self.client.get(reverse('metrics'))
+        self.assertContains(response, 'studybuddy_fragment_cache_requests_total{cache="studybuddy-fragments",result="misses"}')
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+
+# Makes sure logged out visitors get cached pages, which are invalidated by the version stamps and revalidated with ETags.
+class PageCacheTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.room = Room.objects.create(host=self.user, name='Lets learn python')
+
+    def test_anonymous_page_is_served_from_cache(self):
+        self.client.get(reverse('room', args=[self.room.id]))
+        # Only the version stamps are read, the view does not run.
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('room', args=[self.room.id]))
+        self.assertContains(response, 'Lets learn python')
+        self.assertIn('Cookie', response['Vary'])
+
+    def test_normalized_query_string_shares_entry(self):
+        self.client.get(reverse('home'), {'q': 'python', 'page': ''})
+        with self.assertNumQueries(1):
+            self.client.get(reverse('home') + '?q=python')
+
+    def test_new_message_invalidates_room_and_home(self):
+        room_url = reverse('room', args=[self.room.id])
+        self.client.get(room_url)
+        self.client.get(reverse('home'))
+        self.room.post_message(self.user, 'fresh message')
+        self.assertContains(self.client.get(room_url), 'fresh message')
+        self.assertContains(self.client.get(reverse('home')), 'fresh message')
+
+    def test_room_edit_only_invalidates_that_room(self):
+        other = Room.objects.create(host=self.user, name='Other room')
+        self.client.get(reverse('room', args=[other.id]))
+        self.room.name = 'Renamed'
+        self.room.save()
+        with self.assertNumQueries(1):
+            self.client.get(reverse('room', args=[other.id]))
+
+    def test_if_none_match_returns_304(self):
+        url = reverse('room', args=[self.room.id])
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Message.objects.create(user=self.user, room=self.room, body='hello')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    # Another process has its own copy of the page in memory, but reads the same stamps: a bump made there is seen here.
+    def test_stamps_are_shared_between_processes(self):
+        url = reverse('room', args=[self.room.id])
+        etag = self.client.get(url)['ETag']
+        Room.objects.filter(id=self.room.id).update(name='Renamed elsewhere')
+        PageVersion.objects.update_or_create(key=room_version_key(self.room.id), defaults={'stamp' : 1})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Renamed elsewhere')
+
+    # After the TIMEOUT of the page cache the page is rendered again, to refresh its relative times.
+    def test_page_expires_with_the_timeout(self):
+        url = reverse('room', args=[self.room.id])
+        etag = self.client.get(url)['ETag']
+        with unittest.mock.patch('base.cache.page_period', return_value=-1):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_logged_in_users_are_not_cached(self):
+        self.client.get(reverse('home'))
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('home'))
+        self.assertNotIn('ETag', response)
+        self.assertEqual(response.context['request'].user, self.user)
+
+
+# The PRAGMAS of settings.DATABASES are set on every new SQLite connection (base/db.py).
+class DatabaseProfileTests(TestCase):
+    def test_pragmas_are_applied(self):
+        pragmas = settings.DATABASES['default'].get('PRAGMAS', {})
+        if connection.vendor != 'sqlite' or not pragmas:
+            self.skipTest('No SQLite PRAGMAS configured.')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], pragmas['busy_timeout'])
+            cursor.execute('PRAGMA synchronous')
+            # 1 is NORMAL.
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+
+# The primary is the test database, the replica is a SQLite file with a copy of its rows, made by replicate().
+# Rows created after replicate() are only on the primary, like a replica that lags behind.
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(TestCase):
+    # The replica database is added before the test case starts (the test runner only knows the databases of the
+    # settings), so it is wrapped in a transaction like 'default'.
+    @classmethod
+    def setUpClass(cls):
+        cls.databases = {'default', 'replica'}
+        cls.directory = tempfile.TemporaryDirectory()
+        default = connections.settings['default']
+        replica = {'ENGINE' : 'django.db.backends.sqlite3', 'NAME' : str(Path(cls.directory.name) / 'replica.sqlite3')}
+        connections.settings['replica'] = connections.configure_settings({'default' : default, 'replica' : replica})['replica']
+        # Migrations never run on a replica, except here where the replica is created.
+        with override_settings(DATABASE_REPLICAS=[]):
+            call_command('migrate', database='replica', verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections.settings['replica']
+        cls.directory.cleanup()
+        cls.databases = {'default'}
+
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.room = Room.objects.create(host=self.user, name='Lets learn python')
+        self.replicate()
+
+    def replicate(self):
+        User.objects.using('replica').all().delete()
+        Topic.objects.using('replica').all().delete()
+        for model in [User, Topic, Room, Room.participants.through, Message]:
+            model.objects.using('replica').bulk_create(model.objects.using('default').all())
+
+    def test_reads_go_to_replica(self):
+        Room.objects.create(host=self.user, name='Not replicated yet')
+        self.assertEqual(Room.objects.get(id=self.room.id)._state.db, 'replica')
+        response = self.client.get(reverse('home'))
+        self.assertContains(response, 'Lets learn python')
+        self.assertNotContains(response, 'Not replicated yet')
+
+    def test_posted_message_is_read_from_primary(self):
+        self.client.force_login(self.user)
+        url = reverse('room', args=[self.room.id])
+        self.client.post(url, {'body' : 'fresh message'})
+        self.assertContains(self.client.get(url), 'fresh message')
+        # Once the sticky time is over, the reads go back to the (lagging) replica.
+        self.client.cookies['primary_until'] = '0'
+        self.assertNotContains(self.client.get(url), 'fresh message')
+
+    def test_updated_room_is_read_from_primary(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('update-room', args=[self.room.id]), {'name' : 'Renamed room', 'topic' : 'Python', 'description' : ''})
+        self.assertContains(self.client.get(reverse('home')), 'Renamed room')
+
+
+# The dataset generator and the page benchmark, on a tiny dataset.
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        call_command('generate_dataset', users=6, topics=3, rooms=8, messages=120, seed=3, stdout=StringIO())
+
+    def test_dataset_is_skewed_and_counted(self):
+        self.assertEqual(Message.objects.count(), 120)
+        for room in Room.objects.all():
+            self.assertEqual(room.message_count, room.message_set.count())
+            self.assertEqual(room.participant_count, room.participants.count())
+        # The busiest room gets a lot more than an even share of the messages.
+        self.assertGreater(Room.objects.order_by('-message_count').first().message_count, 120 / 8 * 2)
+
+    def test_every_page_is_benchmarked_and_compared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = str(Path(directory) / 'baseline.json')
+            call_command('benchmark_pages', iterations=3, drivers=['client'], save_baseline=path, stdout=StringIO())
+            with open(path) as file:
+                baseline = json.load(file)
+            from .urls import urlpatterns
+            for pattern in urlpatterns:
+                self.assertIn(f'client:{pattern.name}', baseline['results'])
+            self.assertEqual(baseline['results']['client:room']['status'], 200)
+
+            # A page that runs more queries than in the baseline is a regression.
+            baseline['results']['client:user-profile']['queries'] -= 1
+            with open(path, 'w') as file:
+                json.dump(baseline, file)
+            with self.assertRaisesMessage(CommandError, 'client:user-profile'):
+                call_command('benchmark_pages', iterations=3, drivers=['client'], compare=path, stdout=StringIO())
+
+
+@override_settings(INSTRUMENTATION={'SAMPLE_RATE' : 1.0, 'SERVER_TIMING' : True})
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        instrumentation.reset()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        make_rooms(self.user, 6)
+
+    def test_server_timing_and_histograms(self):
+        response = self.client.get(reverse('home'))
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('cache-pages;desc="0 hits 1 misses"', response['Server-Timing'])
+        metrics = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('studybuddy_request_seconds_count{view="home"} 1', metrics)
+        self.assertIn('studybuddy_db_queries_bucket{view="home",le="+Inf"} 1', metrics)
+
+    def test_unsampled_requests_are_only_timed(self):
+        with self.settings(INSTRUMENTATION={'SAMPLE_RATE' : 0, 'SERVER_TIMING' : True}):
+            response = self.client.get(reverse('home'))
+        self.assertNotIn('Server-Timing', response)
+        metrics = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('studybuddy_request_seconds_count{view="home"} 1', metrics)
+        self.assertNotIn('studybuddy_db_queries_count{view="home"}', metrics)
+
+    def test_duplicate_and_n_plus_one_queries(self):
+        for i in range(5):
+            Room.objects.create(host=User.objects.create(username=f'user{i}'), name=f'room of user{i}')
+        with instrumentation.profile() as current:
+            # The host of every room in its own query, without select_related.
+            for room in Room.objects.all():
+                room.host.username
+            list(Topic.objects.all())
+            list(Topic.objects.all())
+        problems = current.problems(duplicate_threshold=2, n_plus_one_threshold=5)
+        self.assertEqual([problem['count'] for problem in problems['n_plus_one']], [11])
+        self.assertIn('auth_user', problems['n_plus_one'][0]['sql'])
+        # The host of the first six rooms six times, and the topics twice.
+        self.assertEqual(sorted(problem['count'] for problem in problems['duplicates']), [2, 6])
+
+    def test_problems_are_logged(self):
+        with self.assertLogs('base.instrumentation', 'WARNING') as logs:
+            with instrumentation.profile() as current:
+                list(Topic.objects.all())
+                list(Topic.objects.all())
+            response = HttpResponse()
+            instrumentation.finish(RequestFactory().get('/'), current, 0.01, response)
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['event'], 'query_problems')
+        self.assertEqual(line['duplicates'][0]['count'], 2)
+
+
+class ApiTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.rooms = make_rooms(self.user, 5)
+        self.room = self.rooms[0]
+
+    def test_rooms_with_sparse_fields_and_cursor(self):
+        response = self.client.get(reverse('api-rooms'), {'fields' : 'id,topic', 'limit' : 3})
+        page = response.json()
+        self.assertEqual(page['data'][0].keys(), {'id', 'topic'})
+        self.assertEqual(len(page['data']), 3)
+        rest = self.client.get(page['next']).json()
+        self.assertIsNone(rest['next'])
+        self.assertEqual({row['id'] for row in page['data'] + rest['data']}, {room.id for room in self.rooms})
+        self.assertEqual(self.client.get(reverse('api-rooms'), {'fields' : 'password'}).status_code, 400)
+
+    def test_rooms_use_a_fixed_number_of_queries(self):
+        make_rooms(self.user, 20, offset=5)
+        # The validators are the newest room and message (one indexed MAX each) and the stamp of the feed, then the page.
+        with self.assertNumQueries(4):
+            self.client.get(reverse('api-rooms'))
+        etag = self.client.get(reverse('api-rooms'))['ETag']
+        with self.assertNumQueries(3):
+            self.assertEqual(self.client.get(reverse('api-rooms'), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_since_returns_new_messages(self):
+        first = Message.objects.filter(room=self.room).get()
+        self.room.post_message(self.user, 'second')
+        self.room.post_message(self.user, 'third')
+        page = self.client.get(reverse('api-room-messages', args=[self.room.id]), {'since' : first.id}).json()
+        self.assertEqual([row['body'] for row in page['data']], ['second', 'third'])
+        again = self.client.get(reverse('api-room-messages', args=[self.room.id]), {'since' : page['since']}).json()
+        self.assertEqual(again['data'], [])
+        self.assertEqual(again['since'], page['since'])
+
+    def test_etag_and_last_modified(self):
+        url = reverse('api-room', args=[self.room.id])
+        response = self.client.get(url)
+        self.assertEqual(response.json()['data']['message_count'], 1)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        # The time of the data: the newest message of the room here.
+        newest = Message.objects.filter(room=self.room).latest('updated').updated
+        self.assertEqual(response['Last-Modified'], http_date(newest.timestamp()))
+        # A new message changes the counter of the room, so the ETag changes.
+        self.room.post_message(self.user, 'hello again')
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.json()['data']['message_count'], 2)
+
+    # The topic name and the username of the host are part of the answers, so renaming them changes the ETag.
+    def test_renamed_topic_or_host_changes_the_etag(self):
+        topic = Topic.objects.get(id=self.room.topic_id)
+        for i, url in enumerate([reverse('api-rooms'), reverse('api-room', args=[self.room.id])]):
+            etag = self.client.get(url)['ETag']
+            topic.name = f'Rust {i}'
+            topic.save()
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, f'"topic":"Rust {i}"')
+
+            etag = response['ETag']
+            user = User.objects.get(id=self.user.id)
+            user.username = f'renamed-{i}'
+            user.save()
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, f'"host":"renamed-{i}"')
+
+    def test_participants_and_topics(self):
+        participants = self.client.get(reverse('api-room-participants', args=[self.room.id])).json()
+        self.assertEqual(participants['data'], [{'id' : self.user.id, 'username' : 'host'}])
+        response = self.client.get(reverse('api-topics'), {'fields' : 'name'})
+        self.assertEqual(len(response.json()['data']), 5)
+        self.assertEqual(self.client.get(reverse('api-topics'), {'fields' : 'name'}, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(reverse('api-room', args=[0])).status_code, 404)
+        # No version stamp is kept for a room that does not exist.
+        self.assertFalse(PageVersion.objects.filter(key=room_version_key(0)).exists())
+
+
+@override_settings(ROOM_EVENTS={'POLL_TIMEOUT' : 5, 'KEEPALIVE' : 5})
+class RoomEventsTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        realtime.set_broker(realtime.LocalBroker())
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.room = Room.objects.create(host=self.user, name='Lets learn python')
+        self.first = self.room.post_message(self.user, 'first')
+        self.url = reverse('api-room-events', args=[self.room.id])
+
+    def tearDown(self):
+        realtime.set_broker(None)
+
+    # Posts a message and runs the on_commit callbacks (the test transaction is never committed).
+    def post(self, body):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.post_message(self.user, body)
+
+    def test_answers_right_away_with_newer_messages(self):
+        response = self.client.get(self.url, {'since' : 0})
+        self.assertEqual([message['body'] for message in response.json()['data']], ['first'])
+        self.assertEqual(response.json()['since'], self.first.id)
+
+    async def test_long_poll_is_woken_by_a_new_message(self):
+        request = asyncio.ensure_future(self.async_client.get(self.url, {'since' : self.first.id}))
+        await asyncio.sleep(0.2)
+        self.assertFalse(request.done())
+        await sync_to_async(self.post)('second')
+        response = await asyncio.wait_for(request, 5)
+        self.assertEqual([message['body'] for message in response.json()['data']], ['second'])
+
+    async def test_long_poll_times_out(self):
+        with self.settings(ROOM_EVENTS={'POLL_TIMEOUT' : 0.2}):
+            response = await self.async_client.get(self.url, {'since' : self.first.id})
+        self.assertEqual(response.json(), {'data' : [], 'since' : self.first.id})
+
+    async def test_event_stream(self):
+        response = await self.async_client.get(self.url, headers={'Accept' : 'text/event-stream', 'Last-Event-ID' : '0'})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = aiter(response.streaming_content)
+        self.assertTrue((await anext(events)).startswith(b'retry:'))
+        self.assertIn(f'id: {self.first.id}\nevent: message\n'.encode(), await anext(events))
+        second = asyncio.ensure_future(anext(events))
+        await asyncio.sleep(0.2)
+        await sync_to_async(self.post)('second')
+        self.assertIn(b'"body":"second"', await asyncio.wait_for(second, 5))
+        await events.aclose()
+
+
+# Old messages are moved to the archive table in batches, and the room pages keep showing them after the recent ones.
+class ArchiveTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.room = Room.objects.create(host=self.user, name='Lets learn python')
+        for i in range(ROOM_PAGE_SIZE + 30):
+            self.room.post_message(self.user, f'message {i}')
+        # The first 40 messages are a year old.
+        self.old = list(Message.objects.order_by('id').values_list('id', flat=True)[:40])
+        for minutes, pk in enumerate(reversed(self.old)):
+            then = timezone.now() - timedelta(days=365, minutes=minutes)
+            Message.objects.filter(id=pk).update(created=then, updated=then)
+
+    def test_command_moves_old_messages_in_batches(self):
+        out = StringIO()
+        call_command('archive_messages', batch_size=15, pause=0, stdout=out)
+        self.assertIn('Archived 40 messages', out.getvalue())
+        self.assertIn('in 3 batches', out.getvalue())
+        self.assertEqual(sorted(ArchivedMessage.objects.values_list('id', flat=True)), self.old)
+        self.assertFalse(Message.objects.filter(id__in=self.old).exists())
+        # The archived messages still count, and are not searched any more.
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, ROOM_PAGE_SIZE + 30)
+        call_command('recount', stdout=StringIO())
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, ROOM_PAGE_SIZE + 30)
+        self.assertEqual(list(filterActivity('message 0')), [])
+        # Nothing left to archive.
+        call_command('archive_messages', stdout=out)
+        self.assertIn('Archived 0 messages', out.getvalue())
+
+    def test_max_batches_and_dry_run(self):
+        out = StringIO()
+        call_command('archive_messages', dry_run=True, stdout=out)
+        self.assertIn('40 messages', out.getvalue())
+        self.assertEqual(ArchivedMessage.objects.count(), 0)
+        call_command('archive_messages', batch_size=10, pause=0, max_batches=2, stdout=out)
+        self.assertEqual(ArchivedMessage.objects.count(), 20)
+
+    # Every batch starts after the last id of the previous one.
+    def test_batches_resume_after_the_last_id(self):
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(list(archive.archive(archive.cutoff(), batch_size=15, pause=0)), [15, 15, 10])
+        scans = [query['sql'] for query in captured if query['sql'].startswith('SELECT "base_message"."id"') and 'ORDER BY' in query['sql']]
+        self.assertEqual([f'"base_message"."id" > {pk}' in sql for pk, sql in zip([0] + self.old[14::15], scans)], [True] * 3)
+
+    # The "older messages" pages of a rendered room page (streamed pages are tested in StreamingTests).
+    @override_settings(STREAMING_PAGES={'ENABLED' : False})
+    def test_room_pages_walk_hot_then_archived_messages(self):
+        call_command('archive_messages', pause=0, stdout=StringIO())
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('room', args=[self.room.id]))
+        seen = [message.id for message in response.context['room_messages']]
+        self.assertEqual(len(seen), ROOM_PAGE_SIZE)
+        next_url = response.context['messages_next_url']
+        while next_url:
+            response = self.client.get(next_url)
+            seen.extend(message.id for message in response.context['room_messages'])
+            next_url = response.context['messages_next_url']
+        self.assertEqual(seen, sorted(seen, reverse=True))
+        self.assertEqual(set(seen), set(Message.objects.values_list('id', flat=True)) | set(self.old))
+        # Archived messages have no delete button.
+        self.assertNotContains(response, reverse('delete-message', args=[self.old[0]]))
+        self.assertEqual(self.client.get(reverse('room-messages', args=[self.room.id]), {'cursor' : 'a.nope'}).status_code, 400)
+
+    def test_api_pages_go_on_with_the_archive(self):
+        call_command('archive_messages', pause=0, stdout=StringIO())
+        page = self.client.get(reverse('api-room-messages', args=[self.room.id]), {'limit' : 30, 'fields' : 'id'}).json()
+        seen = [row['id'] for row in page['data']]
+        while page['next']:
+            page = self.client.get(page['next']).json()
+            seen.extend(row['id'] for row in page['data'])
+        self.assertEqual(len(seen), ROOM_PAGE_SIZE + 30)
+        self.assertEqual(seen[-40:], sorted(self.old, reverse=True))
+
+
+# Rooms and users are deleted in batches of plain DELETEs, rooms are hidden first and purged afterwards.
+class DeletionTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.guest = User.objects.create_user(username='guest', password='secret-password')
+        self.topic = Topic.objects.create(name='Python')
+        self.room = Room.objects.create(host=self.user, topic=self.topic, name='Lets learn python')
+        self.other = Room.objects.create(host=self.user, topic=self.topic, name='Design with me')
+        for i in range(25):
+            self.room.post_message(self.guest if i % 2 else self.user, f'calculus {i}')
+        self.other.post_message(self.guest, 'hello')
+        ArchivedMessage.objects.create(id=10 ** 6, room=self.room, user=self.guest, body='old',
+                                       updated=timezone.now(), created=timezone.now())
+        Room.objects.filter(id=self.room.id).update(message_count=26) # archived messages count too
+
+    @override_settings(ROOM_DELETION={'BACKGROUND' : False, 'BATCH_SIZE' : 10, 'PAUSE' : 0})
+    def test_delete_room_view_removes_everything_in_batches(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('delete-room', args=[self.room.id]))
+        self.assertFalse(Room.all_objects.filter(id=self.room.id).exists())
+        self.assertFalse(Message.objects.filter(room_id=self.room.id).exists())
+        self.assertFalse(ArchivedMessage.objects.filter(room_id=self.room.id).exists())
+        self.assertFalse(Room.participants.through.objects.filter(room_id=self.room.id).exists())
+        self.topic.refresh_from_db()
+        self.assertEqual(self.topic.room_count, 1)
+        self.assertEqual(list(filterRooms('calculus')), [])
+        self.assertEqual(Message.objects.filter(room=self.other).count(), 1)
+
+    def test_hidden_room_disappears_before_it_is_purged(self):
+        deletion.hide_room(self.room)
+        self.assertFalse(Room.objects.filter(id=self.room.id).exists())
+        response = self.client.get(reverse('home'))
+        self.assertEqual([room.id for room in response.context['rooms']], [self.other.id])
+        self.assertEqual({message.room_id for message in response.context['room_messages']}, {self.other.id})
+        self.assertFalse(deletion.hide_room(self.room))
+
+        out = StringIO()
+        call_command('purge_deleted_rooms', batch_size=7, stdout=out)
+        self.assertIn('Purged 1 deleted rooms', out.getvalue())
+        self.assertFalse(Room.all_objects.filter(id=self.room.id).exists())
+        self.assertFalse(Message.objects.filter(room_id=self.room.id).exists())
+
+    def test_delete_user_lowers_the_counters(self):
+        deletion.delete_user(self.guest, batch_size=5, pause=0)
+        self.assertFalse(User.objects.filter(id=self.guest.id).exists())
+        self.room.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual((self.room.message_count, self.room.participant_count), (13, 1))
+        self.assertEqual((self.other.message_count, self.other.participant_count), (0, 0))
+        # The counters agree with the tables.
+        call_command('recount', stdout=StringIO())
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.message_count, self.room.participant_count), (13, 1))
+
+        deletion.delete_user(self.user, pause=0)
+        self.assertEqual(Room.objects.filter(host=None).count(), 2)
+
+    # The delete view of the user admin counts the messages instead of collecting them, and deletes in batches.
+    @override_settings(ROOM_DELETION={'BATCH_SIZE' : 5, 'PAUSE' : 0})
+    def test_admin_deletes_users_in_batches(self):
+        self.client.force_login(User.objects.create_superuser(username='admin', password='secret-password'))
+        url = reverse('admin:auth_user_delete', args=[self.guest.id])
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url)
+        self.assertContains(response, 'Messages: 13')
+        self.assertFalse([query for query in captured if 'SELECT "base_message"."id"' in query['sql']])
+        self.client.post(url, {'post' : 'yes'})
+        self.assertFalse(User.objects.filter(id=self.guest.id).exists())
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.message_count, self.room.participant_count), (13, 1))
+
+
+# Sessions and logged in users come from the "sessions" cache when it is turned on, the login looks the user up once.
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cached_db', AUTHENTICATION_BACKENDS=['base.auth.CachedModelBackend'])
+class AuthFastPathTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.room = Room.objects.create(host=self.user, name='Lets learn python')
+
+    def user_and_session_queries(self, path):
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(self.client.get(path).status_code, 200)
+        return [query['sql'] for query in captured if 'django_session' in query['sql'] or 'WHERE "auth_user"."id" =' in query['sql']]
+
+    def test_logged_in_requests_skip_the_session_and_user_tables(self):
+        self.client.force_login(self.user)
+        self.user_and_session_queries(reverse('home'))
+        self.assertEqual(self.user_and_session_queries(reverse('home')), [])
+        # The room page joins its host, which used to be loaded twice for the host itself.
+        self.assertEqual(self.user_and_session_queries(reverse('room', args=[self.room.id])), [])
+
+    def test_saved_user_is_dropped_from_the_cache(self):
+        self.client.force_login(self.user)
+        self.user_and_session_queries(reverse('home'))
+        self.user.set_password('new-password')
+        self.user.save()
+        # The session was made with the old password, so it is not valid any more.
+        response = self.client.get(reverse('create-room'))
+        self.assertRedirects(response, reverse('login') + '?next=' + reverse('create-room'))
+
+    def test_login_looks_the_user_up_once(self):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.post(reverse('login'), {'username' : 'nobody', 'password' : 'secret-password'})
+        self.assertEqual(sum('FROM "auth_user"' in query['sql'] for query in captured), 1)
+        self.assertEqual([str(message) for message in response.context['messages']], ['Username or password does not exist'])
+        response = self.client.post(reverse('login'), {'username' : 'HOST', 'password' : 'secret-password'})
+        self.assertRedirects(response, reverse('home'))
+
+    # The "sessions" cache of the settings is a LocMemCache, which only one process sees.
+    def test_local_session_cache_is_refused_outside_debug(self):
+        with override_settings(DEBUG=False):
+            self.assertEqual([error.id for error in checks.check_session_cache(None)], ['base.E001'])
+            with override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db', AUTHENTICATION_BACKENDS=['django.contrib.auth.backends.ModelBackend']):
+                self.assertEqual(checks.check_session_cache(None), [])
+        with override_settings(DEBUG=True):
+            self.assertEqual(checks.check_session_cache(None), [])
+
+
+# collectstatic writes hashed and compressed files, StaticFilesMiddleware serves them with far-future caching.
+class StaticFilesTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.settings = override_settings(STATIC_ROOT=cls.directory.name, DEBUG=False)
+        cls.settings.enable()
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings.disable()
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.middleware = StaticFilesMiddleware(lambda request: HttpResponse('not a static file'))
+
+    def get(self, path, **headers):
+        return self.middleware(RequestFactory().get(path, headers=headers))
+
+    def test_hashed_files_are_immutable_and_compressed(self):
+        url = static('images/icons/sprite.svg')
+        self.assertRegex(url, r'sprite\.[0-9a-f]{12}\.svg$')
+        response = self.get(url, accept_encoding='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn(b'<symbol id="remove"', gzip.decompress(b''.join(response.streaming_content)))
+        response.close()
+        self.assertEqual(self.get(url, if_modified_since=response['Last-Modified']).status_code, 304)
+
+    def test_plain_names_and_other_paths(self):
+        response = self.get('/static/js/script.js')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        response.close()
+        for path in ['/static/../manage.py', '/static/nothing.css', '/']:
+            self.assertEqual(self.get(path).content, b'not a static file')
+
+    def test_pages_use_the_icon_sprite(self):
+        response = self.client.get(reverse('home'))
+        self.assertContains(response, static('images/icons/sprite.svg') + '#search')
+        self.assertNotContains(response, '<path')
+
+
+# Uploaded avatars become content-addressed thumbnails, served with the same caching as the hashed static files.
+class AvatarTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.settings = override_settings(MEDIA_ROOT=self.directory.name)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.room = Room.objects.create(host=self.user, name='Lets learn python')
+        self.client.force_login(self.user)
+
+    def upload(self, data):
+        return self.client.post(reverse('update-user'), {'avatar' : SimpleUploadedFile('me.png', data)})
+
+    def png(self):
+        output = BytesIO()
+        avatars.Image.new('RGB', (300, 200), 'purple').save(output, 'PNG')
+        return output.getvalue()
+
+    def test_upload_makes_the_thumbnails(self):
+        data = self.png()
+        self.assertRedirects(self.upload(data), reverse('user-profile', args=[self.user.id]))
+        digest = hashlib.sha256(data).hexdigest()
+        self.assertEqual(Avatar.objects.get(user=self.user).digest, digest)
+        for size, pixels in avatars.get_settings()['SIZES'].items():
+            path = Path(self.directory.name, avatars.avatar_name(digest, size))
+            with avatars.Image.open(path) as image:
+                self.assertEqual((image.format, image.size), ('WEBP', (pixels, pixels)))
+        # The cached user and the cached room page show the new avatar.
+        self.assertContains(self.client.get(reverse('room', args=[self.room.id])), avatars.avatar_name(digest, 'small'))
+
+    def test_default_avatar_and_invalid_uploads(self):
+        self.assertContains(self.client.get(reverse('user-profile', args=[self.user.id])), static('images/avatar.svg'))
+        response = self.upload(b'not an image')
+        self.assertEqual(response.context['form'].errors['avatar'], ['Not a valid image.'])
+        self.assertFalse(Avatar.objects.exists())
+
+    @override_settings(DEBUG=False)
+    def test_middleware_serves_avatars(self):
+        self.upload(self.png())
+        middleware = StaticFilesMiddleware(lambda request: HttpResponse('not an avatar'))
+        url = avatars.avatar_url(User.objects.select_related('avatar').get(id=self.user.id), 'medium')
+        response = middleware(RequestFactory().get(url))
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('immutable', response['Cache-Control'])
+        response.close()
+        for path in [url.replace('medium', 'large'), '/media/../manage.py', '/media/avatars/ab/cd.webp']:
+            self.assertEqual(middleware(RequestFactory().get(path)).content, b'not an avatar')
+
+
+# Room and profile pages of logged in users are streamed: the page header first, then the messages chunk by chunk.
+@override_settings(STREAMING_PAGES={'ENABLED' : True, 'CHUNK_SIZE' : 10, 'ROOM_MESSAGES' : 30})
+class StreamingTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.room = Room.objects.create(host=self.user, name='Lets learn python')
+        Message.objects.bulk_create([Message(user=self.user, room=self.room, body=f'message {i}') for i in range(45)])
+        self.client.force_login(self.user)
+
+    def test_room_thread_is_streamed_in_chunks(self):
+        response = self.client.get(reverse('room', args=[self.room.id]))
+        self.assertTrue(response.streaming)
+        parts = [part.decode() for part in response.streaming_content]
+        # The room details are in the first part, before any message was read.
+        self.assertIn('Lets learn python', parts[0])
+        self.assertNotIn('message 44', parts[0])
+        self.assertIn('message 44', parts[1])
+        self.assertEqual(sum('class="thread"' in part for part in parts), 3)
+        page = ''.join(parts)
+        self.assertEqual(page.count('class="thread"'), 30)
+        self.assertNotIn('message 14<', page)
+        # The "older messages" link goes on with the 15 older messages.
+        next_url = re.search(r'href="([^"]+)">Older messages', page).group(1).replace('&amp;', '&')
+        response = self.client.get(next_url)
+        self.assertEqual([message.body for message in response.context['room_messages']], [f'message {i}' for i in range(14, -1, -1)])
+
+    def test_anonymous_pages_are_rendered_and_cached(self):
+        self.client.logout()
+        self.assertFalse(self.client.get(reverse('room', args=[self.room.id])).streaming)
+        self.assertFalse(self.client.get(reverse('user-profile', args=[self.user.id])).streaming)
+
+    def test_profile_is_streamed(self):
+        response = self.client.get(reverse('user-profile', args=[self.user.id]))
+        parts = [part.decode() for part in response.streaming_content]
+        self.assertNotIn('Lets learn python', parts[0])
+        self.assertIn('Lets learn python', ''.join(parts))
+
+    async def test_room_is_streamed_under_asgi(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('room', args=[self.room.id]))
+        self.assertTrue(response.is_async)
+        parts = [part async for part in response.streaming_content]
+        self.assertIn(b'Lets learn python', parts[0])
+        self.assertEqual(b''.join(parts).count(b'class="thread"'), 30)
+
+
+# Messages are written to the site timeline and the timeline of their author, which the activity column reads.
+class TimelineTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.other = User.objects.create_user(username='guest', password='secret-password')
+        self.room = Room.objects.create(host=self.user, name='Lets learn python')
+
+    def timeline(self, user=None):
+        return [(event.username, event.room_name, event.body) for event in timeline.events(user and user.id)]
+
+    def test_events_follow_the_messages(self):
+        message = self.room.post_message(self.user, 'hello')
+        self.room.post_message(self.other, 'hi')
+        self.assertEqual(self.timeline(), [('guest', 'Lets learn python', 'hi'), ('host', 'Lets learn python', 'hello')])
+        self.assertEqual(self.timeline(self.user), [('host', 'Lets learn python', 'hello')])
+        self.room.name = 'Python for beginners'
+        self.room.save()
+        self.user.username = 'teacher'
+        self.user.save()
+        self.assertEqual(self.timeline(self.user), [('teacher', 'Python for beginners', 'hello')])
+        message.delete()
+        self.assertEqual(self.timeline(self.user), [])
+        self.assertEqual(len(self.timeline()), 1)
+
+    def test_activity_column_reads_the_timeline_index(self):
+        self.room.post_message(self.user, 'hello')
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(reverse('user-profile', args=[self.user.id]))
+        self.assertContains(response, 'replied to post')
+        events = [query['sql'] for query in captured if 'base_activityevent' in query['sql']]
+        self.assertEqual(len(events), 1)
+        self.assertNotIn('base_message', events[0])
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + events[0])
+            plan = ' | '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('activity_timeline_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    @override_settings(ACTIVITY_TIMELINE={'MAX_EVENTS' : 3, 'MAX_SITE_EVENTS' : 5, 'TRIM_EVERY' : 1})
+    def test_timelines_are_capped_and_backfilled(self):
+        for i in range(8):
+            self.room.post_message(self.user, f'message {i}')
+        self.assertEqual([body for _, _, body in self.timeline(self.user)], ['message 7', 'message 6', 'message 5'])
+        self.assertEqual(len(self.timeline()), 5)
+        # A search still finds the messages that are no longer in the timelines.
+        self.assertEqual([event.body for event in filterActivity('message 0')], ['message 0'])
+        self.assertContains(self.client.get(reverse('home'), {'q' : 'message 0'}), 'message 0')
+
+        # Messages written without signals get their events from the backfill, hidden rooms do not.
+        Message.objects.bulk_create([Message(user=self.other, room=self.room, body='bulk')])
+        hidden = Room.objects.create(host=self.other, name='Deleted room')
+        deletion.hide_room(hidden)
+        Message.objects.bulk_create([Message(user=self.other, room=hidden, body='gone')])
+        out = StringIO()
+        call_command('backfill_activity', stdout=out)
+        self.assertIn('Wrote 9 activity events', out.getvalue())
+        self.assertEqual([body for _, _, body in self.timeline(self.other)], ['bulk'])
+        self.assertEqual(len(self.timeline(self.user)), 3)
+        self.assertEqual(self.timeline()[0][2], 'bulk')
+
+
+# Rooms and topics keep a decayed activity score, updated when messages are posted and read through an index.
+class TrendingTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.python = Topic.objects.create(name='Python')
+        self.rust = Topic.objects.create(name='Rust')
+        self.quiet = Room.objects.create(host=self.user, topic=self.rust, name='Quiet room')
+        self.busy = Room.objects.create(host=self.user, topic=self.python, name='Busy room')
+
+    def trends(self):
+        return {room.name : room.trend for room in Room.objects.all()}
+
+    def test_messages_raise_the_score_and_old_ones_count_less(self):
+        self.quiet.post_message(self.user, 'hello')
+        for i in range(3):
+            self.busy.post_message(self.user, f'message {i}')
+        self.assertEqual([room.id for room in trending.trending_rooms(Room.objects.all())], [self.busy.id, self.quiet.id])
+        self.assertEqual([topic.name for topic in trending.trending_topics()], ['Python', 'Rust'])
+        # A message and a participant now score 4, the busy room has 4 + 2 messages.
+        self.assertAlmostEqual(2 ** (self.trends()['Busy room'] - trending.level()), 6, places=2)
+        # Three half-lives later the quiet room's new message is worth more than the busy room's old ones.
+        later = timezone.now() + timedelta(hours=3)
+        with unittest.mock.patch('django.utils.timezone.now', return_value=later):
+            self.quiet.post_message(self.user, 'again')
+            self.assertEqual(trending.trending_rooms(Room.objects.all()).first(), self.quiet)
+
+    def test_rebuild_computes_the_same_scores(self):
+        self.quiet.post_message(self.user, 'hello')
+        for i in range(3):
+            self.busy.post_message(self.user, f'message {i}')
+        before = self.trends()
+        Room.objects.update(trend=0)
+        out = StringIO()
+        call_command('rebuild_trending', stdout=out)
+        self.assertIn('Scored 2 rooms.', out.getvalue())
+        for name, trend in self.trends().items():
+            self.assertAlmostEqual(trend, before[name], places=3)
+
+    def test_home_sorts_by_trend_from_the_index(self):
+        self.quiet.post_message(self.user, 'hello')
+        response = self.client.get(reverse('home'))
+        self.assertEqual([room.id for room in response.context['rooms']], [self.busy.id, self.quiet.id])
+        self.assertContains(response, 'Trending Topics')
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(reverse('home'), {'sort' : 'trending'})
+        self.assertEqual([room.id for room in response.context['rooms']], [self.quiet.id, self.busy.id])
+        self.assertIsNone(response.context['rooms_next_url'])
+        rooms = next(query['sql'] for query in captured if 'ORDER BY "base_room"."trend" DESC' in query['sql'])
+        self.assertNotIn('base_message', rooms)
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + rooms)
+            self.assertIn('room_trending_idx', ' | '.join(row[-1] for row in cursor.fetchall()))
+
+
+# The room form ships no topics, the topic field is completed from an index in memory (base/autocomplete.py).
+class TopicAutocompleteTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        autocomplete.reset()
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        for name, rooms in [('Python', 1), ('Pygame', 3), ('PyTorch', 2), ('Rust', 5)]:
+            topic = Topic.objects.create(name=name)
+            for i in range(rooms):
+                Room.objects.create(host=self.user, topic=topic, name=f'{name} {i}')
+        self.url = reverse('api-topic-autocomplete')
+
+    def tearDown(self):
+        autocomplete.reset()
+
+    def names(self, **params):
+        return [topic['name'] for topic in self.client.get(self.url, params).json()['data']]
+
+    def test_prefix_matches_most_rooms_first_without_queries(self):
+        autocomplete.warm()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.names(q='py'), ['Pygame', 'PyTorch', 'Python'])
+            self.assertEqual(self.names(q='PYT'), ['PyTorch', 'Python'])
+            self.assertEqual(self.names(q='', limit=2), ['Rust', 'Pygame'])
+            self.assertEqual(self.names(q='go'), [])
+        data = self.client.get(self.url, {'q' : 'rust', 'fields' : 'name,room_count'}).json()['data']
+        self.assertEqual(data, [{'name' : 'Rust', 'room_count' : 5}])
+        self.assertEqual(self.client.get(self.url, {'limit' : 'ten'}).status_code, 400)
+
+    def test_form_ships_no_topics_and_new_topics_are_suggested(self):
+        self.client.login(username='host', password='secret-password')
+        response = self.client.get(reverse('create-room'))
+        self.assertNotContains(response, 'Pygame')
+        self.assertContains(response, f'data-autocomplete-url = "{self.url}"')
+        self.assertEqual(self.names(q='py'), ['Pygame', 'PyTorch', 'Python'])
+        # The index follows the new topic and the room counts once the transaction is committed.
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('create-room'), {'topic' : 'Pyramids', 'name' : 'Egypt', 'description' : ''})
+            self.client.post(reverse('create-room'), {'topic' : 'Pyramids', 'name' : 'Maya', 'description' : ''})
+        with self.captureOnCommitCallbacks(execute=True):
+            room = Room.objects.get(name='Python 0')
+            self.client.post(reverse('update-room', args=[room.id]), {'topic' : 'Pyramids', 'name' : 'Moved', 'description' : ''})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.names(q='py'), ['Pygame', 'Pyramids', 'PyTorch', 'Python'])
+            self.assertEqual(self.client.get(self.url, {'q' : 'python'}).json()['data'][0]['room_count'], 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            Topic.objects.get(name='Pygame').delete()
+        self.assertEqual(self.names(q='pyg'), [])
+
+
+# The Room, Topic and Message admin: joined foreign keys, estimated counts, indexed search and batched bulk actions.
+@override_settings(ROOM_DELETION={'BACKGROUND' : False, 'BATCH_SIZE' : 4, 'PAUSE' : 0})
+class AdminTests(TestCase):
+    def setUp(self):
+        clear_caches()
+        self.admin = User.objects.create_superuser(username='admin', password='secret-password')
+        self.user = User.objects.create_user(username='host', password='secret-password')
+        self.topic = Topic.objects.create(name='Python')
+        self.room = Room.objects.create(host=self.user, topic=self.topic, name='Lets learn python')
+        self.other = Room.objects.create(host=self.user, topic=self.topic, name='Design with me')
+        for i in range(10):
+            self.room.post_message(self.user, f'calculus {i}')
+        self.client.force_login(self.admin)
+        self.messages_url = reverse('admin:base_message_changelist')
+
+    def changelist_queries(self, url, **params):
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(self.client.get(url, params).status_code, 200)
+        return [query['sql'] for query in captured]
+
+    def action(self, url, action, ids, **data):
+        return self.client.post(url, {'action' : action, '_selected_action' : ids, **data})
+
+    def test_changelists_join_their_foreign_keys_and_estimate_the_count(self):
+        urls = [self.messages_url, reverse('admin:base_room_changelist'), reverse('admin:base_topic_changelist')]
+        self.changelist_queries(urls[0]) # caches the logged in user
+        few = [len(self.changelist_queries(url)) for url in urls]
+        make_rooms(self.user, 15)
+        self.assertEqual([len(self.changelist_queries(url)) for url in urls], few)
+        with unittest.mock.patch('base.pagination.ESTIMATED_COUNT_MIN', 0):
+            queries = self.changelist_queries(self.messages_url)
+        self.assertFalse([sql for sql in queries if 'COUNT(*)' in sql and 'base_message' in sql])
+        self.assertTrue([sql for sql in queries if 'SELECT MAX("id") FROM "base_message"' in sql])
+        # The search box uses the search index.
+        response = self.client.get(self.messages_url, {'q' : 'calculus'})
+        self.assertEqual(response.context['cl'].result_count, 10)
+
+    # Deleted messages leave holes in the ids, so the estimate offers pages that do not exist.
+    def test_estimated_pages_past_the_end_show_the_last_page(self):
+        Message.objects.filter(id__in=list(Message.objects.order_by('id').values_list('id', flat=True)[1:9])).delete()
+        with unittest.mock.patch('base.pagination.ESTIMATED_COUNT_MIN', 0):
+            paginator = EstimatedCountPaginator(Message.objects.order_by('id'), 3)
+            self.assertEqual(paginator.num_pages, 4)
+            page = paginator.page(4)
+            self.assertEqual((page.number, len(page), paginator.count, paginator.num_pages), (1, 2, 2, 1))
+            with unittest.mock.patch.object(MessageAdmin, 'list_per_page', 3):
+                response = self.client.get(self.messages_url, {'p' : 4})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['cl'].result_list), 2)
+
+    def test_delete_messages_asks_first_then_deletes_in_batches(self):
+        ids = list(Message.objects.filter(room=self.room).values_list('id', flat=True)[:6])
+        response = self.action(self.messages_url, 'deleteMessages', ids)
+        self.assertContains(response, 'Delete 6 messages?')
+        self.assertEqual(Message.objects.count(), 10)
+        self.action(self.messages_url, 'deleteMessages', ids, post='yes')
+        self.assertEqual(Message.objects.count(), 4)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 4)
+        self.assertFalse(ActivityEvent.objects.filter(message_id__in=ids).exists())
+        self.assertEqual(self.client.get(self.messages_url, {'q' : 'calculus'}).context['cl'].result_count, 4)
+
+    def test_move_messages_to_another_room(self):
+        ids = list(Message.objects.filter(room=self.room).values_list('id', flat=True))
+        self.action(self.messages_url, 'moveMessages', ids, room=self.other.id)
+        self.room.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual((self.room.message_count, self.other.message_count), (0, 10))
+        self.assertEqual(self.other.participant_count, 1)
+        self.assertEqual(set(ActivityEvent.objects.values_list('room_name', flat=True)), {'Design with me'})
+        self.assertEqual(list(filterRooms('calculus')), [self.other])
+        response = self.action(self.messages_url, 'moveMessages', ids, room='')
+        self.assertEqual(Message.objects.filter(room=self.other).count(), 10)
+
+    def test_rooms_are_moved_and_deleted_without_the_collector(self):
+        rooms_url = reverse('admin:base_room_changelist')
+        self.action(rooms_url, 'moveRooms', [self.room.id, self.other.id], topic='Maths')
+        maths = Topic.objects.get(name='Maths')
+        self.topic.refresh_from_db()
+        self.assertEqual((self.topic.room_count, maths.room_count), (0, 2))
+        self.assertEqual(set(filterRooms('maths')), {self.room, self.other})
+
+        response = self.action(rooms_url, 'deleteRooms', [self.room.id], select_across='0')
+        self.assertContains(response, 'Delete 1 rooms with all their messages?')
+        with CaptureQueriesContext(connection) as captured:
+            self.action(rooms_url, 'deleteRooms', [self.room.id], post='yes')
+        self.assertFalse([query['sql'] for query in captured if query['sql'].startswith('SELECT "base_message"."id", "base_message"."user_id"')])
+        self.assertFalse(Room.all_objects.filter(id=self.room.id).exists())
+        self.assertFalse(Message.objects.exists())
+        maths.refresh_from_db()
+        self.assertEqual(maths.room_count, 1)
@@ -0,0 +1,123 @@
+import itertools
+from collections import Counter
+from django.conf import settings
+from django.db.models import F
+from .models import ActivityEvent, Message
+from .pagination import KEYSET_ORDERING
+
+# Activity timelines.
+# The "Recent Activities" column (home and profile pages) used to join the messages with their user and room and sort
+# them on every request. Now every new message is also written as an ActivityEvent to two timelines: the site timeline
+# (home) and the timeline of its author (profile). An event carries the names it is shown with (username, room name),
+# so a page of a timeline is one query on the activity_timeline_idx index, whatever the size of the Message table.
+#
+# The timelines are capped: only the newest MAX_EVENTS events of a user (MAX_SITE_EVENTS of the site) are kept, the
+# older ones are trimmed every TRIM_EVERY written events. So a message costs two inserts, and no timeline grows past
+# its cap however many messages are written.
+# Events go away with their message (deleted or archived, see archive.py) and their room (hidden, see deletion.py).
+# The names are updated when a room or a user is renamed (signals.py).
+#
+# A search of the activity column reads the Message table instead (message_events), not the capped timelines.
+#
+# The backfill_activity command builds the timelines again from the Message table, after messages were written
+# without signals (generate_dataset, raw SQL...) or the caps were changed.
+#
+# Settings (settings.ACTIVITY_TIMELINE, all optional):
+#   MAX_EVENTS       events kept in the timeline of a user.
+#   MAX_SITE_EVENTS  events kept in the site timeline.
+#   TRIM_EVERY       the timelines are trimmed once every this many events written by a process.
+
+DEFAULTS = {
+    'MAX_EVENTS' : 1000,
+    'MAX_SITE_EVENTS' : 10000,
+    'TRIM_EVERY' : 100,
+}
+
+# Number of events written by this process.
+_written = itertools.count(1)
+
+
+def get_settings():
+    return {**DEFAULTS, **getattr(settings, 'ACTIVITY_TIMELINE', {})}
+
+
+def cap(owner_id, options):
+    return options['MAX_SITE_EVENTS'] if owner_id is None else options['MAX_EVENTS']
+
+
+# A timeline, newest first: the site timeline (user_id None) or the one of a user.
+# The author is joined for the avatar, activity_item.html needs nothing else.
+def events(user_id=None):
+    return ActivityEvent.objects.filter(owner_id=user_id).select_related('user__avatar')
+
+
+# The messages of the site (or of a user), with the fields of an event, for the searches of the activity column:
+# the timelines only keep the newest events, a search also finds the older messages (with the search index).
+def message_events(user_id=None):
+    messages = Message.objects.filter(room__hidden=False).select_related('user__avatar').annotate(
+        message_id=F('id'), username=F('user__username'), room_name=F('room__name'),
+    )
+    if user_id:
+        messages = messages.filter(user_id=user_id)
+    return messages
+
+
+# The events of a message (with its user and room loaded): one on the site timeline, one on the timeline of the author.
+def events_of(message):
+    fields = {
+        'message_id' : message.id, 'user_id' : message.user_id, 'username' : message.user.username,
+        'room_id' : message.room_id, 'room_name' : message.room.name, 'body' : message.body,
+        'updated' : message.updated, 'created' : message.created,
+    }
+    return [ActivityEvent(owner_id=None, **fields), ActivityEvent(owner_id=message.user_id, **fields)]
+
+
+# Writes the events of new messages.
+def add_events(messages, using='default'):
+    new = [event for message in messages for event in events_of(message)]
+    ActivityEvent.objects.using(using).bulk_create(new)
+    every = get_settings()['TRIM_EVERY']
+    if any([next(_written) % every == 0 for _ in new]):
+        trim({event.owner_id for event in new}, using=using)
+
+
+# Deletes the events older than the cap of the timelines of owner_ids (None for the site timeline).
+def trim(owner_ids, using='default'):
+    options = get_settings()
+    timelines = ActivityEvent.objects.using(using)
+    for owner_id in owner_ids:
+        older = timelines.filter(owner_id=owner_id).order_by(*KEYSET_ORDERING).values('id')[cap(owner_id, options):]
+        # A plain DELETE, the events have no signals.
+        timelines.filter(id__in=older)._raw_delete(using)
+
+
+def remove_events(message_ids, using='default'):
+    ActivityEvent.objects.using(using).filter(message_id__in=list(message_ids))._raw_delete(using)
+
+
+def remove_room_events(room_id, using='default'):
+    ActivityEvent.objects.using(using).filter(room_id=room_id)._raw_delete(using)
+
+
+# Empties the timelines and fills them again with the newest messages, up to the caps.
+# Reads the messages once, newest first. Returns the number of events written.
+def backfill(using='default', chunk_size=2000):
+    options = get_settings()
+    ActivityEvent.objects.using(using).all()._raw_delete(using)
+    messages = (
+        Message.objects.using(using).filter(room__hidden=False).select_related('user', 'room')
+        .order_by(*KEYSET_ORDERING).iterator(chunk_size=chunk_size)
+    )
+    counts = Counter()
+    batch, written = [], 0
+    for message in messages:
+        for event in events_of(message):
+            if counts[event.owner_id] < cap(event.owner_id, options):
+                counts[event.owner_id] += 1
+                batch.append(event)
+        if len(batch) >= chunk_size:
+            ActivityEvent.objects.using(using).bulk_create(batch)
+            written += len(batch)
+            batch = []
+    ActivityEvent.objects.using(using).bulk_create(batch)
+    return written + len(batch)
@@ -0,0 +1,111 @@
+import math
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.db.models import F, Value
+from django.db.models.functions import Greatest, Log, Power
+from django.utils import timezone
+from .models import Room, Topic, Message
+
+# Trending rooms and topics.
+# Every room and topic has a score: its messages and new participants, each one worth less and less as time goes by
+# (it halves every HALF_LIFE seconds). The home page sorts the rooms by it (?sort=trending) and the topic sidebar
+# lists the trending topics, without counting any messages at request time.
+#
+# A decayed score changes all the time, even without new messages, so it cannot be stored as is. What is stored in
+# the `trend` column is log2 of the score measured from a fixed EPOCH: an event of weight w at time t adds
+# 2 ** ((t - EPOCH) / HALF_LIFE) * w. All scores decay at the same rate, so this order is the order of the scores now,
+# and the rooms are sorted by an index on the column. The log keeps the numbers small (about 9000 per year with
+# a half-life of an hour), and adding an event is one UPDATE:  trend = x + log2(1 + 2 ** (trend - x)).
+# Rows without any activity have a trend of 0, the score of the EPOCH, which is nothing now.
+#
+# The rebuild_trending command computes the scores again from the messages (after bulk loads, or when HALF_LIFE
+# was changed, which changes the meaning of the stored numbers).
+#
+# Settings (settings.TRENDING, all optional):
+#   HALF_LIFE           seconds after which a message or participant counts half.
+#   MESSAGE_WEIGHT      weight of a message.
+#   PARTICIPANT_WEIGHT  weight of a new participant.
+#   TOPICS              number of topics in the trending list.
+#   MIN_SCORE           topics with a lower score now are not trending (a message of one half-life ago scores 0.5).
+
+DEFAULTS = {
+    'HALF_LIFE' : 3600,
+    'MESSAGE_WEIGHT' : 1,
+    'PARTICIPANT_WEIGHT' : 3,
+    'TOPICS' : 5,
+    'MIN_SCORE' : 0.1,
+}
+
+EPOCH = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def get_settings():
+    return {**DEFAULTS, **getattr(settings, 'TRENDING', {})}
+
+
+# The trend of an event of weight 1 at `when` (now by default).
+def level(when=None, options=None):
+    options = options or get_settings()
+    return ((when or timezone.now()) - EPOCH).total_seconds() / options['HALF_LIFE']
+
+
+# log2(2 ** a + 2 ** b), without going through the (huge) scores themselves.
+def log_add(a, b):
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+# Adds the activity of a room (number of new messages and participants) to the scores of the room and its topic.
+def record(room_id, messages=0, participants=0, using='default'):
+    options = get_settings()
+    weight = messages * options['MESSAGE_WEIGHT'] + participants * options['PARTICIPANT_WEIGHT']
+    if weight <= 0:
+        return
+    x = level(options=options) + math.log2(weight)
+    # Done by the database, so two posts at the same time both count.
+    # Rows that were quiet for a long time add nothing, the floor keeps 2 ** (trend - x) from underflowing.
+    trend = Value(x) + Log(2, Value(1.0) + Power(2, Greatest(F('trend') - Value(x), Value(-1000.0))))
+    Room.all_objects.using(using).filter(id=room_id).update(trend=trend)
+    Topic.objects.using(using).filter(room__id=room_id).update(trend=trend)
+
+
+def trending_rooms(rooms):
+    return rooms.order_by('-trend', '-id')
+
+
+# The topics with the highest scores now, at least MIN_SCORE.
+def trending_topics():
+    options = get_settings()
+    floor = level(options=options) + math.log2(options['MIN_SCORE'])
+    return list(Topic.objects.filter(trend__gte=floor).order_by('-trend')[:options['TOPICS']])
+
+
+# Computes the scores of every room and topic again from the messages of the Message table (the archived ones are
+# too old to count). A participant counts from their first message in the room. Returns the number of rooms scored.
+def rebuild(using='default', chunk_size=2000):
+    options = get_settings()
+    rooms, topics = defaultdict(float), defaultdict(float)
+    seen = set()
+    messages = (
+        Message.objects.using(using).order_by('created')
+        .values_list('room_id', 'room__topic_id', 'user_id', 'created').iterator(chunk_size=chunk_size)
+    )
+    for room_id, topic_id, user_id, created in messages:
+        weight = options['MESSAGE_WEIGHT']
+        if (room_id, user_id) not in seen:
+            seen.add((room_id, user_id))
+            weight += options['PARTICIPANT_WEIGHT']
+        x = level(created, options) + math.log2(weight)
+        rooms[room_id] = log_add(rooms[room_id], x)
+        if topic_id:
+            topics[topic_id] = log_add(topics[topic_id], x)
+    Room.all_objects.using(using).update(trend=0)
+    Topic.objects.using(using).update(trend=0)
+    Room.all_objects.using(using).bulk_update(
+        [Room(id=pk, trend=trend) for pk, trend in rooms.items()], ['trend'], batch_size=chunk_size
+    )
+    Topic.objects.using(using).bulk_update(
+        [Topic(id=pk, trend=trend) for pk, trend in topics.items()], ['trend'], batch_size=chunk_size
+    )
+    return len(rooms)
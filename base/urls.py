@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import views, api
 
 # Associates URLs with corresponding view functions. For example, an empty path leads to the home function, 
 # "room/str:pk/" leads to the room function, and "create-room/" leads to createRoom.
@@ -11,7 +11,11 @@ urlpatterns = [
     
     path("", views.home, name = "home"),
     path("room/<str:pk>/", views.room, name = "room"),
+    path("room/<str:pk>/messages/", views.roomMessages, name = "room-messages"), # "older messages" pages of a room, archived ones included.
     path("profile/<str:pk>/", views.userProfile, name = "user-profile"),
+    path("update-user/", views.updateUser, name = "update-user"), # avatar upload
+    path("rooms/more/", views.loadRooms, name = "load-rooms"), # "load more" pages of the room feed and the activity stream.
+    path("activity/more/", views.loadActivity, name = "load-activity"),
 
     path('create-room/', views.createRoom, name = "create-room"),
     path('update-room/<str:pk>/', views.updateRoom, name = "update-room"), 
@@ -19,5 +23,16 @@ urlpatterns = [
 
     path('delete-message/<str:pk>/', views.deleteMessage, name = "delete-message"),
 
+    path('metrics/', views.metrics, name = "metrics"), # counters for the monitoring system, only for local addresses.
+
+    # JSON API for the mobile apps and bots (see api.py). A new version gets new urls (api/v2/...), the old ones keep working.
+    path('api/v1/rooms/', api.apiRooms, name = "api-rooms"),
+    path('api/v1/rooms/<int:pk>/', api.apiRoom, name = "api-room"),
+    path('api/v1/rooms/<int:pk>/messages/', api.apiRoomMessages, name = "api-room-messages"),
+    path('api/v1/rooms/<int:pk>/participants/', api.apiRoomParticipants, name = "api-room-participants"),
+    path('api/v1/rooms/<int:pk>/events/', api.apiRoomEvents, name = "api-room-events"), # waits for new messages (long-poll or server-sent events)
+    path('api/v1/topics/', api.apiTopics, name = "api-topics"),
+    path('api/v1/topics/autocomplete/', api.apiTopicAutocomplete, name = "api-topic-autocomplete"), # topic field of the room form
+
     
 ]
@@ -1,15 +1,27 @@
 # Import necessary modules from Django
+from urllib.parse import urlencode
 from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.conf import settings
 from django.db.models import Q
+from django.db.models.expressions import RawSQL
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.forms import UserCreationForm
 from django.http import HttpResponse
 from .models import Room, Topic, Message
-from .forms import RoomForm
+from .forms import RoomForm, AvatarForm
+from .pagination import paginate, encode_cursor, KEYSET_ORDERING, FEED_PAGE_SIZE
+from .archive import history_page, ARCHIVE_CURSOR
+from .deletion import delete_room
+from .avatars import save_avatar
+from .ingest import submit_message, IngestQueueFull
+from . import search, instrumentation, streaming, timeline, trending
+from .cache import cache_stats, anonymous_page_cache, is_cacheable_request, feed_versions, room_versions
 
 # rooms = [
 #    {"id":1, "name":"Lets learn python!"},
@@ -36,14 +48,9 @@ def loginPage(request):
         username = request.POST.get('username').lower()
         password = request.POST.get('password')
         
-        # Checks if the user exists with a try catch block. 
-        try:
-            user = User.objects.get(username=username)
-        except:
-            messages.error(request, 'User does not exist')
-        
-        # Gets user object based on username and password.
+        # Gets user object based on username and password, in a single lookup of the username.
         # Authenticate method will either give us an error or return back a user that matches the credentials (username and password).
+        # It answers the same way for an unknown user and a wrong password, so nobody can find out which usernames exist.
         user = authenticate(request, username=username, password=password)
         
         # Logs the user in if there is one, and returns home. 
@@ -84,78 +91,286 @@ def registerPage(request):
     return render(request,'base/login_register.html', context)
 
 
+# Filters the rooms shown in the room feed.
+# q searches by four different values: topic_name, name, description and the messages of the room. host only keeps the rooms of one user (profile page).
+def filterRooms(q='', host=None):
+    # for_feed() fetches the host, topic and participant count of every room in the same query.
+    rooms = Room.objects.for_feed()
+    backend = search.get_backend()
+    terms = search.parse_terms(q)
+    if backend and terms:
+        # Looks the words up in the full text search index (see search.py).
+        rooms = rooms.filter(id__in=RawSQL(*backend.room_ids_sql(terms)))
+    elif q:
+        # Databases without a search index: the __icontains lookup is used for a case-insensitive search.
+        rooms = rooms.filter(
+            Q(topic__name__icontains=q) | 
+            Q(name__icontains=q) |
+            Q(description__icontains=q)
+            )
+        # __ is used for quering upwards to the parent. 
+    if host:
+        rooms = rooms.filter(host_id=host)
+    return rooms
+
+
+# Filters the activity stream: the site timeline, or the timeline of one user (profile page), see timeline.py.
+# q gets the messages for the rooms based on what topic it is, and the messages that contain the words. The timelines
+# only keep the newest events, so a search reads the messages themselves.
+def filterActivity(q='', user=None):
+    if not q:
+        return timeline.events(user)
+    room_messages = timeline.message_events(user)
+    backend = search.get_backend()
+    terms = search.parse_terms(q)
+    if backend and terms:
+        room_messages = room_messages.filter(
+            Q(room_id__in=RawSQL(*backend.topic_room_ids_sql(terms))) |
+            Q(id__in=RawSQL(*backend.message_ids_sql(terms)))
+            )
+    elif q:
+        room_messages = room_messages.filter(Q(room__topic__name__icontains=q))
+    return room_messages
+
+
+# Builds the url of the "load more" link for the next page, or returns None when there are no more pages.
+def nextPageUrl(name, cursor, q='', user=None, sort=None):
+    if cursor is None:
+        return None
+    params = {'cursor' : cursor}
+    if q:
+        params['q'] = q
+    if user:
+        params['user'] = user
+    if sort:
+        params['sort'] = sort
+    return reverse(name) + '?' + urlencode(params)
+
+
+# Orders of the room feed of the home page: (value of ?sort=, label of the link).
+SORT_OPTIONS = [('relevance', 'Best match'), ('latest', 'Latest'), ('trending', 'Trending')]
+
+
+# The order asked for with ?sort=, and the orders that can be asked for. A search is shown best match first by default,
+# when the database has a search index to rank the rooms with (search.py). The newest rooms come first otherwise.
+def feedSort(request, q):
+    options = [option for option in SORT_OPTIONS if option[0] != 'relevance' or search.can_rank(q)]
+    sort = request.GET.get('sort')
+    return (sort if sort in dict(options) else options[0][0]), options
+
+
+# Turns the cursor of a ranked page back into its offset. Raises ValueError if it is not a number of rooms (0 or more).
+def decodeOffset(cursor):
+    if not cursor.isdigit():
+        raise ValueError(f'Invalid offset: {cursor!r}')
+    return int(cursor)
+
+
+# A page of the rooms that match q, best match first (search.rank_rooms), and the cursor of the next page.
+# The cursor is the number of rooms shown so far: the ranking has no keyset to start from.
+def rankedRooms(q, offset=0, size=FEED_PAGE_SIZE):
+    ids = search.rank_rooms(q, limit=offset + size + 1)
+    page = ids[offset:offset + size]
+    # Joins the host and topic like the other feed pages, hidden rooms are left out by Room.objects.
+    rooms = Room.objects.for_feed().in_bulk(page)
+    cursor = str(offset + size) if len(ids) > offset + size else None
+    return [rooms[pk] for pk in page if pk in rooms], cursor
+
+
 # This function retrieves rooms from the database 
 # and passes them to the "base/home.html" template using the Django render function. 
 # This template is responsible for displaying the list of rooms.
+@anonymous_page_cache(feed_versions) # Logged out visitors get a cached copy of the page (see cache.py).
 def home(request): 
     # Query rooms from the Room model (database table) and pass them to the template
 
    # Retrieves the value of the 'q' parameter from the request's GET parameters. If 'q' is not present, it defaults to an empty string.    
     q = request.GET.get('q') if request.GET.get('q') != None else ''
-    # Queries the Room model (database table) to filter rooms based on the topic name containing the query (q). The __icontains lookup is used for a case-insensitive search.
-    rooms = Room.objects.filter(
-        Q(topic__name__icontains=q) | 
-        Q(name__icontains=q) |
-        Q(description__icontains=q)
-        )  # we can now search by three different values: topic_name, name and description.
-    # __ is used for quering upwards to the parent. 
-    # Retrieves all topics from the Topic model.
+    rooms = filterRooms(q)
+    # Retrieves all topics from the Topic model. The number of rooms in each topic is stored on the topic (room_count).
     topics = Topic.objects.all()
     # Counts the number of rooms
     room_count = rooms.count()
-    # filters and only gets the messages for the room based on what topic it is   
-    room_messages = Message.objects.filter(Q(room__topic__name__icontains=q))
+    # Only the first page of rooms and messages is rendered, the rest is fetched by the "load more" links.
+    # ?sort=trending shows the most active rooms right now instead (see trending.py), on a single page.
+    sort, sort_options = feedSort(request, q)
+    if sort == 'trending':
+        rooms, rooms_cursor = list(trending.trending_rooms(rooms)[:FEED_PAGE_SIZE]), None
+    elif sort == 'relevance':
+        rooms, rooms_cursor = rankedRooms(q)
+    else:
+        rooms, rooms_cursor = paginate(rooms)
+    room_messages, messages_cursor = paginate(filterActivity(q))
     
     
     # Creates a dictionary context containing the queried rooms and all topics. This data will be passed to the template for rendering.
-    context = {"rooms" : rooms, 'topics': topics, 
-               'room_count' : room_count, 'room_messages': room_messages}
+    context = {"rooms" : rooms, 'topics': topics, 'q' : q, 'sort' : sort, 'sort_options' : sort_options,
+               'room_count' : room_count, 'room_messages': room_messages,
+               'rooms_next_url' : nextPageUrl('load-rooms', rooms_cursor, q=q, sort=sort if sort == 'relevance' else None),
+               'messages_next_url' : nextPageUrl('load-activity', messages_cursor, q=q)}
     # Uses the render function to render the "base/home.html" template with the provided context.
     return render(request, "base/home.html", context)
 
+
+# Returns the next page of the room feed, as the html of the room cards. Used by the "load more" link in feed_component.html.
+@anonymous_page_cache(feed_versions) # Logged out visitors get a cached copy of the page (see cache.py).
+def loadRooms(request):
+    q = request.GET.get('q', '')
+    user = request.GET.get('user')
+    sort = 'relevance' if request.GET.get('sort') == 'relevance' and not user and search.can_rank(q) else None
+    try:
+        if sort:
+            rooms, cursor = rankedRooms(q, offset=decodeOffset(request.GET.get('cursor', '0')))
+        else:
+            rooms, cursor = paginate(filterRooms(q, host=user), request.GET.get('cursor'))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid page')
+    context = {'rooms' : rooms, 'rooms_next_url' : nextPageUrl('load-rooms', cursor, q=q, user=user, sort=sort)}
+    return render(request, 'base/feed_component.html', context)
+
+
+# Returns the next page of the activity stream, as the html of the messages. Used by the "load more" link in activity_component.html.
+@anonymous_page_cache(feed_versions) # Logged out visitors get a cached copy of the page (see cache.py).
+def loadActivity(request):
+    q = request.GET.get('q', '')
+    user = request.GET.get('user')
+    try:
+        room_messages, cursor = paginate(filterActivity(q, user=user), request.GET.get('cursor'))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid page')
+    context = {'room_messages' : room_messages, 'messages_next_url' : nextPageUrl('load-activity', cursor, q=q, user=user)}
+    return render(request, 'base/activity_items.html', context)
+
 #  Fetches a specific room based on the provided primary key (pk) from the URL. 
 # The room is then passed to the "base/room.html" template.
+@anonymous_page_cache(room_versions) # Logged out visitors get a cached copy of the page (see cache.py).
 def room(request, pk):
-    # Retrieve a single room from the database based on the provided id (pk)
-    room = Room.objects.get(id=pk) 
+    # Retrieve a single room from the database based on the provided id (pk), with its host and topic in the same query.
+    room = Room.objects.for_feed().get(id=pk) 
     
-    # Queries child object of a specific room. If we take the parent model, in this case we have a room. 
-    # To get all the children, all we have to do is specify the model name, in this case it is message. We put that in lowercase value (message).
-    # So the model name in lowercase followed by "_set.all()". Which is basically saying, give us the set of messages that are related to this specific room.
-    room_messages = room.message_set.all()
+    # Creates a Message object and adds the user to the participants (or queues it for the next batch, see ingest.py).
+    # Browsers with a WebSocket connection post through the chat socket instead (consumers.py), this is the fallback.
+    if request.method == 'POST':
+        try:
+            submit_message(room, request.user, request.POST.get('body')) # The body is passed in from the comment form in the room.html, where in input : name = 'body'. Thats how we get that data.
+        except IngestQueueFull:
+            # Back-pressure: too many messages are waiting to be written.
+            response = HttpResponse('Too many messages right now, please try again in a moment.', status=503)
+            response['Retry-After'] = '1'
+            return response
+        return redirect('room', pk=room.id)
 
     # brings the participants in. all() method is used for the many to many relationship field to get all the participants. These are passed into the context dictionary.
-    participants = room.participants.all()
+    participants = room.participants.select_related('avatar')
 
-    # Creates a Message object and sets the model fields.
-    if request.method == 'POST':
-        message = Message.objects.create(
-            user=request.user,
-            room=room,
-            body=request.POST.get('body') # The body is passed in from the comment form in the room.html, where in input : name = 'body'. Thats how we get that data.
-        )
-        # The user will be added to the many to many field for the participants, so that we can render out the participants of a chatroom.  
-        room.participants.add(request.user)
-        return redirect('room', pk=room.id)
+    # Long threads are sent while they are read from the database (see streaming.py), instead of rendered in one piece.
+    options = streaming.get_settings()
+    if options['ENABLED'] and not is_cacheable_request(request):
+        thread = streamRoomThread(request, room, options['ROOM_MESSAGES'], options['CHUNK_SIZE'])
+        return streaming.stream_page(request, 'base/room.html', {'room' : room, 'participants' : participants},
+                                     {'messages' : thread})
+
+    # Only loaded for the page itself, a POST is redirected.
+    # Queries child object of a specific room. If we take the parent model, in this case we have a room. 
+    # To get all the children, all we have to do is specify the model name, in this case it is message. We put that in lowercase value (message).
+    # So the model name in lowercase followed by "_set.all()". Which is basically saying, give us the set of messages that are related to this specific room.
+    # Only the newest page is rendered, the older messages (hot, then archived, see archive.py) come from the "older messages" link.
+    room_messages, cursor = roomHistory(room, None)
 
     # Creates a dictionary context containing the retrieved room. This data will be passed to the template for rendering.
-    context = {"room" : room, "room_messages" : room_messages, "participants" : participants}
+    context = {"room" : room, "room_messages" : room_messages, "participants" : participants,
+               "messages_next_url" : olderMessagesUrl(room.id, cursor)}
     # Uses the render function to render the "base/room.html" template with the provided context.
     return render(request, "base/room.html", context)
 
 
+# One page of the messages of a room, newest first: the messages of the Message table, then the archived ones.
+def roomHistory(room, cursor):
+    return history_page(room.message_set.select_related('user__avatar'), room.archivedmessage_set.select_related('user__avatar'), cursor)
+
+
+# The messages of a streamed room page: the newest `size` messages of the Message table, rendered chunk_size at a time,
+# then the "older messages" link (the next hot messages, or the archived ones).
+def streamRoomThread(request, room, size, chunk_size):
+    hot = room.message_set.select_related('user__avatar').order_by(*KEYSET_ORDERING)[:size + 1]
+    shown, last, more = 0, None, False
+    for chunk in streaming.chunks(hot, chunk_size):
+        # The extra row only tells that there are more messages.
+        more = shown + len(chunk) > size
+        chunk = chunk[:size - shown]
+        if chunk:
+            shown, last = shown + len(chunk), chunk[-1]
+            yield render_to_string('base/room_messages.html', {'room_messages' : chunk}, request)
+    if more:
+        cursor = encode_cursor(last)
+    else:
+        cursor = ARCHIVE_CURSOR if room.archivedmessage_set.exists() else None
+    yield render_to_string('base/room_messages.html', {'messages_next_url' : olderMessagesUrl(room.id, cursor)}, request)
+
+
+def olderMessagesUrl(pk, cursor):
+    if cursor is None:
+        return None
+    return reverse('room-messages', args=[pk]) + '?' + urlencode({'cursor' : cursor})
+
+
+# Returns the older messages of a room, as the html of the messages. Used by the "older messages" link in room_messages.html.
+@anonymous_page_cache(room_versions) # Logged out visitors get a cached copy of the page (see cache.py).
+def roomMessages(request, pk):
+    room = Room.objects.get(id=pk)
+    try:
+        room_messages, cursor = roomHistory(room, request.GET.get('cursor'))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid page')
+    context = {'room_messages' : room_messages, 'messages_next_url' : olderMessagesUrl(room.id, cursor)}
+    return render(request, 'base/room_messages.html', context)
 
 # 
 def userProfile(request, pk):
-    user = User.objects.get(id=pk)
-    # Gets all the children of the specific object, in this case all the rooms of the user. 
-    rooms = user.room_set.all()
-    room_messages = user.message_set.all()
+    user = User.objects.select_related('avatar').get(id=pk)
     topics = Topic.objects.all()
-    context = {'user' : user, 'rooms' : rooms, 'room_messages' : room_messages, 'topics' : topics}
+
+    # The profile is sent first, the rooms and the activity when they are rendered (see streaming.py).
+    if streaming.get_settings()['ENABLED'] and not is_cacheable_request(request):
+        parts = {'rooms' : renderLater(request, 'base/feed_component.html', lambda: profileRooms(user)),
+                 'activity' : renderLater(request, 'base/activity_items.html', lambda: profileActivity(user))}
+        return streaming.stream_page(request, 'base/profile.html', {'user' : user, 'topics' : topics}, parts)
+
+    context = {'user' : user, 'topics' : topics, **profileRooms(user), **profileActivity(user)}
     return render(request, 'base/profile.html', context)
 
 
+# Gets all the children of the specific object, in this case all the rooms of the user. 
+def profileRooms(user):
+    rooms, cursor = paginate(filterRooms(host=user.id))
+    return {'rooms' : rooms, 'rooms_next_url' : nextPageUrl('load-rooms', cursor, user=user.id)}
+
+
+def profileActivity(user):
+    room_messages, cursor = paginate(filterActivity(user=user.id))
+    return {'room_messages' : room_messages, 'messages_next_url' : nextPageUrl('load-activity', cursor, user=user.id)}
+
+
+# A part of a streamed page: the template is rendered, and get_context() runs its queries, when the stream gets there.
+def renderLater(request, template_name, get_context):
+    yield render_to_string(template_name, get_context(), request)
+
+
+# Lets the logged in user upload a new avatar (see avatars.py).
+@login_required(login_url='login')
+def updateUser(request):
+    form = AvatarForm()
+    if request.method == 'POST':
+        form = AvatarForm(request.POST, request.FILES)
+        if form.is_valid():
+            try:
+                save_avatar(request.user, form.cleaned_data['avatar'])
+                return redirect('user-profile', pk=request.user.id)
+            except ValueError as error:
+                form.add_error('avatar', str(error))
+    return render(request, 'base/update_user.html', {'form' : form})
+
+
 # Handles the creation of a new room. It initializes a RoomForm, processes the form data on a POST request, 
 # saves the room to the database if valid, and redirects to the home page.
 @login_required(login_url='login') # Requires to be logged in, in order to create a room. Redirects user to login page if they are not logged in.
@@ -163,8 +378,6 @@ def createRoom(request):
     # Initializes a new instance of the RoomForm class.
     form = RoomForm()   
     
-    topics = Topic.objects.all()
-    
     # Checks if the request method is POST.
     if request.method == 'POST':
         topic_name = request.POST.get('topic')
@@ -180,7 +393,8 @@ def createRoom(request):
         )
         return redirect('home')
     # Creates a dictionary context containing the form. This data will be passed to the template for rendering.
-    context = {'form':form, 'topics' : topics}
+    # The topics are not listed in the page, the topic field asks for them as the user types (autocomplete.py).
+    context = {'form':form}
     # Uses the render function to render the "base/room_form.html" template with the provided context.
     return render(request, 'base/room_form.html', context)
 
@@ -193,8 +407,6 @@ def updateRoom(request, pk):
     # Initializes a form instance with the existing room data (instance=room). 
     form = RoomForm(instance=room) # the form will be prefilled with the room value.
     
-    topics = Topic.objects.all()
-    
     # Only allows the owner of the room to update the room. 
     if request.user != room.host :
         return HttpResponse('You are not allowed here!')
@@ -211,7 +423,8 @@ def updateRoom(request, pk):
         room.name = request.POST.get('name')
         room.topic = topic
         room.description = request.POST.get('description')
-        room.save()
+        # Only the edited fields are saved, so the counters of the room (changed by other requests in the meantime) are not overwritten.
+        room.save(update_fields=['name', 'topic', 'description', 'updated'])
 
         # Populates the form with the provided POST data, replacing the values in the form with the new values.
         #form = RoomForm(request.POST, instance=room)
@@ -220,7 +433,7 @@ def updateRoom(request, pk):
             #form.save()
         return redirect('home')
     # Creates a dictionary context containing the form. This data will be passed to the template for rendering.
-    context = {'form' : form, 'topics' : topics, 'room' : room}
+    context = {'form' : form, 'room' : room}
     # Uses the render function to render the "base/room_form.html" template with the provided context.
     return render(request, 'base/room_form.html', context)
     
@@ -238,8 +451,8 @@ def deleteRoom(request, pk):
     
     # Checks if the request method is POST.
     if request.method == 'POST':
-        # Removes room from database, deletes it 
-        room.delete()
+        # Hides the room right away, its messages and participants are removed in the background (see deletion.py).
+        delete_room(room)
         return redirect('home')
     return render(request, 'base/delete.html', {'obj':room})
 
@@ -259,4 +472,20 @@ def deleteMessage(request, pk):
         # Removes message from database, deletes it 
         message.delete()
         return redirect('home')
-    return render(request, 'base/delete.html', {'obj':message})
\ No newline at end of file
+    return render(request, 'base/delete.html', {'obj':message})
+
+
+# Counters for the monitoring system, in the Prometheus text format. Only answers requests from the addresses in settings.METRICS_ALLOWED_IPS.
+def metrics(request):
+    if request.META.get('REMOTE_ADDR') not in getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1']):
+        return HttpResponse('You are not allowed here!', status=403)
+    lines = [
+        '# HELP studybuddy_fragment_cache_requests_total Template fragment cache lookups.',
+        '# TYPE studybuddy_fragment_cache_requests_total counter',
+    ]
+    for location, stats in sorted(cache_stats().items()):
+        for result in ['hits', 'misses']:
+            lines.append(f'studybuddy_fragment_cache_requests_total{{cache="{location}",result="{result}"}} {stats[result]}')
+    # Request histograms of the instrumentation middleware.
+    lines += instrumentation.prometheus_lines()
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
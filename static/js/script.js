@@ -67,3 +67,97 @@ if (photoInput)
 // Scroll to Bottom
 const conversationThread = document.querySelector(".room__box");
 if (conversationThread) conversationThread.scrollTop = conversationThread.scrollHeight;
+
+// Load More
+// Replaces the "load more" link with the next page of rooms or messages, fetched from the server.
+document.addEventListener("click", (event) => {
+  const loadMoreLink = event.target.closest(".load-more");
+  if (!loadMoreLink) return;
+  event.preventDefault();
+  fetch(loadMoreLink.href)
+    .then((response) => response.text())
+    .then((html) => {
+      loadMoreLink.outerHTML = html;
+    });
+});
+
+// Topic Autocomplete
+// The room form ships no topics: the datalist of the topic field is filled with the best matches of what is typed,
+// asked from the server (base/autocomplete.py) once the user stops typing for a moment.
+const topicInput = document.querySelector("input[data-autocomplete-url]");
+if (topicInput) {
+  const topicList = document.getElementById(topicInput.getAttribute("list"));
+  let typing;
+  const suggestTopics = () => {
+    const prefix = topicInput.value;
+    fetch(`${topicInput.dataset.autocompleteUrl}?q=${encodeURIComponent(prefix)}`)
+      .then((response) => response.json())
+      .then((answer) => {
+        // An answer to an older prefix is thrown away.
+        if (prefix !== topicInput.value) return;
+        topicList.replaceChildren(
+          ...answer.data.map((topic) => {
+            const option = document.createElement("option");
+            option.value = topic.name;
+            return option;
+          })
+        );
+      });
+  };
+  topicInput.addEventListener("input", () => {
+    clearTimeout(typing);
+    typing = setTimeout(suggestTopics, 150);
+  });
+  topicInput.addEventListener("focus", suggestTopics, { once: true });
+}
+
+// Real-time Room Chat
+// Connects to the chat WebSocket of the room (base/consumers.py). New messages are added to the thread as they are posted,
+// and the message form sends over the socket instead of reloading the page. Without a connection the form is a normal POST.
+const threads = document.querySelector(".threads[data-room-id]");
+if (threads && "WebSocket" in window) {
+  const protocol = window.location.protocol === "https:" ? "wss" : "ws";
+  const socket = new WebSocket(`${protocol}://${window.location.host}/ws/room/${threads.dataset.roomId}/`);
+  const chatForm = document.querySelector(".room__message form");
+
+  const addThread = (delta) => {
+    const thread = document.createElement("div");
+    thread.className = "thread";
+    thread.dataset.messageId = delta.id;
+    thread.innerHTML = `<div class="thread__top">
+        <div class="thread__author">
+          <a class="thread__authorInfo">
+            <div class="avatar avatar--small"><img /></div>
+            <span></span>
+          </a>
+          <span class="thread__date">just now</span>
+        </div>
+      </div>
+      <div class="thread__details"></div>`;
+    thread.querySelector(".avatar img").src = delta.user.avatar;
+    thread.querySelector(".thread__authorInfo").href = `/profile/${delta.user.id}/`;
+    thread.querySelector(".thread__authorInfo span").textContent = `@${delta.user.username}`;
+    thread.querySelector(".thread__details").textContent = delta.body;
+    // The thread shows the newest message first.
+    threads.prepend(thread);
+  };
+
+  socket.addEventListener("message", (event) => {
+    const delta = JSON.parse(event.data);
+    if (delta.type === "message") addThread(delta);
+    if (delta.type === "message_deleted") {
+      const thread = threads.querySelector(`[data-message-id="${delta.id}"]`);
+      if (thread) thread.remove();
+    }
+  });
+
+  if (chatForm) {
+    chatForm.addEventListener("submit", (event) => {
+      if (socket.readyState !== WebSocket.OPEN) return;
+      event.preventDefault();
+      const input = chatForm.querySelector("input[name='body']");
+      socket.send(JSON.stringify({ body: input.value }));
+      input.value = "";
+    });
+  }
+}
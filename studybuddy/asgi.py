@@ -13,4 +13,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'studybuddy.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# WebSocket connections (the room chat) are handled by base.consumers, everything else by Django.
+# Imported after get_asgi_application(), which sets Django up.
+from base.consumers import websocketRouter
+from base import autocomplete
+
+# Loads the topic autocomplete index before the first request.
+autocomplete.warm()
+
+application = websocketRouter(django_application)
@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+import django
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -41,7 +44,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'base.middleware.StaticFilesMiddleware', # collected static files, with far-future caching (base/staticfiles.py)
+    'base.middleware.InstrumentationMiddleware', # per view timings, query counts and N+1 detection (base/instrumentation.py)
     'django.middleware.security.SecurityMiddleware',
+    'base.middleware.ReplicaStickinessMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -65,6 +71,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'base.context_processors.fragment_cache',
+                'base.context_processors.trending',
             ],
         },
     },
@@ -76,11 +84,161 @@ WSGI_APPLICATION = 'studybuddy.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
+# The database is chosen with environment variables:
+#   DATABASE_ENGINE        "sqlite" (default) or "postgresql".
+#   DATABASE_NAME          file name (SQLite) or database name (PostgreSQL).
+#   DATABASE_USER, DATABASE_PASSWORD, DATABASE_HOST, DATABASE_PORT   PostgreSQL only.
+#   DATABASE_CONN_MAX_AGE  seconds a connection is kept open between requests (SQLite only, PostgreSQL uses the pool).
+#   DATABASE_POOL_MIN_SIZE, DATABASE_POOL_MAX_SIZE                   size of the PostgreSQL connection pool.
+#
+# SQLite runs in WAL mode, so readers never block the writer and the writer never blocks readers.
+# PRAGMAS are applied to every new connection (see base/db.py):
+#   journal_mode=WAL      readers and the writer work at the same time.
+#   synchronous=NORMAL    no fsync on every commit (safe with WAL, a power cut can only lose the last commits).
+#   mmap_size             reads go through memory mapped I/O instead of read() calls.
+#   busy_timeout          milliseconds a writer waits for the lock before "database is locked".
+#   cache_size            page cache per connection, negative numbers are KiB.
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite')
+
+if DATABASE_ENGINE == 'postgresql':
+    # Needs psycopg 3 with the pool extra (pip install "psycopg[pool]") and Django 5.1 or newer.
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DATABASE_NAME', 'studybuddy'),
+            'USER': os.environ.get('DATABASE_USER', ''),
+            'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+            'HOST': os.environ.get('DATABASE_HOST', ''),
+            'PORT': os.environ.get('DATABASE_PORT', ''),
+            'CONN_MAX_AGE': 0, # Connections are kept by the pool, not by Django.
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('DATABASE_POOL_MIN_SIZE', 2)),
+                    'max_size': int(os.environ.get('DATABASE_POOL_MAX_SIZE', 20)),
+                    'timeout': 10,
+                },
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DATABASE_NAME', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 600)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'timeout': 20, # seconds the sqlite3 module waits for the lock.
+            },
+            'PRAGMAS': {
+                'journal_mode': 'WAL',
+                'synchronous': 'NORMAL',
+                'mmap_size': 256 * 1024 * 1024,
+                'busy_timeout': 20000,
+                'cache_size': -20000,
+            },
+        }
+    }
+    # Django 5.1+: writing transactions take the lock when they start (BEGIN IMMEDIATE), instead of failing
+    # with "database is locked" when a reading transaction tries to become a writer.
+    if django.VERSION >= (5, 1):
+        DATABASES['default']['OPTIONS']['transaction_mode'] = 'IMMEDIATE'
+
+# Read replicas (see base/routers.py): DATABASE_REPLICAS is a comma separated list of replica hosts (PostgreSQL)
+# or replica files (SQLite). Each one gets the settings of the primary and an alias: replica1, replica2...
+# Writes go to 'default', reads go to a replica, except right after a write (REPLICA_STICKY_SECONDS, see base/middleware.py).
+# In tests the replicas mirror 'default', because the test databases have no replication.
+DATABASE_REPLICAS = []
+for number, replica in enumerate(filter(None, os.environ.get('DATABASE_REPLICAS', '').split(',')), start=1):
+    alias = f'replica{number}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        ('HOST' if DATABASE_ENGINE == 'postgresql' else 'NAME'): replica.strip(),
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['base.routers.PrimaryReplicaRouter']
+
+REPLICA_STICKY_SECONDS = 10
+
+
+# Cache
+# The "fragments" cache holds the cached pieces of the feed pages (see base/cache.py).
+# It keeps at most MAX_ENTRIES fragments and evicts the least recently used ones first.
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'fragments': {
+        'BACKEND': 'base.cache.CountingLocMemCache',
+        'LOCATION': 'studybuddy-fragments',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+    # Full page cache of logged out visitors (see base/cache.py). Each process keeps its own copy of the pages, they
+    # are only served while the version stamps (a table shared by every process) still match. A page, and its ETag,
+    # is also only used for TIMEOUT seconds: after that it is rendered again (and browsers get a 200 instead of a 304),
+    # so the relative times ("5 minutes ago") are never older than that.
+    'pages': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'studybuddy-pages',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+    # Sessions and logged in users, when the cached session engine or user backend is turned on (see base/auth.py).
+    # It must be shared by every process (REDIS_URL below), a LocMemCache is refused outside DEBUG (base/checks.py).
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'studybuddy-sessions',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+if os.environ.get('REDIS_URL'):
+    CACHES['sessions'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['REDIS_URL'],
     }
+
+# Sessions
+# The sessions are read from the database by default. SESSION_ENGINE=django.contrib.sessions.backends.cached_db reads
+# them from the "sessions" cache and writes them to the cache and the database (write-through), so a session survives
+# a cache restart. 'django.contrib.sessions.backends.signed_cookies' keeps the session in the cookie instead, without
+# any lookup (the session data is then readable by the visitor, but cannot be changed).
+SESSION_ENGINE = os.environ.get('SESSION_ENGINE', 'django.contrib.sessions.backends.db')
+SESSION_CACHE_ALIAS = 'sessions'
+
+# AUTH_USER_CACHE=1 caches the logged in user of a session too, for AUTH_USER_CACHE_TIMEOUT seconds (see base/auth.py).
+# A logout, a new password or a deactivated user must reach every process, so it needs the shared "sessions" cache.
+AUTHENTICATION_BACKENDS = [
+    'base.auth.CachedModelBackend' if os.environ.get('AUTH_USER_CACHE') else 'django.contrib.auth.backends.ModelBackend',
+]
+AUTH_USER_CACHE_TIMEOUT = 300
+
+# Seconds a cached fragment is used. Fragments contain relative times ("5 minutes ago"), so this is kept short.
+FRAGMENT_CACHE_TIMEOUT = 60
+
+# Addresses allowed to read the /metrics/ endpoint.
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+
+# Request instrumentation (see base/instrumentation.py). Every request is added to the histograms of the metrics view,
+# SAMPLE_RATE of them are profiled (queries, templates, caches, duplicate and N+1 queries).
+# The Server-Timing header shows the timings in the network tab of the browser, only in development.
+INSTRUMENTATION = {
+    'ENABLED' : True,
+    'SAMPLE_RATE' : 1.0 if DEBUG else 0.01,
+    'SERVER_TIMING' : DEBUG,
+    'DUPLICATE_THRESHOLD' : 2,
+    'N_PLUS_ONE_THRESHOLD' : 5,
 }
 
 
@@ -124,11 +282,109 @@ STATICFILES_DIRS = [
     BASE_DIR / 'static'
 ]
 
+# python manage.py collectstatic copies the static files here, with hashed names and compressed variants
+# (see base/staticfiles.py). StaticFilesMiddleware serves them from there when DEBUG is off.
+STATIC_ROOT = os.environ.get('STATIC_ROOT', BASE_DIR / 'staticfiles')
 
-# STATIC_ROOT = 
+# Uploaded files (the avatars, see base/avatars.py). Served by StaticFilesMiddleware, or by runserver with DEBUG.
+MEDIA_URL = 'media/'
+MEDIA_ROOT = os.environ.get('MEDIA_ROOT', BASE_DIR / 'media')
+
+# Avatar thumbnails: name -> pixels (width and height), and the largest upload accepted.
+AVATARS = {
+    'SIZES' : {'small' : 64, 'medium' : 160},
+    'MAX_BYTES' : 5 * 1024 * 1024,
+}
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'base.staticfiles.CompressedManifestStaticFilesStorage',
+    },
+}
 
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Publish/subscribe broker of the real-time room chat (see base/realtime.py).
+# LocalBroker only works inside one process, a broker for several ASGI workers can be plugged in here.
+CHAT_BROKER = 'base.realtime.LocalBroker'
+
+
+# New messages of a room for clients without the WebSocket chat (see base/api.py, apiRoomEvents).
+# Long-poll requests wait up to POLL_TIMEOUT seconds, event streams get a keep-alive comment every KEEPALIVE seconds.
+ROOM_EVENTS = {
+    'POLL_TIMEOUT' : 25,
+    'KEEPALIVE' : 15,
+    'MAX_MESSAGES' : 100,
+    'RETRY' : 3000,
+}
+
+
+# Batched message ingestion (see base/ingest.py). When enabled, posted messages are queued and written in batches
+# by a background thread: at most BATCH_SIZE per transaction, at most MAX_LATENCY seconds after they were posted.
+# When MAX_QUEUE messages are waiting, new ones are refused after BLOCK_TIMEOUT seconds (HTTP 503).
+MESSAGE_INGEST = {
+    'ENABLED' : False,
+    'BATCH_SIZE' : 200,
+    'MAX_LATENCY' : 0.05,
+    'MAX_QUEUE' : 10000,
+    'BLOCK_TIMEOUT' : 1.0,
+}
+
+# Message retention (base/archive.py): the archive_messages command moves the messages older than HOT_DAYS
+# to the archive table, BATCH_SIZE messages per transaction with a PAUSE (seconds) in between.
+MESSAGE_RETENTION = {
+    'HOT_DAYS' : 90,
+    'BATCH_SIZE' : 1000,
+    'PAUSE' : 0.05,
+}
+
+# Streamed room and profile pages (base/streaming.py): the messages are read and sent CHUNK_SIZE at a time,
+# ROOM_MESSAGES of them on the room page.
+STREAMING_PAGES = {
+    'ENABLED' : True,
+    'CHUNK_SIZE' : 100,
+    'ROOM_MESSAGES' : 500,
+}
+
+# Activity timelines (base/timeline.py): the newest MAX_EVENTS events of every user and MAX_SITE_EVENTS of the site
+# are kept, the timelines are trimmed every TRIM_EVERY events. Rebuilt with the backfill_activity command.
+ACTIVITY_TIMELINE = {
+    'MAX_EVENTS' : 1000,
+    'MAX_SITE_EVENTS' : 10000,
+    'TRIM_EVERY' : 100,
+}
+
+# Trending rooms and topics (base/trending.py): messages and new participants count MESSAGE_WEIGHT and
+# PARTICIPANT_WEIGHT, and half as much every HALF_LIFE seconds. Run rebuild_trending after changing HALF_LIFE.
+TRENDING = {
+    'HALF_LIFE' : 3600,
+    'MESSAGE_WEIGHT' : 1,
+    'PARTICIPANT_WEIGHT' : 3,
+    'TOPICS' : 5,
+    'MIN_SCORE' : 0.1,
+}
+
+# Topic autocomplete of the room form (base/autocomplete.py): at most MAX_LIMIT topics per answer (LIMIT by default),
+# from an index in the memory of every process, loaded again from the database every REFRESH seconds.
+TOPIC_AUTOCOMPLETE = {
+    'LIMIT' : 10,
+    'MAX_LIMIT' : 50,
+    'REFRESH' : 300,
+    'MEMO_SIZE' : 10000,
+}
+
+# Room and user deletion (base/deletion.py): rows are deleted BATCH_SIZE at a time with a PAUSE (seconds) in between.
+# With BACKGROUND a deleted room is hidden right away and its rows are removed by a background thread.
+ROOM_DELETION = {
+    'BACKGROUND' : True,
+    'BATCH_SIZE' : 1000,
+    'PAUSE' : 0.01,
+}
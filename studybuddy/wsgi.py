@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'studybuddy.settings')
 
 application = get_wsgi_application()
+
+# Loads the topic autocomplete index before the first request. Imported after get_wsgi_application(), which sets Django up.
+from base import autocomplete
+
+autocomplete.warm()